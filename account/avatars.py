@@ -0,0 +1,119 @@
+"""
+AVATAR URL CACHE AND BACKGROUND THUMBNAILS
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from avatar.models import Avatar
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+from django.dispatch import Signal
+
+
+logger = logging.getLogger(__name__)
+
+# Sent with ``user_id`` once the avatar URLs of a user changed
+avatar_urls_changed = Signal()
+
+# Sized and timed out for the avatar URLs only (see AVATAR_URL_CACHE_SIZE)
+cache = caches['avatar_urls']
+
+_pool = ThreadPoolExecutor(max_workers=settings.AVATAR_THUMBNAIL_WORKERS, thread_name_prefix='avatar-thumbnails')
+_scheduled = set()
+_scheduled_lock = threading.Lock()
+
+
+def cache_key(user_id):
+    return f'avatar-urls:{user_id}'
+
+
+def default_avatar_url(profile, size):
+    """
+    Gravatar of the user's email, with a default picture depending on the
+    gender. Built from strings only, no storage or network access.
+    """
+    email_hash = hashlib.md5(profile.user.email.strip().lower().encode()).hexdigest()
+    style = settings.AVATAR_DEFAULT_STYLES.get(profile.gender, 'identicon')
+    return f'https://www.gravatar.com/avatar/{email_hash}?s={size}&d={style}'
+
+
+def build_avatar_urls(profile, rendered):
+    """
+    {size: URL} of a profile's avatar. Thumbnails are only pointed to once
+    ``rendered``, the original image stands in for them until then.
+    """
+    avatar = profile.avatar
+    if avatar is None or not avatar.avatar:
+        return {str(size): default_avatar_url(profile, size) for size in settings.AVATAR_THUMBNAIL_SIZES}
+    original = avatar.avatar.url
+    return {
+        str(size): avatar.avatar_url(size) if rendered else original
+        for size in settings.AVATAR_THUMBNAIL_SIZES
+    }
+
+
+def avatar_url(profile, size=None):
+    """
+    Ready to use avatar URL of a profile (load it with select_related('user',
+    'avatar')). Served from the cache; on a miss the URLs are rebuilt without
+    storage access and the thumbnails are rendered in the background.
+    """
+    size = str(size or settings.CHAT_AVATAR_SIZE)
+    urls = cache.get(cache_key(profile.user_id))
+    if urls is None:
+        urls = build_avatar_urls(profile, rendered=False)
+        cache.set(cache_key(profile.user_id), urls)
+        if profile.avatar_id is not None:
+            schedule_thumbnails(profile.avatar_id)
+    return urls.get(size) or next(iter(urls.values()))
+
+
+def forget_avatar_urls(user_id):
+    cache.delete(cache_key(user_id))
+
+
+def invalidate_avatar_urls(user_id):
+    """
+    Forget the cached URLs of a user and tell the caches built on them
+    (the chat relays it to its other processes, see chat/invalidation.py).
+    """
+    forget_avatar_urls(user_id)
+    avatar_urls_changed.send(sender=Avatar, user_id=user_id)
+
+
+def schedule_thumbnails(avatar_id):
+    """
+    Render the thumbnail sizes of an avatar in the worker pool, then point
+    the cached URLs to them.
+    """
+    with _scheduled_lock:
+        if avatar_id in _scheduled:
+            return
+        _scheduled.add(avatar_id)
+    _pool.submit(_render_thumbnails, avatar_id)
+
+
+def _render_thumbnails(avatar_id):
+    from .models import Profile
+
+    try:
+        avatar = Avatar.objects.filter(pk=avatar_id).first()
+        if avatar is None:
+            return
+        for size in settings.AVATAR_THUMBNAIL_SIZES:
+            if not avatar.thumbnail_exists(size):
+                avatar.create_thumbnail(size)
+        profile = Profile.objects.select_related('user', 'avatar').filter(avatar_id=avatar_id).first()
+        if profile is not None:
+            cache.set(cache_key(profile.user_id), build_avatar_urls(profile, rendered=True))
+            avatar_urls_changed.send(sender=Avatar, user_id=profile.user_id)
+    except Exception:
+        logger.exception('Could not render the thumbnails of avatar %s', avatar_id)
+    finally:
+        with _scheduled_lock:
+            _scheduled.discard(avatar_id)
+        close_old_connections()
@@ -0,0 +1,87 @@
+"""
+COALESCED last_online WRITES
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+
+class LastOnlineCoalescer:
+    """
+    Keeps the last time each user was seen in memory and writes them all to
+    ``Profile.last_online`` every ``interval`` seconds with a single UPDATE,
+    instead of saving the whole profile row on every heartbeat.
+
+    ``touch`` only writes to a dict, so it is safe to call from the event
+    loop as well as from synchronous views; the database work happens in a
+    background thread.
+    """
+
+    # Keep the UPDATE ... CASE statements under the SQLite variable limit
+    chunk_size = 400
+
+    def __init__(self, interval=None):
+        self.interval = interval or settings.PRESENCE_FLUSH_INTERVAL
+        self._pending = {}  # user id -> last time seen
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def touch(self, user_id, when=None):
+        with self._lock:
+            self._pending[user_id] = when or timezone.now()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='last-online-writer', daemon=True)
+                self._thread.start()
+
+    def last_seen(self, user_id):
+        """
+        Last time seen that is not written yet, None if there is none.
+        """
+        return self._pending.get(user_id)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except DatabaseError:
+                logger.exception('Could not write last_online, will retry')
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        from .models import Profile
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        try:
+            for start in range(0, len(items), self.chunk_size):
+                chunk = items[start:start + self.chunk_size]
+                Profile.objects.filter(user_id__in=[user_id for user_id, _ in chunk]).update(
+                    last_online=Case(
+                        *[When(user_id=user_id, then=Value(seen)) for user_id, seen in chunk],
+                        output_field=DateTimeField(),
+                    )
+                )
+        except DatabaseError:
+            # Put back what was not written, unless a newer value came in meanwhile
+            with self._lock:
+                for user_id, seen in items:
+                    self._pending.setdefault(user_id, seen)
+            raise
+
+
+last_online_writer = LastOnlineCoalescer()
+
+atexit.register(last_online_writer.flush)
@@ -1,12 +1,16 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import models
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from django.utils import timezone
-from channels.db import database_sync_to_async
 
 from django.contrib.auth.models import User
 from avatar.models import Avatar
 
+from .last_online import last_online_writer
+
 
 class Profile(models.Model):
     """
@@ -17,7 +21,7 @@ class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     last_seen = models.DateTimeField(null=True, blank=True) # last time the user connect to the system
     last_online = models.DateTimeField(null=True, blank=True) # last time the user used the chat feature
-    avatar = models.OneToOneField(Avatar, on_delete=models.CASCADE, null=True, blank=True)
+    avatar = models.OneToOneField(Avatar, on_delete=models.SET_NULL, null=True, blank=True)
     GENDER_CHOICES = (
         ('M', 'Male'),
         ('F', 'Female'),
@@ -25,25 +29,13 @@ class Profile(models.Model):
     )
     gender = models.CharField(max_length=1, choices=GENDER_CHOICES)
 
-    def save(self, *args, **kwargs):
-        if not self.avatar:
-            if self.gender == 'M':
-                self.avatar = Avatar.objects.create(user=self.user, primary=True, avatar_type='gravatar')
-            elif self.gender == 'F':
-                self.avatar = Avatar.objects.create(user=self.user, primary=True, avatar_type='female')
-            else:
-                # Default avatar for "other" gender
-                self.avatar = Avatar.objects.create(user=self.user, primary=True, avatar_type='identicon')    
-        super(Profile, self).save(*args, **kwargs)
-        
-    # @database_sync_to_async
-    # async def get_unread_messages_count(self, sender):
-    #     from chat.models import Message
-    #     """
-    #     Returns the number of unread messages from the given sender.
-    #     """
-    #     return Message.objects.filter(sender=sender, recipient=self.user, is_read=False).count()
-    
+    def get_unread_messages_count(self, sender):
+        """
+        Returns the number of unread messages from the given sender.
+        """
+        from chat.models import UnreadCounter
+        return UnreadCounter.objects.filter(receiver=self, sender=sender).values_list('count', flat=True).first() or 0
+
     def last_seen(self):
         if self.last_online is None:
             return 'never'
@@ -65,15 +57,28 @@ class Profile(models.Model):
         else:
             return self.last_online.strftime('%B %d, %Y')
 
+    def is_online(self):
+        # A value waiting in the coalescer is more recent than the column
+        last_online = last_online_writer.last_seen(self.user_id) or self.last_online
+        if last_online is None:
+            return False
+        return timezone.now() - last_online < timedelta(seconds=settings.PRESENCE_TTL)
+
     def set_last_online(self):
+        # chat imports account: imported here to keep account importable first
+        from chat.groups import user_inbox_group
+        from chat.protocol import group_event
+
+        was_online = self.is_online()
         self.last_online = timezone.now()
-        self.save()
+        # Written in bulk by the coalescer (see last_online.py), not row by row
+        last_online_writer.touch(self.user_id, self.last_online)
+        if was_online:
+            # Nothing changed for the other users
+            return
         channel_layer = get_channel_layer()
         async_to_sync(channel_layer.group_send)(
-            f'user-{self.user.id}',
-            {
-                'type': 'user.last_online',
-                'last_online': self.last_seen(),
-            }
+            user_inbox_group(self.user_id),
+            group_event('user.last_online', {'last_online': self.last_seen()})
         )
     
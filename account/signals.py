@@ -0,0 +1,29 @@
+"""
+SIGNAL HANDLERS
+AUTHOR: DONALD PROGRAMMEUR
+"""
+from avatar.models import Avatar
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .avatars import invalidate_avatar_urls, schedule_thumbnails
+from .models import Profile
+
+
+@receiver(post_save, sender=Avatar)
+def avatar_saved(sender, instance, **kwargs):
+    if instance.primary:
+        Profile.objects.filter(user_id=instance.user_id).update(avatar=instance)
+    invalidate_avatar_urls(instance.user_id)
+    schedule_thumbnails(instance.pk)
+
+
+@receiver(post_delete, sender=Avatar)
+def avatar_deleted(sender, instance, **kwargs):
+    invalidate_avatar_urls(instance.user_id)
+
+
+@receiver(post_save, sender=Profile)
+def profile_saved(sender, instance, **kwargs):
+    # The default avatar depends on the gender
+    invalidate_avatar_urls(instance.user_id)
@@ -0,0 +1,131 @@
+"""
+MESSAGE ARCHIVE (MONTHLY COMPRESSED JSONL FILES)
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import gzip
+import json
+import os
+import zlib
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.dateparse import parse_datetime
+
+from .models import ArchivedMonth, Message, UnreadCounter
+from .search import unindex_messages
+
+
+ARCHIVE_FIELDS = ('id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'is_read', 'attachment_id')
+
+
+def archive_path(month):
+    return os.path.join(settings.CHAT_ARCHIVE_DIR, f'messages-{month:%Y-%m}.jsonl.gz')
+
+
+def archive_messages(cutoff, chunk_size=1000):
+    """
+    Move every message older than ``cutoff`` to the archive file of its month.
+
+    Messages are read by id in chunks of ``chunk_size`` (constant memory),
+    written to the archive first, as one complete gzip member per chunk and
+    month synced to disk, then deleted with one bounded DELETE per chunk
+    that also records the new size of the file. If the process dies in
+    between, the next run cuts the file back to its recorded size and
+    archives the same rows again. Returns the number of messages archived.
+    """
+    os.makedirs(settings.CHAT_ARCHIVE_DIR, exist_ok=True)
+    queryset = Message.objects.filter(timestamp__lt=cutoff).order_by('id').values(*ARCHIVE_FIELDS)
+    files = {}
+    archived = 0
+    last_id = 0
+    try:
+        while True:
+            chunk = list(queryset.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1]['id']
+            lines = defaultdict(list)
+            for row in chunk:
+                month = row['timestamp'].date().replace(day=1)
+                row['timestamp'] = row['timestamp'].isoformat()
+                lines[month].append(json.dumps(row) + '\n')
+            sizes = {}
+            for month, month_lines in lines.items():
+                if month not in files:
+                    files[month] = _open_archive(month)
+                sizes[month] = _append_member(files[month], month_lines)
+            _delete_chunk(chunk, Counter({month: len(month_lines) for month, month_lines in lines.items()}), sizes)
+            archived += len(chunk)
+    finally:
+        for archive in files.values():
+            archive.close()
+    return archived
+
+
+def _open_archive(month):
+    # Appending adds a gzip member, read back as one stream
+    record, _ = ArchivedMonth.objects.get_or_create(month=month, defaults={'path': archive_path(month), 'size': 0})
+    archive = open(record.path, 'ab')
+    if record.size is not None:
+        # Drop what a run that died wrote after its last deleted chunk
+        archive.truncate(record.size)
+    return archive
+
+
+def _append_member(archive, lines):
+    # Complete on disk before the messages are deleted; returns the new size
+    with gzip.GzipFile(fileobj=archive, mode='ab') as member:
+        member.write(''.join(lines).encode('utf8'))
+    archive.flush()
+    os.fsync(archive.fileno())
+    return os.fstat(archive.fileno()).st_size
+
+
+def _delete_chunk(chunk, months, sizes):
+    unread = Counter((row['receiver_id'], row['sender_id']) for row in chunk if not row['is_read'])
+    with transaction.atomic():
+        unindex_messages(chunk)
+        Message.objects.filter(id__in=[row['id'] for row in chunk]).delete()
+        for (receiver_id, sender_id), count in unread.items():
+            UnreadCounter.objects.decrement(receiver_id, sender_id, count)
+        for month, count in months.items():
+            ArchivedMonth.objects.filter(month=month).update(message_count=F('message_count') + count, size=sizes[month])
+
+
+def read_archived_page(profile_id, other_profile_id, before=None, limit=50):
+    """
+    Up to ``limit`` archived messages of a conversation older than the
+    ``before`` (timestamp, id) position, newest first, in the format of
+    history.get_conversation_page. Archive files are read newest month first
+    and only until the page is full, each one up to its last complete gzip
+    member.
+    """
+    pair = {(profile_id, other_profile_id), (other_profile_id, profile_id)}
+    months = ArchivedMonth.objects.order_by('-month')
+    if before is not None:
+        months = months.filter(month__lte=before[0].date())
+
+    rows = {}
+    for archived_month in months:
+        if not os.path.exists(archived_month.path):
+            continue
+        with gzip.open(archived_month.path, 'rt', encoding='utf8') as archive:
+            try:
+                for line in archive:
+                    row = json.loads(line)
+                    if (row['sender_id'], row['receiver_id']) not in pair:
+                        continue
+                    row['timestamp'] = parse_datetime(row['timestamp'])
+                    # Archived before messages had attachments
+                    row.setdefault('attachment_id', None)
+                    if before is not None and (row['timestamp'], row['id']) >= before:
+                        continue
+                    rows[row['id']] = row
+            except (EOFError, gzip.BadGzipFile, zlib.error):
+                # A write that did not complete: its messages are still in the database
+                pass
+        if len(rows) >= limit:
+            break
+    return sorted(rows.values(), key=lambda row: (row['timestamp'], row['id']), reverse=True)[:limit]
@@ -0,0 +1,254 @@
+"""
+MESSAGE ATTACHMENTS: RESUMABLE UPLOADS, THUMBNAILS, SENDING FILES
+AUTHOR: DONALD PROGRAMMEUR
+
+An attachment is created with its name, size and type, then its bytes are
+appended in as many requests as needed, each one starting at the offset
+the server has (a broken upload resumes from there). The bytes go to a
+".part" file, copied in blocks, never held in memory; once complete, the
+file takes its final name and images get a thumbnail made by a pool of
+processes. The attachment is then sent with a message. Uploads left
+incomplete are deleted after a while (see expire_uploads).
+"""
+import fcntl
+import logging
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+from urllib.parse import quote
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.http import FileResponse, HttpResponse
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from .models import Attachment
+from .thumbnails import IMAGE_TYPES, make_thumbnail
+
+
+logger = logging.getLogger(__name__)
+
+# Bytes copied from the request to the file at a time
+BLOCK_SIZE = 64 * 1024
+
+
+class InvalidUpload(ValueError):
+    pass
+
+
+class UploadOffsetMismatch(InvalidUpload):
+    """
+    The chunk does not start where the stored bytes end (``offset``).
+    """
+
+    def __init__(self, offset):
+        super().__init__(offset)
+        self.offset = offset
+
+
+def full_path(relative_path):
+    return os.path.join(settings.CHAT_ATTACHMENT_DIR, relative_path)
+
+
+def part_path(attachment):
+    return full_path(attachment.path) + '.part'
+
+
+def create_upload(uploader_id, name, size, content_type=None):
+    """
+    Start the upload of a file of ``size`` bytes.
+    """
+    size = int(size)
+    if not 0 < size <= settings.CHAT_ATTACHMENT_MAX_SIZE:
+        raise InvalidUpload(f'size must be between 1 and {settings.CHAT_ATTACHMENT_MAX_SIZE} bytes')
+    name = get_valid_filename(os.path.basename(name or '')) or 'attachment'
+    now = timezone.now()
+    attachment = Attachment.objects.create(
+        uploader_id=uploader_id,
+        name=name[:255],
+        content_type=(content_type or 'application/octet-stream')[:100],
+        size=size,
+        path=os.path.join(f'{now:%Y}', f'{now:%m}', uuid.uuid4().hex),
+        created_at=now,
+    )
+    os.makedirs(os.path.dirname(full_path(attachment.path)), exist_ok=True)
+    open(part_path(attachment), 'wb').close()
+    return attachment
+
+
+def upload_offset(attachment):
+    """
+    Number of bytes of the file the server has.
+    """
+    if attachment.completed_at is not None:
+        return attachment.size
+    try:
+        return os.path.getsize(part_path(attachment))
+    except FileNotFoundError:
+        return 0
+
+
+def write_chunk(attachment, offset, stream):
+    """
+    Append the bytes read from ``stream`` (a request) to the file, from
+    ``offset``. Returns the new offset; the upload is finished when it
+    reaches the size of the file.
+    """
+    if attachment.completed_at is not None:
+        raise UploadOffsetMismatch(attachment.size)
+    try:
+        part = open(part_path(attachment), 'r+b')
+    except FileNotFoundError:
+        # Completed (renamed) by another request
+        raise UploadOffsetMismatch(attachment.size)
+    with part:
+        # One writer at a time per file, whatever the process
+        fcntl.flock(part, fcntl.LOCK_EX)
+        if not os.path.exists(part_path(attachment)):
+            raise UploadOffsetMismatch(attachment.size)
+        current = part.seek(0, os.SEEK_END)
+        if offset != current:
+            raise UploadOffsetMismatch(current)
+        while True:
+            block = stream.read(BLOCK_SIZE)
+            if not block:
+                break
+            if current + len(block) > attachment.size:
+                # Keep what fits: the client resumes from the stored offset
+                part.write(block[:attachment.size - current])
+                current = attachment.size
+                break
+            part.write(block)
+            current += len(block)
+        if current == attachment.size:
+            finish_upload(attachment)
+    return current
+
+
+def finish_upload(attachment):
+    os.replace(part_path(attachment), full_path(attachment.path))
+    attachment.completed_at = timezone.now()
+    attachment.save(update_fields=['completed_at'])
+    if attachment.content_type in IMAGE_TYPES:
+        schedule_thumbnail(attachment)
+
+
+def expire_uploads(cutoff):
+    """
+    Delete the uploads started before ``cutoff`` and still incomplete, with
+    their ".part" file, unless bytes were appended to it since. Returns the
+    number of uploads deleted.
+    """
+    expired = Attachment.objects.filter(completed_at__isnull=True, created_at__lt=cutoff)
+    return sum(_expire_upload(attachment, cutoff.timestamp()) for attachment in expired.iterator())
+
+
+def _expire_upload(attachment, cutoff):
+    try:
+        part = open(part_path(attachment), 'r+b')
+    except FileNotFoundError:
+        # Completed (renamed) since it was read, or the file is already gone
+        return bool(Attachment.objects.filter(pk=attachment.pk, completed_at__isnull=True).delete()[0])
+    with part:
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # A chunk is being written
+            return False
+        if not os.path.exists(part_path(attachment)) or os.fstat(part.fileno()).st_mtime >= cutoff:
+            return False
+        os.remove(part_path(attachment))
+    Attachment.objects.filter(pk=attachment.pk).delete()
+    return True
+
+
+_thumbnail_pool = None
+
+
+def thumbnail_pool():
+    """
+    Worker processes for the thumbnails, started on first use. Spawned, not
+    forked: the server process has threads and an event loop.
+    """
+    global _thumbnail_pool
+    if _thumbnail_pool is None:
+        _thumbnail_pool = ProcessPoolExecutor(
+            max_workers=settings.CHAT_THUMBNAIL_WORKERS, mp_context=get_context('spawn')
+        )
+    return _thumbnail_pool
+
+
+def schedule_thumbnail(attachment):
+    thumbnail = attachment.path + '.thumb.jpg'
+    future = thumbnail_pool().submit(
+        make_thumbnail, full_path(attachment.path), full_path(thumbnail), settings.CHAT_THUMBNAIL_SIZE
+    )
+    future.add_done_callback(partial(_thumbnail_done, attachment.pk, thumbnail))
+    return future
+
+
+def _thumbnail_done(attachment_id, thumbnail, future):
+    # Called in a thread of the pool, which has its own database connection
+    try:
+        width, height = future.result()
+    except Exception:
+        logger.warning('No thumbnail for attachment %s', attachment_id, exc_info=True)
+        return
+    try:
+        Attachment.objects.filter(pk=attachment_id).update(width=width, height=height, thumbnail=thumbnail)
+    finally:
+        connection.close()
+
+
+def readable_attachment(profile_id, attachment_id):
+    """
+    The complete attachment ``attachment_id`` if ``profile_id`` uploaded it
+    or received it in a message (archived or not), None otherwise.
+    """
+    return Attachment.objects.filter(
+        # The message of an attachment sent before its receiver was recorded
+        Q(uploader_id=profile_id) | Q(receiver_id=profile_id) | Q(message__receiver_id=profile_id),
+        pk=attachment_id,
+        completed_at__isnull=False,
+    ).first()
+
+
+def sendable_attachment(profile_id, attachment_id, receiver_id):
+    """
+    The attachment ``attachment_id`` if ``profile_id`` may send it: their
+    own, complete, and not sent with another message yet. Marks it sent to
+    ``receiver_id``, in a single UPDATE, so that two sends of it cannot both
+    succeed.
+    """
+    claimed = Attachment.objects.filter(
+        pk=attachment_id, uploader_id=profile_id, completed_at__isnull=False, sent_at__isnull=True
+    ).update(sent_at=timezone.now(), receiver_id=receiver_id)
+    return Attachment.objects.get(pk=attachment_id) if claimed else None
+
+
+def file_response(relative_path, name, content_type):
+    """
+    Response sending a stored file: by the front web server when
+    CHAT_ATTACHMENT_SENDFILE is set (the file never goes through Python),
+    otherwise streamed by Django (with sendfile under WSGI servers that
+    provide wsgi.file_wrapper).
+    """
+    inline = content_type in IMAGE_TYPES
+    if not settings.CHAT_ATTACHMENT_SENDFILE:
+        return FileResponse(
+            open(full_path(relative_path), 'rb'),
+            as_attachment=not inline,
+            filename=name,
+            content_type=content_type if inline else 'application/octet-stream',
+        )
+    response = HttpResponse(content_type=content_type if inline else 'application/octet-stream')
+    if settings.CHAT_ATTACHMENT_SENDFILE == 'X-Accel-Redirect':
+        response['X-Accel-Redirect'] = settings.CHAT_ATTACHMENT_SENDFILE_URL + quote(relative_path)
+    else:
+        response[settings.CHAT_ATTACHMENT_SENDFILE] = full_path(relative_path)
+    response['Content-Disposition'] = "{}; filename*=UTF-8''{}".format('inline' if inline else 'attachment', quote(name))
+    return response
@@ -0,0 +1,105 @@
+"""
+BENCHMARK TOOLKIT
+AUTHOR: DONALD PROGRAMMEUR
+
+The scenarios drive the ASGI application in-process with channels'
+WebsocketCommunicator, an in-memory channel layer and a throwaway test
+database. Run them with ``python manage.py benchmark <scenario>``.
+"""
+import math
+import time
+
+from channels.layers import channel_layers
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.db.backends.signals import connection_created
+
+from account.models import Profile
+from chat.layers import LocalChannelLayer
+
+
+def use_in_memory_layer(capacity=10000):
+    """
+    Replace the configured channel layer (Redis) by an in-memory one.
+    """
+    channel_layers.set('default', LocalChannelLayer(capacity=capacity))
+
+
+def create_users(count, prefix='bench'):
+    """
+    Create ``count`` users with their profile, without the avatar work done
+    by Profile.save.
+    """
+    User = get_user_model()
+    User.objects.bulk_create([User(username=f'{prefix}{index}') for index in range(count)])
+    users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+    Profile.objects.bulk_create([Profile(user=user, gender='O') for user in users])
+    return users
+
+
+async def open_socket(application, path, user, subprotocols=None):
+    """
+    Connected WebsocketCommunicator for ``user`` (the session is skipped).
+    """
+    communicator = WebsocketCommunicator(application, path, subprotocols=subprotocols)
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect()
+    if not connected:
+        raise RuntimeError(f'{path} refused the connection of {user}')
+    return communicator
+
+
+class QueryCounter:
+    """
+    Counts the SQL queries run on every database connection opened while it
+    is installed, whatever the thread (database_sync_to_async runs the ORM
+    in worker threads).
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def install(self, *connections):
+        connection_created.connect(self._on_connection_created)
+        for connection in connections:
+            self._on_connection_created(None, connection)
+
+    def uninstall(self, *connections):
+        connection_created.disconnect(self._on_connection_created)
+        for connection in connections:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+def now():
+    return time.perf_counter()
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of ``values`` (0 when empty).
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def latency_summary(latencies):
+    """
+    p50/p99/max of a list of latencies in seconds, in milliseconds.
+    """
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(max(latencies, default=0) * 1000, 3),
+    }
@@ -0,0 +1,87 @@
+"""
+MULTI-DEVICE INBOX FAN-OUT BENCHMARK
+AUTHOR: DONALD PROGRAMMEUR
+
+Every user keeps ``devices`` sockets open on ws/inbox/ and a private chat
+with the next user. Each user sends ``messages`` messages; every inbox
+socket of the receiver must get each of them exactly once.
+"""
+import asyncio
+
+from asgiref.sync import async_to_sync
+from django.db import connections
+
+from . import QueryCounter, create_users, latency_summary, now, open_socket, use_in_memory_layer
+
+
+def run(application, users=10, devices=3, messages=20, **options):
+    use_in_memory_layer()
+    people = create_users(users, prefix='inbox')
+    counter = QueryCounter()
+    counter.install(*connections.all())
+    try:
+        result = async_to_sync(_drive)(application, people, devices, messages, counter)
+    finally:
+        counter.uninstall(*connections.all())
+    result.update(scenario='inbox', users=users, devices=devices, messages=messages)
+    return result
+
+
+async def _drive(application, people, devices, messages, counter):
+    inboxes = {
+        user.id: [await open_socket(application, '/ws/inbox/', user) for _ in range(devices)]
+        for user in people
+    }
+    chats = [
+        await open_socket(application, f'/ws/private_chat/{people[(index + 1) % len(people)].id}/', user)
+        for index, user in enumerate(people)
+    ]
+    queries_before = counter.count
+
+    latencies = []
+    started = now()
+    for _ in range(messages):
+        # Every user sends one message to the next one, at the same time
+        await asyncio.gather(*[chat.send_json_to({'message': repr(now())}) for chat in chats])
+        for sockets in inboxes.values():
+            for socket in sockets:
+                event = await receive_new_message(socket)
+                latencies.append(now() - float(event['message']))
+        for chat in chats:
+            await chat.receive_json_from(timeout=5)
+    elapsed = now() - started
+
+    # Each socket must have got each message once, no more
+    duplicates = 0
+    for sockets in inboxes.values():
+        for socket in sockets:
+            while not await socket.receive_nothing(timeout=0.05):
+                if 'new_message' in await socket.receive_json_from():
+                    duplicates += 1
+                    break
+
+    for chat in chats:
+        await chat.disconnect()
+    queries = counter.count - queries_before
+    for sockets in inboxes.values():
+        for socket in sockets:
+            await socket.disconnect()
+
+    sent = len(people) * messages
+    return {
+        'messages_sent': sent,
+        'deliveries': len(latencies),
+        'deliveries_per_message': len(latencies) / sent,
+        'sockets_with_duplicates': duplicates,
+        'throughput_msg_per_s': round(sent / elapsed, 1),
+        'delivery_latency': latency_summary(latencies),
+        'queries_per_message': round(queries / sent, 3),
+    }
+
+
+async def receive_new_message(socket):
+    # Skip the other inbox events (sequence numbers of written messages)
+    while True:
+        event = await socket.receive_json_from(timeout=5)
+        if 'new_message' in event:
+            return event['new_message']
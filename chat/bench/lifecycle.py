@@ -0,0 +1,135 @@
+"""
+CHAT LIFECYCLE BENCHMARK
+AUTHOR: DONALD PROGRAMMEUR
+
+Users are paired two by two and go through the whole life of a session:
+they connect to ws/user_list_status/ one after the other, chat on
+ws/private_chat/<id>/, send presence heartbeats and disconnect. Every phase
+reports its latencies and the SQL queries it ran.
+"""
+import asyncio
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import connections
+
+from chat.models import Message
+from . import QueryCounter, create_users, latency_summary, now, open_socket, use_in_memory_layer
+
+
+def run(application, users=10, messages=20, heartbeats=5, **options):
+    use_in_memory_layer()
+    # Users chat two by two
+    users += users % 2
+    people = create_users(users, prefix='chat')
+    counter = QueryCounter()
+    counter.install(*connections.all())
+    try:
+        result = async_to_sync(_drive)(application, people, messages, heartbeats, counter)
+    finally:
+        counter.uninstall(*connections.all())
+    result.update(scenario='lifecycle', users=users, messages=messages, heartbeats=heartbeats)
+    return result
+
+
+async def _receive_presence(socket, user_id, status):
+    while True:
+        frame = await socket.receive_json_from(timeout=5)
+        if frame.get('presence') == {'user_id': user_id, 'status': status}:
+            return now()
+
+
+async def _connect_phase(application, people, counter):
+    sockets = []
+    snapshot_latencies, delta_latencies = [], []
+    queries_before = counter.count
+    for user in people:
+        started = now()
+        socket = await open_socket(application, '/ws/user_list_status/', user)
+        await socket.receive_json_from(timeout=5)  # snapshot
+        snapshot_latencies.append(now() - started)
+        sockets.append(socket)
+        for other in sockets:
+            delta_latencies.append(await _receive_presence(other, user.id, 'online') - started)
+    return sockets, {
+        'snapshot_latency': latency_summary(snapshot_latencies),
+        'presence_delta_latency': latency_summary(delta_latencies),
+        'queries_per_connect': round((counter.count - queries_before) / len(people), 3),
+    }
+
+
+async def _chat_phase(application, people, messages, counter):
+    chats = []
+    for index, user in enumerate(people):
+        partner = people[index ^ 1]
+        chats.append(await open_socket(application, f'/ws/private_chat/{partner.id}/', user))
+    queries_before = counter.count
+    messages_before = await sync_to_async(Message.objects.count)()
+
+    latencies = []
+    started = now()
+    for _ in range(messages):
+        await asyncio.gather(*[chat.send_json_to({'message': repr(now())}) for chat in chats])
+        for user, chat in zip(people, chats):
+            # Own echo and partner's message, in any order, between 'persisted' frames
+            received = 0
+            while received < 2:
+                frame = await chat.receive_json_from(timeout=5)
+                if 'message' not in frame:
+                    continue
+                received += 1
+                if frame['username'] != user.username:
+                    latencies.append(now() - float(frame['message']))
+    elapsed = now() - started
+
+    # Disconnecting flushes the write-behind queue
+    for chat in chats:
+        await chat.disconnect()
+    sent = len(people) * messages
+    persisted = await sync_to_async(Message.objects.count)() - messages_before
+    return {
+        'messages_sent': sent,
+        'messages_persisted': persisted,
+        'throughput_msg_per_s': round(sent / elapsed, 1),
+        'latency': latency_summary(latencies),
+        'queries_per_message': round((counter.count - queries_before) / sent, 3),
+    }
+
+
+async def _heartbeat_phase(sockets, heartbeats, counter):
+    queries_before = counter.count
+    started = now()
+    for _ in range(heartbeats):
+        await asyncio.gather(*[socket.send_json_to({'message': 'heartbeat'}) for socket in sockets])
+    # Heartbeats of online users produce no frame: wait until things settle
+    for socket in sockets:
+        await socket.receive_nothing(timeout=0.01)
+    sent = len(sockets) * heartbeats
+    return {
+        'heartbeats': sent,
+        'elapsed_s': round(now() - started, 4),
+        'queries': counter.count - queries_before,
+    }
+
+
+async def _disconnect_phase(people, sockets):
+    delta_latencies = []
+    while sockets:
+        user, socket = people[len(sockets) - 1], sockets.pop()
+        started = now()
+        await socket.disconnect()
+        for other in sockets:
+            delta_latencies.append(await _receive_presence(other, user.id, 'offline') - started)
+    return {'presence_delta_latency': latency_summary(delta_latencies)}
+
+
+async def _drive(application, people, messages, heartbeats, counter):
+    sockets, connect = await _connect_phase(application, people, counter)
+    chat = await _chat_phase(application, people, messages, counter)
+    heartbeat = await _heartbeat_phase(sockets, heartbeats, counter)
+    disconnect = await _disconnect_phase(people, sockets)
+    return {
+        'connect': connect,
+        'chat': chat,
+        'heartbeat': heartbeat,
+        'disconnect': disconnect,
+    }
@@ -0,0 +1,80 @@
+"""
+LARGE ROOM BROADCAST BENCHMARK
+AUTHOR: DONALD PROGRAMMEUR
+
+``members`` users join one room and each keeps a socket open on
+ws/room/<id>/. One of them sends ``messages`` messages, one at a time;
+every socket of the room must get each of them. Reports the time for a
+message to reach the members (each one and the last one) and the queries
+per message, which must not grow with the size of the room.
+"""
+import asyncio
+
+from asgiref.sync import async_to_sync
+from django.db import connections
+
+from chat.models import Membership, Room
+from . import QueryCounter, create_users, latency_summary, now, open_socket, use_in_memory_layer
+
+
+def run(application, members=500, messages=20, **options):
+    use_in_memory_layer()
+    people = create_users(members, prefix='room')
+    room = Room.objects.create(name='benchmark')
+    Membership.objects.bulk_create([Membership(room=room, profile=user.profile) for user in people])
+    counter = QueryCounter()
+    counter.install(*connections.all())
+    try:
+        result = async_to_sync(_drive)(application, room, people, messages, counter)
+    finally:
+        counter.uninstall(*connections.all())
+    result.update(scenario='room', members=members, messages=messages)
+    return result
+
+
+async def _receive_at(socket):
+    # Time the frame reached this socket (all sockets are awaited together)
+    frame = await socket.receive_json_from(timeout=10)
+    return now(), frame
+
+
+async def _drive(application, room, people, messages, counter):
+    path = f'/ws/room/{room.id}/'
+    queries_before = counter.count
+    started = now()
+    sockets = [await open_socket(application, path, user) for user in people]
+    connect_elapsed = now() - started
+    connect_queries = counter.count - queries_before
+
+    latencies, fanout = [], []
+    queries_before = counter.count
+    started = now()
+    for index in range(messages):
+        receipts = asyncio.gather(*[_receive_at(socket) for socket in sockets])
+        sent = now()
+        await sockets[0].send_json_to({'message': f'benchmark {index}'})
+        arrivals = [arrival - sent for arrival, frame in await receipts if 'room_message' in frame]
+        if len(arrivals) != len(sockets):
+            raise RuntimeError(f'message {index} reached {len(arrivals)} of {len(sockets)} sockets')
+        latencies.extend(arrivals)
+        fanout.append(max(arrivals))
+    elapsed = now() - started
+    queries = counter.count - queries_before
+
+    for socket in sockets:
+        await socket.disconnect()
+
+    return {
+        'connect': {
+            'elapsed_s': round(connect_elapsed, 4),
+            'queries_per_connect': round(connect_queries / len(people), 3),
+        },
+        'broadcast': {
+            'messages_sent': messages,
+            'deliveries': len(latencies),
+            'throughput_msg_per_s': round(messages / elapsed, 1),
+            'delivery_latency': latency_summary(latencies),
+            'fanout_latency': latency_summary(fanout),
+            'queries_per_message': round(queries / messages, 3),
+        },
+    }
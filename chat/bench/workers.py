@@ -0,0 +1,239 @@
+"""
+MULTI-WORKER THROUGHPUT BENCHMARK
+AUTHOR: DONALD PROGRAMMEUR
+
+Unlike the other scenarios, this one goes over real sockets: for each count
+of ``workers`` (e.g. "1,2,4") it starts ``manage.py runworkers`` on the
+benchmark database, the configured (Redis) channel layer and presence
+registry (CHAT_PRESENCE_REDIS_URL), and drives it from client processes.
+``users`` users chat in pairs on ws/private_chat/, each sending
+``messages`` messages without waiting for the previous ones. Reports the
+messages delivered per second for each count, and how that grows over the
+first count.
+"""
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection, connections
+
+from . import create_users, latency_summary
+
+
+# The workers must not throttle the load
+WORKER_ENVIRONMENT = {
+    'CHAT_RATE_LIMIT_CONNECTION_RATE': '1000000',
+    'CHAT_RATE_LIMIT_CONNECTION_BURST': '1000000',
+    'CHAT_RATE_LIMIT_USER_RATE': '1000000',
+    'CHAT_RATE_LIMIT_USER_BURST': '1000000',
+}
+
+
+def run(application, users=10, messages=20, workers='1,2', **options):
+    counts = [int(count) for count in str(workers).split(',')]
+    people = create_users(max(2, users - users % 2), prefix='workers')
+    peers = [(user.id, session_cookie(user)) for user in people]
+    pairs = [(peers[index], peers[index + 1]) for index in range(0, len(peers), 2)]
+    # The same client processes for every count, so that only the server side changes
+    clients = min(max(counts), os.cpu_count() or 1, len(pairs))
+    # The workers and the client processes open their own connections
+    connections.close_all()
+
+    runs = {}
+    for count in counts:
+        port = free_port()
+        server = start_server(count, port)
+        try:
+            runs[str(count)] = drive(port, pairs, messages, clients)
+        finally:
+            stop_server(server)
+    first = runs[str(counts[0])]['messages_per_s']
+    for result in runs.values():
+        result['speedup'] = round(result['messages_per_s'] / first, 2) if first else 0
+    return {
+        'runs': runs,
+        'scenario': 'workers',
+        'users': len(people),
+        'messages': messages,
+        'client_processes': clients,
+        'cores': os.cpu_count(),
+    }
+
+
+def session_cookie(user):
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers, port, timeout=60):
+    """
+    ``runworkers`` on the benchmark database, once all its workers listen.
+    """
+    environment = dict(os.environ, DATABASE_NAME=str(connection.settings_dict['NAME']), **WORKER_ENVIRONMENT)
+    read_fd, write_fd = os.pipe()
+    try:
+        server = subprocess.Popen(
+            [
+                sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'runworkers',
+                '--workers', str(workers), '--port', str(port), '--ready-fd', str(write_fd), '-v0',
+            ],
+            env=environment, pass_fds=[write_fd],
+        )
+    finally:
+        os.close(write_fd)
+    try:
+        ready, _, _ = select.select([read_fd], [], [], timeout)
+        if not ready or not os.read(read_fd, 1):
+            stop_server(server)
+            raise RuntimeError(f'runworkers --workers {workers} did not start')
+    finally:
+        os.close(read_fd)
+    return server
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(60)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def drive(port, pairs, messages, clients):
+    # Forked: the client processes only run asyncio and sockets, no Django
+    with multiprocessing.get_context('fork').Pool(clients) as pool:
+        results = pool.starmap(drive_pairs, [(port, pairs[index::clients], messages) for index in range(clients)])
+    started = min(result['started'] for result in results)
+    finished = max(result['finished'] for result in results)
+    delivered = sum(result['delivered'] for result in results)
+    latencies = [latency for result in results for latency in result['latencies']]
+    elapsed = finished - started
+    return {
+        'delivered': delivered,
+        'elapsed_s': round(elapsed, 4),
+        'messages_per_s': round(delivered / elapsed, 1) if elapsed else 0,
+        'latency': latency_summary(latencies),
+    }
+
+
+def drive_pairs(port, pairs, messages):
+    return asyncio.run(_drive_pairs(port, pairs, messages))
+
+
+async def _drive_pairs(port, pairs, messages):
+    sockets = []
+    for first, second in pairs:
+        for (user_id, cookie), (peer_id, _) in ((first, second), (second, first)):
+            sockets.append((user_id, await WebSocketClient.connect('127.0.0.1', port, f'/ws/private_chat/{peer_id}/', cookie)))
+    started = time.time()
+    latencies = []
+    await asyncio.gather(*[_chat(user_id, client, messages, latencies) for user_id, client in sockets])
+    finished = time.time()
+    for _, client in sockets:
+        await client.close()
+    return {
+        'started': started,
+        'finished': finished,
+        # Each message reaches both sockets of its pair
+        'delivered': len(sockets) * messages * 2,
+        'latencies': latencies,
+    }
+
+
+async def _chat(user_id, client, messages, latencies):
+    for index in range(messages):
+        await client.send_json({'message': repr(time.time()), 'client_id': f'{user_id}-{index}'})
+    received = 0
+    while received < messages * 2:
+        frame = await client.receive_json()
+        if 'message' not in frame or 'client_id' not in frame:
+            continue
+        received += 1
+        if not frame['client_id'].startswith(f'{user_id}-'):
+            latencies.append(time.time() - float(frame['message']))
+
+
+class WebSocketClient:
+    """
+    Minimal RFC 6455 client: unfragmented text frames, masked as clients must.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host, port, path, cookie):
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            f'GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\nCookie: {cookie}\r\n\r\n'
+        ).encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        if b' 101 ' not in response.split(b'\r\n', 1)[0]:
+            writer.close()
+            raise ConnectionError(f'{path} refused: {response.splitlines()[0].decode()}')
+        return cls(reader, writer)
+
+    def _write(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header.append(0x80 | length)
+        elif length < 65536:
+            header.append(0x80 | 126)
+            header += length.to_bytes(2, 'big')
+        else:
+            header.append(0x80 | 127)
+            header += length.to_bytes(8, 'big')
+        mask = os.urandom(4)
+        repeated = (mask * (length // 4 + 1))[:length]
+        masked = (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+        self.writer.write(bytes(header) + mask + masked)
+
+    async def send_json(self, data):
+        self._write(0x1, json.dumps(data).encode())
+        await self.writer.drain()
+
+    async def receive_json(self):
+        while True:
+            first, second = await self.reader.readexactly(2)
+            opcode, length = first & 0x0F, second & 0x7F
+            if length == 126:
+                length = int.from_bytes(await self.reader.readexactly(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(await self.reader.readexactly(8), 'big')
+            payload = await self.reader.readexactly(length)
+            if opcode == 0x1:
+                return json.loads(payload)
+            if opcode == 0x8:
+                raise ConnectionError(f'closed by the server ({int.from_bytes(payload[:2], "big")})')
+            if opcode == 0x9:
+                self._write(0xA, payload)
+
+    async def close(self):
+        self._write(0x8, (1000).to_bytes(2, 'big'))
+        await self.writer.drain()
+        self.writer.close()
@@ -0,0 +1,93 @@
+"""
+EVENT LOOP BLOCKING DETECTOR
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class BlockingMonitor:
+    """
+    Measures how long consumer handlers hold the event loop.
+
+    A handler runs in slices, from one ``await`` that actually suspends to
+    the next one. While a slice runs no other socket of the process is
+    served, so every slice longer than ``threshold_ms`` is logged with the
+    handler name and counted in ``stats()``. Time spent awaiting (the
+    database, the channel layer) is not counted. A threshold of 0 disables
+    the monitor and handlers run unwrapped.
+    """
+
+    def __init__(self, threshold_ms=None):
+        self.threshold_ms = settings.CHAT_LOOP_BLOCKING_THRESHOLD_MS if threshold_ms is None else threshold_ms
+        self._stats = {}  # handler -> [slow slices, longest slice in ms]
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.threshold_ms > 0
+
+    def watch(self, coroutine, name):
+        """
+        Awaitable running ``coroutine`` and timing each of its slices.
+        """
+        if not self.enabled:
+            return coroutine
+        return _Timed(self, coroutine, name)
+
+    def report(self, name, elapsed_ms):
+        with self._lock:
+            entry = self._stats.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] = max(entry[1], elapsed_ms)
+        logger.warning('%s blocked the event loop for %.1f ms', name, elapsed_ms)
+
+    def stats(self):
+        with self._lock:
+            return {name: {'count': count, 'max_ms': round(longest, 3)} for name, (count, longest) in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class _Timed:
+    # Drives the wrapped coroutine one slice at a time: each send() / throw()
+    # runs the coroutine until it suspends, which is exactly the time it holds
+    # the loop. What it yields (futures) is passed through to the task.
+
+    def __init__(self, monitor, coroutine, name):
+        self.monitor = monitor
+        self.coroutine = coroutine
+        self.name = name
+
+    def __await__(self):
+        coroutine = self.coroutine
+        threshold = self.monitor.threshold_ms
+        value, error = None, None
+        while True:
+            start = time.perf_counter()
+            try:
+                if error is None:
+                    yielded = coroutine.send(value)
+                else:
+                    yielded = coroutine.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                if elapsed_ms > threshold:
+                    self.monitor.report(self.name, elapsed_ms)
+            try:
+                value, error = (yield yielded), None
+            except BaseException as exc:
+                value, error = None, exc
+
+
+blocking_monitor = BlockingMonitor()
@@ -0,0 +1,50 @@
+"""
+RECONNECT CATCH-UP BY SEQUENCE NUMBER
+AUTHOR: DONALD PROGRAMMEUR
+"""
+from django.conf import settings
+
+from .history import HISTORY_FIELDS
+from .models import Message
+
+
+CATCH_UP_FIELDS = HISTORY_FIELDS + ('conversation_seq', 'inbox_seq')
+
+
+def _serialize(rows):
+    for row in rows:
+        row['timestamp'] = row['timestamp'].isoformat()
+    return rows
+
+
+def conversation_gap(profile_id, other_profile_id, after, limit):
+    """
+    Up to ``limit`` messages of the conversation numbered after ``after``,
+    in order. One range scan per direction on the sequence index, merged here.
+    """
+    rows = []
+    for sender_id, receiver_id in ((profile_id, other_profile_id), (other_profile_id, profile_id)):
+        rows.extend(
+            Message.objects.filter(sender_id=sender_id, receiver_id=receiver_id, conversation_seq__gt=after)
+            .order_by('conversation_seq').values(*CATCH_UP_FIELDS)[:limit]
+        )
+        if sender_id == receiver_id:
+            break
+    rows.sort(key=lambda row: row['conversation_seq'])
+    return _serialize(rows[:limit])
+
+
+def inbox_gap(profile_id, after, limit):
+    """
+    Up to ``limit`` messages received by ``profile_id`` numbered after ``after``, in order.
+    """
+    return _serialize(list(
+        Message.objects.filter(receiver_id=profile_id, inbox_seq__gt=after)
+        .order_by('inbox_seq').values(*CATCH_UP_FIELDS)[:limit]
+    ))
+
+
+def get_chunk_size(limit=None):
+    if not limit:
+        return settings.CHAT_CATCH_UP_CHUNK_SIZE
+    return max(1, min(int(limit), settings.CHAT_CATCH_UP_CHUNK_SIZE))
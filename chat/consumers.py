@@ -2,32 +2,63 @@
 LIST OF CONSUMERS
 AUTHOR: DONALD PROGRAMMEUR
 """
-import json
-from datetime import timezone, timedelta
+import uuid
+from functools import partial
 
-from channels.db import database_sync_to_async
-from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth import get_user_model
-from .models import Profile, Message
+from django.db.models import F
+from account.last_online import last_online_writer
+from .models import Profile, Message, RoomMessage
+from .groups import private_room_name, room_group_name, user_inbox_group
+from .attachments import sendable_attachment
+from .catchup import conversation_gap, get_chunk_size, inbox_gap
+from .db import run_sync
+from .ephemeral import delivery_acks, typing_events
+from .history import InvalidCursor, get_conversation_page
+from .identity import avatar_url, identities
+from .metrics import handler_scope, messages_sent, registry
+from .persistence import message_queue
+from .presence import USER_LIST_GROUP, presence, presence_event, start_reaper
+from .outbound import COALESCE, DROPPABLE
+from .protocol import ProtocolConsumer, group_event
+from .routers import read_from_replica
+from .rooms import get_room_page, memberships, room_gap
+from .search import InvalidSearch, search_messages
 
 
 User = get_user_model()
 
+# Close code sent to a member removed from a room they are connected to
+REMOVED_FROM_ROOM_CLOSE_CODE = 4003
+
+
+class PrivateChatConsumer(ProtocolConsumer):
+    # Frames of each connection and of all the user's connections are limited
+    rate_limited = True
 
-class PrivateChatConsumer(AsyncWebsocketConsumer):
     # When a client connects to the WebSocket, set up the necessary variables
     def __init__(self, *args, **kwargs):
-        super().__init__(args, kwargs)
+        super().__init__(*args, **kwargs)
         self.room_name = None
         self.other_user = None
         self.other_user_id = None
         self.user = None
+        self.profile = None
+        self.acked_up_to = 0
 
     async def connect(self):
         self.user = self.scope["user"]  # Get the current user
+        if not self.user.is_authenticated:
+            await self.close()
+            return
         self.other_user_id = self.scope['url_route']['kwargs']['user_id']  # Get the ID of the other user
-        self.other_user = await self.get_other_user(self.other_user_id)  # Get the Profile object of the other user
-        self.room_name = f'private_chat_{self.user.id}_{self.other_user_id}'  # Create a unique room name for the chat
+        # Identities (ids, username, avatar) of both participants, resolved once for the connection
+        self.other_user = await self.get_other_user(self.other_user_id)
+        self.profile = await self.get_other_user(self.user.id)
+        if self.profile is None or self.other_user is None:
+            await self.close()
+            return
+        self.room_name = private_room_name(self.user.id, self.other_user_id)  # Same room for both participants
 
         # Add the consumer to the channel layer group for the room
         await self.channel_layer.group_add(
@@ -40,138 +71,500 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
 
     # When the WebSocket connection is closed, remove the consumer from the channel layer group
     async def disconnect(self, close_code):
+        # Make sure nothing sent on this connection is still waiting to be written
+        await message_queue.flush()
+        if self.room_name is None:
+            return
+        typing_events.forget((self.room_name, self.user.id))
+        # The last delivery ack still reaches the other participant
+        await delivery_acks.close((self.room_name, self.user.id))
         await self.channel_layer.group_discard(
             self.room_name,
             self.channel_name
         )
 
-    # When the consumer receives a message from the WebSocket, create a new message object and send it to the room group
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']  # Extract the message text from the JSON data
+    # Create a new message and send it to the room group. A message can carry
+    # an attachment uploaded beforehand: {'message': ..., 'attachment_id': id}
+    async def on_message(self, data):
+        # Extract the message text from the frame (optional with an attachment)
+        message = data.get('message')
+        if message is None and data.get('attachment_id') is not None:
+            message = ''
+        if not isinstance(message, str):
+            await self.send_payload({'error': 'invalid message'})
+            return
+        attachment = None
+        if data.get('attachment_id') is not None:
+            attachment_id = integer_field(data, 'attachment_id')
+            if attachment_id is None:
+                await self.send_payload({'error': 'invalid attachment_id'})
+                return
+            attachment = await run_sync(
+                sendable_attachment, self.profile.profile_id, attachment_id, self.other_user.profile_id
+            )
+            if attachment is None:
+                await self.send_payload({'error': 'unknown attachment'})
+                return
+        if registry.enabled:
+            messages_sent.inc()
+        # Lets the client match the message with the id it gets once it is written
+        client_id = str(data.get('client_id') or uuid.uuid4().hex)
+
+        # Queue the message, it is written to the database in the next batch
+        new_message = await self.create_message(message, client_id, attachment)
 
-        # Create a new message object and save it to the database
-        await self.create_message(message)
+        # Sending a message ends the typing indicator, right away
+        typing_events.forget((self.room_name, self.user.id))
 
-        # Send the message to the room group
+        # Send the message to the room group, encoded once for all its sockets
         await self.channel_layer.group_send(
             self.room_name,
-            {
-                'type': 'chat_message',
+            group_event('chat_message', {
                 'message': message,
-                'username': self.user.username
-            }
+                'username': self.user.username,
+                'client_id': client_id,
+                'attachment': attachment.metadata() if attachment else None,
+            })
+        )
+
+        # And to every open socket of the receiver, in whatever page they are
+        await self.channel_layer.group_send(
+            user_inbox_group(self.other_user.user_id),
+            new_message.notification(sender=self.profile)
+        )
+
+    async def on_history(self, data):
+        await self.send_history(data.get('cursor'), data.get('limit'), bool(data.get('archive')))
+
+    # {'type': 'read', 'up_to': id}
+    async def on_read(self, data):
+        up_to = integer_field(data, 'up_to')
+        if up_to is None:
+            await self.send_payload({'error': 'invalid up_to'})
+            return
+        await self.read_up_to(up_to)
+
+    async def on_search(self, data):
+        await self.send_payload(await search(self.profile.profile_id, data, self.other_user.profile_id))
+
+    # {'type': 'catch_up', 'after': last seq seen}: what was missed while disconnected
+    async def on_catch_up(self, data):
+        gap = partial(conversation_gap, self.profile.profile_id, self.other_user.profile_id)
+        await send_catch_up(self, gap, data, 'conversation_seq')
+
+    # Ephemeral events: only sent through the channel layer, never written,
+    # and coalesced to one per interval and user (see ephemeral.py)
+
+    # {'type': 'typing', 'state': 'start' | 'stop'}
+    async def on_typing(self, data):
+        state = 'stop' if data.get('state') == 'stop' else 'start'
+        await typing_events.submit(
+            (self.room_name, self.user.id),
+            group_event('chat_typing', {'typing': {'user_id': self.user.id, 'state': state}}, user_id=self.user.id),
+            self.send_to_room,
+            urgent=state == 'stop',
         )
 
+    # {'type': 'ack', 'up_to': id}: the messages up to this id reached the client
+    async def on_ack(self, data):
+        up_to = integer_field(data, 'up_to')
+        if up_to is None:
+            await self.send_payload({'error': 'invalid up_to'})
+            return
+        if up_to <= self.acked_up_to:
+            return
+        self.acked_up_to = up_to
+        await delivery_acks.submit(
+            (self.room_name, self.user.id),
+            group_event('chat_delivered', {'delivered': {'user_id': self.user.id, 'up_to': up_to}}, user_id=self.user.id),
+            self.send_to_room,
+        )
+
+    # {'type': 'ping'}: the user is still there, answered with a pong
+    async def on_ping(self, data):
+        if await presence.heartbeat(self.user.id):
+            await self.channel_layer.group_send(USER_LIST_GROUP, presence_event(self.user.id, True))
+        last_online_writer.touch(self.user.id)
+        await self.send_payload({'pong': data.get('id')}, COALESCE, 'pong')
+
+    client_events = {
+        'message': on_message,
+        'history': on_history,
+        'read': on_read,
+        'search': on_search,
+        'catch_up': on_catch_up,
+        'typing': on_typing,
+        'ack': on_ack,
+        'ping': on_ping,
+    }
+
+    async def send_to_room(self, event):
+        await self.channel_layer.group_send(self.room_name, event)
+
     # When a message is received by the channel layer group, send it back to the WebSocket
     async def chat_message(self, event):
-        message = event['message']  # Extract the message text from the event data
-        username = event['username']  # Extract the username from the event data
+        # The message, username and client_id, already encoded by the sender
+        await self.send_frame(event['frame'])
 
-        # Send the message and username back to the WebSocket as JSON data
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'username': username
-        }))
+    # Messages of the room were written: give the clients their ids
+    async def chat_persisted(self, event):
+        await self.send_frame(event['frame'])
 
-    # Get the Profile object for the other user in the chat
-    async def get_other_user(self, user_id):
+    # Typing indicators and delivery acks of the other participant; a slow
+    # client only gets the latest of each
+    async def chat_typing(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send_frame(event['frame'], COALESCE, 'typing')
+
+    async def chat_delivered(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send_frame(event['frame'], COALESCE, 'delivered')
+
+    # Mark every message received from the other user up to ``up_to`` (an id) as read
+    async def read_up_to(self, up_to):
+        # Messages still waiting in the write-behind queue may be among them
+        await message_queue.flush()
+        read = await run_sync(
+            Message.objects.mark_read_up_to,
+            self.profile.profile_id, self.other_user.profile_id, up_to
+        )
+        if not read:
+            return
+        # One watermark for the whole range instead of one receipt per message
+        await self.channel_layer.group_send(
+            user_inbox_group(self.other_user.user_id),
+            group_event('chat.read_watermark', {
+                'read_watermark': {'reader_id': self.user.id, 'up_to': up_to},
+            })
+        )
+
+    # Send one page of the conversation history back to the WebSocket
+    async def send_history(self, cursor=None, limit=None, archive=False):
+        # Messages still waiting in the write-behind queue belong to the history too
+        await message_queue.flush()
         try:
-            other_user = Profile.objects.get(user__id=user_id)
-            return other_user
-        except Profile.DoesNotExist:
-            return None
+            page = await run_sync(
+                get_conversation_page,
+                self.profile.profile_id, self.other_user.profile_id, cursor=cursor, limit=limit, archive=archive
+            )
+        except (InvalidCursor, ValueError):
+            await self.send_payload({'error': 'invalid cursor or limit'})
+            return
+        await self.send_payload({'history': page})
 
-    # Create a new message object and save it to the database
-    async def create_message(self, message_content):
-        message = Message.objects.create(
-            sender=self.user.profile,
+    # Get the identity of a user of the chat, from the shared cache when possible
+    async def get_other_user(self, user_id):
+        return await identities.aresolve(int(user_id))
+
+    # Hand the new message to the write-behind queue (see persistence.py)
+    async def create_message(self, message_content, client_id=None, attachment=None):
+        return await message_queue.put(
+            sender=self.profile,
             receiver=self.other_user,
-            content=message_content
+            content=message_content,
+            client_id=client_id,
+            attachment=attachment,
         )
-        message.save()
 
 
-class UserListStatusConsumer(AsyncWebsocketConsumer):
+class InboxConsumer(ProtocolConsumer):
+    """
+    Personal channel of a user. Every tab and device of the user opens one on
+    ws/inbox/ and joins the user's inbox group, so new messages, read receipts
+    and last online updates reach each of them once, as they are sent (the
+    events already carry their encoded frame, no database access here).
+    The client can also send 'search' commands to search all its messages,
+    and 'catch_up' commands to get the messages received while it was away.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        self.inbox_group = user_inbox_group(self.user.id)
+        await self.channel_layer.group_add(self.inbox_group, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if self.user.is_authenticated:
+            await self.channel_layer.group_discard(self.inbox_group, self.channel_name)
+
+    async def receive_payload(self, payload):
+        # Only search and catch-up commands are expected from the client on this socket
+        if payload.get('command') not in ('search', 'catch_up'):
+            return
+        identity = await identities.aresolve(self.user.id)
+        if identity is None:
+            return
+        if payload['command'] == 'search':
+            await self.send_payload(await search(identity.profile_id, payload))
+        else:
+            # {'command': 'catch_up', 'after': last inbox_seq seen}
+            await send_catch_up(self, partial(inbox_gap, identity.profile_id), payload, 'inbox_seq')
+
+    async def user_new_message(self, event):
+        await self.send_frame(event['frame'])
+
+    # Sequence numbers of the messages received, once written
+    async def chat_inbox_persisted(self, event):
+        await self.send_frame(event['frame'])
+
+    # New messages are never dropped for a slow client, receipts and
+    # last online updates may be (see outbound.py)
+    async def chat_message_read(self, event):
+        await self.send_frame(event['frame'], DROPPABLE)
+
+    async def chat_read_watermark(self, event):
+        await self.send_frame(event['frame'], DROPPABLE)
+
+    async def user_last_online(self, event):
+        await self.send_frame(event['frame'], COALESCE, 'last_online')
+
+
+class RoomConsumer(ProtocolConsumer):
+    """
+    Socket of a member in a group room, ws/room/<room_id>/. Every socket of
+    every member joins the room group: a message is written once and fanned
+    out with a single group_send, already encoded. Membership is checked
+    against the in-memory membership cache (see rooms.py), on connect and
+    again for each message delivered: a member removed from the room is
+    closed on the next one.
+    """
+
+    rate_limited = True
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.room_id = int(self.scope['url_route']['kwargs']['room_id'])
+        self.profile = await identities.aresolve(self.user.id) if self.user.is_authenticated else None
+        if self.profile is None or not await memberships.ais_member(self.room_id, self.user.id):
+            await self.close()
+            return
+        self.room_group = room_group_name(self.room_id)
+        await self.channel_layer.group_add(self.room_group, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if getattr(self, 'room_group', None) is not None:
+            await self.channel_layer.group_discard(self.room_group, self.channel_name)
+
+    # Same typed events as the private chat: message, history, catch_up
+    async def on_message(self, data):
+        message = data.get('message')
+        if not isinstance(message, str):
+            await self.send_payload({'error': 'invalid message'})
+            return
+        # Members removed since they connected can not post anymore
+        if not await memberships.ais_member(self.room_id, self.user.id):
+            await self.send_payload({'error': 'not a member of this room'})
+            return
+        if registry.enabled:
+            messages_sent.inc()
+        message = await run_sync(RoomMessage.objects.create_message, self.room_id, self.profile.profile_id, message)
+        await self.channel_layer.group_send(self.room_group, group_event('room_message', {
+            'room_message': {
+                'id': message.id,
+                'room_id': self.room_id,
+                'seq': message.seq,
+                'user_id': self.user.id,
+                'username': self.profile.username,
+                'avatar': self.profile.avatar_url,
+                'message': message.content,
+                'client_id': data.get('client_id'),
+                'timestamp': message.timestamp.isoformat(),
+            },
+        }))
+
+    # {'type': 'history', 'before': seq}: older messages, newest first
+    async def on_history(self, data):
+        try:
+            page = await run_sync(get_room_page, self.room_id, data.get('before'), data.get('limit'))
+        except (TypeError, ValueError):
+            await self.send_payload({'error': 'invalid before or limit'})
+            return
+        await self.send_payload({'history': page})
+
+    # {'type': 'catch_up', 'after': last seq seen}
+    async def on_catch_up(self, data):
+        await send_catch_up(self, partial(room_gap, self.room_id), data, 'seq')
+
+    client_events = {
+        'message': on_message,
+        'history': on_history,
+        'catch_up': on_catch_up,
+    }
+
+    async def room_message(self, event):
+        # Removed since they connected: out of the group, the message is not theirs
+        if not await memberships.ais_member(self.room_id, self.user.id):
+            await self.channel_layer.group_discard(self.room_group, self.channel_name)
+            self.room_group = None
+            await self.close(code=REMOVED_FROM_ROOM_CLOSE_CODE)
+            return
+        await self.send_frame(event['frame'])
+
+
+class UserListStatusConsumer(ProtocolConsumer):
+    """
+    Sends the user list once on connect, then only the presence changes
+    ("user X is online/offline") as they happen. Who is online is tracked by
+    the presence registry (see presence.py), not in the database.
+    """
+
     async def connect(self):
-        await self.channel_layer.group_add('user_list', self.channel_name)
+        await self.channel_layer.group_add(USER_LIST_GROUP, self.channel_name)
         await self.accept()
+        start_reaper(self.channel_layer)
+
+        user = self.scope["user"]
+        if user.is_authenticated:
+            if await presence.connect(user.id):
+                await self.broadcast_status(user.id, True)
+            self.update_user_status(user.id, True)
+
+        # Initial snapshot, the deltas follow
+        user_list = await self.get_sorted_user_list()
+        await self.send_user_list(user_list)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard('user_list', self.channel_name)
+        await self.channel_layer.group_discard(USER_LIST_GROUP, self.channel_name)
+        user = self.scope["user"]
+        if user.is_authenticated:
+            if await presence.disconnect(user.id):
+                await self.broadcast_status(user.id, False)
+            self.update_user_status(user.id, False)
 
-    async def receive(self, text_data):
+    async def receive_payload(self, data):
         # Receive message from WebSocket
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
+        message = data['message']
 
         # Add new user to the list when they create an account
         if message == 'user_created':
-            new_user = text_data_json['user']
+            new_user = data['user']
             user_data = await self.get_user_data(new_user)
-            user_data['status'] = 'online'
+            if user_data is None:
+                return
+            user_data['is_online'] = await presence.is_online(user_data['user_id'])
             await self.channel_layer.group_send(
-                "user_list",
-                {
-                    "type": "user_list_update",
-                    "users": [user_data],
-                }
+                USER_LIST_GROUP,
+                group_event("user_created", {'user_list_update': [user_data]})
             )
         else:
-            # Update user status and send updated user list
+            # Any other message is a heartbeat: only a transition is broadcast
             user = self.scope["user"]
             if user.is_authenticated:
-                await database_sync_to_async(self.update_user_status)(user.id, True)
-            await self.send_user_list()
+                if await presence.heartbeat(user.id):
+                    await self.broadcast_status(user.id, True)
+                self.update_user_status(user.id, True)
 
+    async def broadcast_status(self, user_id, online):
+        await self.channel_layer.group_send(USER_LIST_GROUP, presence_event(user_id, online))
+
+    # A slow client only gets the latest status of each user
     async def user_online(self, event):
-        user_id = event['user_id']
-        await self.update_user_status(user_id, True)
-        user_list = await self.get_sorted_user_list()
-        await self.send_user_list(user_list)
+        await self.send_frame(event['frame'], COALESCE, f"presence:{event['user_id']}")
 
     async def user_offline(self, event):
-        user_id = event['user_id']
-        await self.update_user_status(user_id, False)
-        user_list = await self.get_sorted_user_list()
-        await self.send_user_list(user_list)
+        await self.send_frame(event['frame'], COALESCE, f"presence:{event['user_id']}")
 
     async def user_created(self, event):
-        user_list = await self.get_sorted_user_list()
-        await self.send_user_list(user_list)
+        await self.send_frame(event['frame'], DROPPABLE)
 
-    @database_sync_to_async
     def update_user_status(self, user_id, status):
-        user = Profile.objects.get(pk=user_id)
-        user.last_online = timezone.now() if status else None
-        user.save()
-
-    @database_sync_to_async
-    def get_sorted_user_list(self):
-        profiles = Profile.objects.all()
-        sorted_profiles = sorted(profiles, key=lambda p: p.last_online, reverse=True)
-        user_list = []
-        for profile in sorted_profiles:
-            user_dict = {
-                'id': profile.id,
-                'username': profile.user.username,
-                'avatar': profile.avatar,
-                'is_online': profile.last_online and (timezone.now() - profile.last_online) < timedelta(minutes=5),
-                'last_seen': profile.last_seen.strftime('%b %d %Y %I:%M %p') if profile.last_seen else '',
-            }
-            user_list.append(user_dict)
-        return user_list
-
-    @database_sync_to_async
-    def get_user_data(self, user_id):
-        user = get_user_model().objects.get(id=user_id)
-        return {
-            'id': user.id,
-            'username': user.username,
-            'avatar': user.profile.avatar,
-            'status': user.last_seen,
-            'last_login': str(user.last_login) if user.last_login else None
-        }
+        # last_online is the last time the user used the chat, online or not.
+        # It is only recorded in memory here and written in bulk later.
+        last_online_writer.touch(user_id)
+
+    async def get_sorted_user_list(self):
+        profiles = Profile.objects.select_related('user', 'avatar').order_by(
+            F('last_online').desc(nulls_last=True)
+        )
+        online_users = await presence.online_users()
+        with handler_scope(type(self).__name__, 'get_sorted_user_list'), read_from_replica():
+            return [serialize_profile(profile, profile.user_id in online_users) async for profile in profiles]
+
+    async def get_user_data(self, user_id):
+        try:
+            profile = await Profile.objects.select_related('user', 'avatar').aget(user_id=user_id)
+        except Profile.DoesNotExist:
+            return None
+        return serialize_profile(profile, False)
 
     async def send_user_list(self, user_list):
-        await self.send(text_data=json.dumps({'user_list': user_list}))
+        await self.send_payload({'user_list': user_list})
+
+
+def integer_field(data, name):
+    """
+    data[name] as an integer, None when it is missing or not a number.
+    """
+    try:
+        return int(data[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def serialize_profile(profile, is_online):
+    """
+    Entry of the user list sent to the clients.
+    """
+    return {
+        'id': profile.id,
+        'user_id': profile.user_id,
+        'username': profile.user.username,
+        'avatar': avatar_url(profile),
+        'is_online': is_online,
+        'last_seen': profile.last_seen(),
+    }
+
+
+async def search(profile_id, data, other_profile_id=None):
+    """
+    Reply to a 'search' command: {'command': 'search', 'q': ..., 'order': ...,
+    'page': ..., 'limit': ...}, in all the messages of the user or in one
+    conversation.
+    """
+    try:
+        results = await run_sync(
+            search_messages,
+            profile_id,
+            data.get('q'),
+            other_profile_id=other_profile_id,
+            order=data.get('order', 'relevance'),
+            page=data.get('page', 1),
+            limit=data.get('limit'),
+        )
+    except (InvalidSearch, ValueError):
+        return {'error': 'invalid query, order, page or limit'}
+    return {'search': results}
+
+
+async def send_catch_up(consumer, gap, data, seq_field):
+    """
+    Stream the messages numbered after data['after'] to the client, in
+    chunks of at most data['limit'] messages: {'catch_up': {'messages': [...],
+    'last_seq': ..., 'done': ...}}. The next chunk is only read once the
+    previous one is written, so a long gap never piles up in memory, and
+    none is read once the client is gone.
+    """
+    try:
+        after = int(data.get('after') or 0)
+        limit = get_chunk_size(data.get('limit'))
+    except (TypeError, ValueError):
+        await consumer.send_payload({'error': 'invalid after or limit'})
+        return
+    # Messages still waiting in the write-behind queue are part of the gap
+    await message_queue.flush()
+    while True:
+        rows = await run_sync(gap, after, limit + 1)
+        done = len(rows) <= limit
+        rows = rows[:limit]
+        if rows:
+            after = rows[-1][seq_field]
+        await consumer.send_payload({'catch_up': {'messages': rows, 'last_seq': after, 'done': done}})
+        if done:
+            return
+        await consumer.outbound.drain()
+        if consumer.outbound.closed:
+            return
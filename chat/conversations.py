@@ -0,0 +1,56 @@
+"""
+CONVERSATION LIST (KEYSET PAGINATION)
+AUTHOR: DONALD PROGRAMMEUR
+"""
+from django.db.models import OuterRef, Q, Subquery
+
+from account.avatars import avatar_url
+from .history import decode_cursor, encode_cursor, get_page_size
+from .models import Conversation, UnreadCounter
+
+
+def get_conversation_list(profile_id, cursor=None, limit=None):
+    """
+    Returns one page of the conversations of a profile, the most recently
+    active first, and the cursor of the next page.
+
+    Each row is read from the profile's Conversation summaries (updated with
+    every message) with a range scan on the (owner, last_message_at) index;
+    the unread count comes from the matching counter, one indexed lookup per
+    row of the page. The cost of a page only depends on its size, not on the
+    number of messages.
+    """
+    limit = get_page_size(limit)
+    queryset = Conversation.objects.filter(owner_id=profile_id)
+    if cursor:
+        timestamp, conversation_id = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(last_message_at__lt=timestamp) | Q(last_message_at=timestamp, id__lt=conversation_id)
+        )
+    unread = UnreadCounter.objects.filter(receiver_id=OuterRef('owner_id'), sender_id=OuterRef('other_id'))
+    rows = list(
+        queryset.select_related('other__user', 'other__avatar')
+        .annotate(unread=Subquery(unread.values('count')[:1]))
+        .order_by('-last_message_at', '-id')[:limit + 1]
+    )
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(page[-1].last_message_at, page[-1].id)
+
+    return {
+        'conversations': [
+            {
+                'user_id': conversation.other.user_id,
+                'username': conversation.other.user.username,
+                'avatar': avatar_url(conversation.other),
+                'last_message_id': conversation.last_message_id,
+                'last_message': conversation.snippet,
+                'last_message_at': conversation.last_message_at.isoformat(),
+                'sent_by_me': conversation.last_sender_id == profile_id,
+                'unread': conversation.unread or 0,
+            }
+            for conversation in page
+        ],
+        'next_cursor': next_cursor,
+    }
@@ -0,0 +1,26 @@
+"""
+ASYNC DATA ACCESS
+AUTHOR: DONALD PROGRAMMEUR
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+
+# Threads for the database work that has no async ORM equivalent
+# (transactions, bulk writes, multi-query reads). Bounded, so a burst of
+# such work queues up here instead of starving the default executor.
+sync_pool = ThreadPoolExecutor(max_workers=settings.CHAT_SYNC_WORKERS, thread_name_prefix='chat-sync')
+
+
+def run_sync(func, *args, **kwargs):
+    """
+    Run the synchronous ``func`` in the chat thread pool and return an
+    awaitable of its result. Database connections are closed around the
+    call like database_sync_to_async does.
+
+    Plain reads and single-statement writes should use the async ORM API
+    (aget, acreate, aupdate, ``async for``) instead.
+    """
+    return database_sync_to_async(func, thread_sensitive=False, executor=sync_pool)(*args, **kwargs)
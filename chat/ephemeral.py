@@ -0,0 +1,78 @@
+"""
+EPHEMERAL EVENTS (TYPING, DELIVERY ACKS)
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import asyncio
+import time
+
+from django.conf import settings
+
+
+class EphemeralCoalescer:
+    """
+    Forwards at most one event per ``interval`` seconds and key (e.g. one
+    typing event per user and conversation). Events arriving in between
+    replace each other and only the last one is sent, when the interval
+    ends. An ``urgent`` event (typing stopped) is sent at once and replaces
+    the pending one.
+
+    Nothing here is persisted: the events only go through the channel layer.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._last_sent = {}  # key -> time of the last send
+        self._pending = {}  # key -> (send, event) waiting for the end of the interval
+        self._timers = {}  # key -> timer handle
+
+    def __len__(self):
+        return len(self._last_sent)
+
+    async def submit(self, key, event, send, urgent=False):
+        now = time.monotonic()
+        wait = self._last_sent.get(key, -self.interval) + self.interval - now
+        if urgent or wait <= 0:
+            self._cancel(key)
+            self._last_sent[key] = now
+            await send(event)
+            return
+        self._pending[key] = (send, event)
+        if key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(wait, self._flush, key)
+
+    def _flush(self, key):
+        self._timers.pop(key, None)
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        send, event = pending
+        self._last_sent[key] = time.monotonic()
+        asyncio.get_running_loop().create_task(send(event))
+
+    def _cancel(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self._pending.pop(key, None)
+
+    def forget(self, key):
+        """
+        Drop the state of a key (its sender disconnected).
+        """
+        self._cancel(key)
+        self._last_sent.pop(key, None)
+
+    async def close(self, key):
+        """
+        Send the pending event of a key at once, then drop its state (its
+        sender disconnected, the last event still counts).
+        """
+        pending = self._pending.get(key)
+        self.forget(key)
+        if pending is not None:
+            send, event = pending
+            await send(event)
+
+
+typing_events = EphemeralCoalescer(settings.CHAT_TYPING_INTERVAL)
+delivery_acks = EphemeralCoalescer(settings.CHAT_ACK_INTERVAL)
@@ -0,0 +1,31 @@
+"""
+CHANNEL LAYER GROUP NAMES
+AUTHOR: DONALD PROGRAMMEUR
+"""
+
+
+def private_room_name(user_id, other_user_id):
+    """
+    Group of the private conversation between two users. The name does not
+    depend on who opened the conversation, so both participants join the
+    same group.
+    """
+    low, high = sorted((int(user_id), int(other_user_id)))
+    return f'private_chat_{low}_{high}'
+
+
+def user_inbox_group(user_id):
+    """
+    Group joined by every open socket of a user (all tabs and devices). New
+    messages, read receipts and last online updates for the user are sent
+    there, once.
+    """
+    return f'inbox_{user_id}'
+
+
+def room_group_name(room_id):
+    """
+    Group joined by every open socket of the members of a room: a message is
+    fanned out to all of them with a single group_send.
+    """
+    return f'room_{room_id}'
@@ -0,0 +1,105 @@
+"""
+CONVERSATION HISTORY (KEYSET PAGINATION)
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import base64
+import binascii
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .models import Message
+from .routers import read_from_replica
+
+
+HISTORY_FIELDS = ('id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'is_read', 'attachment_id')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp, message_id):
+    """
+    Opaque cursor pointing just before the given (timestamp, id) position.
+    """
+    raw = f'{timestamp.isoformat()}|{message_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    if not isinstance(cursor, str):
+        raise InvalidCursor(cursor)
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, message_id = raw.split('|')
+        timestamp = parse_datetime(timestamp)
+        message_id = int(message_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if timestamp is None:
+        raise InvalidCursor(cursor)
+    return timestamp, message_id
+
+
+def get_page_size(limit=None):
+    if not limit:
+        return settings.CHAT_HISTORY_PAGE_SIZE
+    try:
+        limit = int(limit)
+    except TypeError:
+        # A list or an object sent by a client: as invalid as 'abc'
+        raise ValueError(f'invalid limit {limit!r}')
+    return max(1, min(limit, settings.CHAT_HISTORY_MAX_PAGE_SIZE))
+
+
+def get_conversation_page(profile_id, other_profile_id, cursor=None, limit=None, archive=False):
+    """
+    Returns one page of the conversation between two profiles (both
+    directions), newest first, and the cursor of the next (older) page.
+
+    Each direction is read with its own query so that both are a range scan
+    on the (sender, receiver, timestamp) index; the two sorted slices are then
+    merged here. The cost of a page only depends on its size, not on how far
+    back in the conversation it is.
+
+    With ``archive``, a page that goes past the oldest message still in the
+    database continues with the archived messages (see archive.py).
+
+    Read from a replica when there are some: a message may show up in the
+    history a little after it was delivered on the socket.
+    """
+    limit = get_page_size(limit)
+    before = decode_cursor(cursor) if cursor else None
+
+    rows = []
+    with read_from_replica():
+        for sender_id, receiver_id in ((profile_id, other_profile_id), (other_profile_id, profile_id)):
+            queryset = Message.objects.filter(sender_id=sender_id, receiver_id=receiver_id)
+            if before is not None:
+                timestamp, message_id = before
+                queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+            rows.extend(queryset.order_by('-timestamp', '-id').values(*HISTORY_FIELDS)[:limit + 1])
+            if sender_id == receiver_id:
+                # Conversation with oneself: both directions are the same rows
+                break
+
+    if archive and len(rows) <= limit:
+        # The database has no more than this page: complete it from the archive
+        from .archive import read_archived_page
+        rows.extend(read_archived_page(profile_id, other_profile_id, before=before, limit=limit + 1))
+        rows = list({row['id']: row for row in rows}.values())
+
+    rows.sort(key=lambda row: (row['timestamp'], row['id']), reverse=True)
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(page[-1]['timestamp'], page[-1]['id'])
+
+    for row in page:
+        row['timestamp'] = row['timestamp'].isoformat()
+    return {
+        'messages': page,
+        'next_cursor': next_cursor,
+    }
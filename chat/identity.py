@@ -0,0 +1,98 @@
+"""
+IDENTITY CACHE
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from account.avatars import avatar_url
+from account.models import Profile
+
+
+# What the consumers need to know about a user to send or route a message
+Identity = namedtuple('Identity', ['user_id', 'profile_id', 'username', 'avatar_url'])
+
+
+class IdentityCache:
+    """
+    Small LRU of identities shared by all the consumers of the process,
+    reachable by user id or by profile id. An identity is loaded with one
+    select_related query the first time it is needed, then served from
+    memory until the profile, the user or the avatar URLs change (see signals.py).
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or settings.CHAT_IDENTITY_CACHE_SIZE
+        self._by_user = OrderedDict()
+        self._user_of_profile = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_user)
+
+    def get(self, user_id):
+        with self._lock:
+            identity = self._by_user.get(user_id)
+            if identity is not None:
+                self._by_user.move_to_end(user_id)
+            return identity
+
+    def get_by_profile(self, profile_id):
+        user_id = self._user_of_profile.get(profile_id)
+        return None if user_id is None else self.get(user_id)
+
+    def add(self, identity):
+        with self._lock:
+            self._by_user[identity.user_id] = identity
+            self._by_user.move_to_end(identity.user_id)
+            self._user_of_profile[identity.profile_id] = identity.user_id
+            while len(self._by_user) > self.max_size:
+                _, evicted = self._by_user.popitem(last=False)
+                self._user_of_profile.pop(evicted.profile_id, None)
+        return identity
+
+    def invalidate(self, user_id):
+        with self._lock:
+            identity = self._by_user.pop(user_id, None)
+            if identity is not None:
+                self._user_of_profile.pop(identity.profile_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._by_user.clear()
+            self._user_of_profile.clear()
+
+    def _load(self, **lookup):
+        try:
+            profile = Profile.objects.select_related('user', 'avatar').get(**lookup)
+        except Profile.DoesNotExist:
+            return None
+        return self._add_profile(profile)
+
+    def _add_profile(self, profile):
+        return self.add(Identity(profile.user_id, profile.id, profile.user.username, avatar_url(profile)))
+
+    def resolve(self, user_id):
+        """
+        Identity of a user, None when the user has no profile.
+        """
+        return self.get(user_id) or self._load(user_id=user_id)
+
+    def resolve_profile(self, profile_id):
+        return self.get_by_profile(profile_id) or self._load(pk=profile_id)
+
+    async def aresolve(self, user_id):
+        # A cache hit does not need to leave the event loop
+        identity = self.get(user_id)
+        if identity is not None:
+            return identity
+        try:
+            profile = await Profile.objects.select_related('user', 'avatar').aget(user_id=user_id)
+        except Profile.DoesNotExist:
+            return None
+        return self._add_profile(profile)
+
+
+identities = IdentityCache()
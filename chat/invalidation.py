@@ -0,0 +1,97 @@
+"""
+CACHE INVALIDATION ACROSS PROCESSES
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import asyncio
+import logging
+import uuid
+from functools import partial
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.db import transaction
+
+from account.avatars import forget_avatar_urls
+from .identity import identities
+from .rooms import memberships
+
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_GROUP = 'cache_invalidation'
+
+# Tells the invalidations sent by this process from the others'
+PROCESS_ID = uuid.uuid4().hex
+
+
+def _invalidate_room(room_id):
+    if room_id is None:
+        memberships.clear()
+    else:
+        memberships.invalidate(room_id)
+
+
+def _invalidate_avatar(user_id):
+    # The identity of the user carries an avatar URL too
+    forget_avatar_urls(user_id)
+    identities.invalidate(user_id)
+
+
+# Caches kept in memory by each process: name -> invalidate(key)
+CACHES = {
+    'identity': identities.invalidate,
+    'room': _invalidate_room,
+    'avatar': _invalidate_avatar,
+}
+
+
+def invalidate(cache, key=None):
+    """
+    Forget ``key`` (None: everything) in the ``cache`` of this process at
+    once, and in the other processes once the transaction commits, through
+    the channel layer: a worker started by runworkers only sees the writes
+    of the others that way.
+    """
+    CACHES[cache](key)
+    transaction.on_commit(partial(_broadcast, cache, key))
+
+
+def _broadcast(cache, key):
+    channel_layer = get_channel_layer()
+    if channel_layer is None or isinstance(channel_layer, InMemoryChannelLayer):
+        # Only this process can read the layer, nothing to tell
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(INVALIDATION_GROUP, {
+            'type': 'cache.invalidate',
+            'cache': cache,
+            'key': key,
+            'origin': PROCESS_ID,
+        })
+    except Exception:
+        # The other processes keep the stale entry until it is evicted
+        logger.exception('Could not broadcast the invalidation of %s %s', cache, key)
+
+
+async def listen(channel_layer, renew_every=3600):
+    """
+    Apply the invalidations broadcast by the other processes, until
+    cancelled. The group membership is renewed every ``renew_every``
+    seconds, before the channel layer expires it.
+    """
+    channel = await channel_layer.new_channel()
+    renew = asyncio.get_running_loop().create_task(_renew(channel_layer, channel, renew_every))
+    try:
+        while True:
+            message = await channel_layer.receive(channel)
+            if message.get('origin') != PROCESS_ID and message.get('cache') in CACHES:
+                CACHES[message['cache']](message.get('key'))
+    finally:
+        renew.cancel()
+        await channel_layer.group_discard(INVALIDATION_GROUP, channel)
+
+
+async def _renew(channel_layer, channel, renew_every):
+    while True:
+        await channel_layer.group_add(INVALIDATION_GROUP, channel)
+        await asyncio.sleep(renew_every)
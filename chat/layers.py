@@ -0,0 +1,108 @@
+"""
+SHARDED REDIS CHANNEL LAYER
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import bisect
+import hashlib
+import time
+
+from channels.layers import InMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+from django.utils.module_loading import import_string
+
+from .metrics import group_send_seconds, registry
+
+
+class HashRing:
+    """
+    Consistent hashing of keys (group and channel names) over a list of
+    nodes. Each node is placed ``replicas`` times on the ring so the keys
+    are spread evenly, and adding or removing a node only moves the keys of
+    that node instead of reshuffling all of them.
+    """
+
+    replicas = 160
+
+    def __init__(self, nodes):
+        self._points = []
+        self._indexes = []
+        ring = sorted(
+            (self._hash(f'{node}#{replica}'), index)
+            for index, node in enumerate(nodes)
+            for replica in range(self.replicas)
+        )
+        for point, index in ring:
+            self._points.append(point)
+            self._indexes.append(index)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf8')).digest()[:8], 'big')
+
+    def get_node(self, key):
+        """
+        Index of the node that owns the key.
+        """
+        position = bisect.bisect(self._points, self._hash(key))
+        return self._indexes[position % len(self._points)]
+
+
+class GroupSendMetricsMixin:
+    """
+    Records the latency of group_send when the metrics are enabled.
+    """
+
+    async def group_send(self, group, message):
+        if not registry.enabled:
+            return await super().group_send(group, message)
+        start = time.perf_counter()
+        try:
+            return await super().group_send(group, message)
+        finally:
+            group_send_seconds.observe(time.perf_counter() - start)
+
+
+class ShardedRedisChannelLayer(GroupSendMetricsMixin, RedisChannelLayer):
+    """
+    channels_redis layer that spreads groups and process channels over all
+    the configured Redis hosts with a pluggable router (``HashRing`` by
+    default), so the layer can scale out by adding hosts.
+
+    Extra CONFIG key:
+        "router": dotted path of a class built with the list of host names
+                  and providing ``get_node(key)`` -> host index.
+    """
+
+    def __init__(self, *args, router='chat.layers.HashRing', **kwargs):
+        super().__init__(*args, **kwargs)
+        router_class = import_string(router) if isinstance(router, str) else router
+        self.router = router_class([self._host_name(host) for host in self.hosts])
+
+    @staticmethod
+    def _host_name(host):
+        if 'address' in host:
+            return str(host['address'])
+        return repr(sorted(host.items()))
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        return self.router.get_node(value)
+
+
+class LocalChannelLayer(GroupSendMetricsMixin, InMemoryChannelLayer):
+    """
+    In-memory layer (development, benchmarks) with the group_send metrics.
+
+    The channels layer looks for expired messages in every channel on every
+    receive, which makes a broadcast to N sockets cost N * N. Here that scan
+    runs at most once per ``clean_interval`` seconds.
+    """
+
+    clean_interval = 1.0
+    _cleaned = 0.0
+
+    def _clean_expired(self):
+        if time.monotonic() - self._cleaned >= self.clean_interval:
+            self._cleaned = time.monotonic()
+            super()._clean_expired()
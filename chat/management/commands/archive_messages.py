@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.archive import archive_messages
+
+
+class Command(BaseCommand):
+    help = 'Move the messages older than the retention period to monthly compressed archive files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.CHAT_RETENTION_DAYS,
+            help='archive the messages older than this number of days',
+        )
+        parser.add_argument('--chunk-size', type=int, default=1000, help='messages read and deleted at a time')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        count = archive_messages(cutoff, chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'{count} messages archived (older than {cutoff:%Y-%m-%d})'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        'Give conversation and inbox sequence numbers to the messages written before they existed. '
+        'Run it once after upgrading, before clients catch up by sequence number.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = Message.objects.backfill_sequences(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{count} messages numbered'))
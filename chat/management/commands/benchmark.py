@@ -0,0 +1,120 @@
+import json
+import os
+import platform
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+from django.utils import timezone
+
+from account.last_online import last_online_writer
+from chat.bench import inbox, lifecycle, room, workers
+from chat.blocking import blocking_monitor
+from chat.outbound import outbound_stats
+from chat.persistence import message_queue
+
+
+SCENARIOS = {
+    'inbox': inbox.run,
+    'lifecycle': lifecycle.run,
+    'room': room.run,
+    'workers': workers.run,
+}
+
+# Scenarios whose server runs in other processes: the test database must be
+# one they can open (a file with SQLite, not the default in-memory one)
+SHARED_DATABASE = {'workers'}
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(result, prefix=''):
+    """
+    {'chat': {'latency': {'p50_ms': 1}}} -> {'chat.latency.p50_ms': 1}, numbers only.
+    """
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+class Command(BaseCommand):
+    help = (
+        'Run a WebSocket benchmark scenario in-process (WebsocketCommunicator, in-memory '
+        'channel layer, throwaway test database) and report throughput, latencies and queries. '
+        'The workers scenario runs runworkers over real sockets instead.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--messages', type=int, default=20, help='messages sent by each user')
+        parser.add_argument('--devices', type=int, default=3, help='inbox sockets per user (inbox)')
+        parser.add_argument('--heartbeats', type=int, default=5, help='heartbeats sent by each user (lifecycle)')
+        parser.add_argument('--members', type=int, default=500, help='members of the room (room)')
+        parser.add_argument('--workers', default='1,2', help='comma separated worker counts to compare (workers)')
+        parser.add_argument('--output', help='write the results as JSON to this file')
+        parser.add_argument('--compare', help='results file of a previous run to compare with')
+
+    def handle(self, *args, **options):
+        from django_chat.asgi import application
+
+        if options['scenario'] in SHARED_DATABASE and connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        blocking_monitor.reset()
+        outbound_stats.reset()
+        try:
+            result = SCENARIOS[options['scenario']](
+                application,
+                users=options['users'],
+                messages=options['messages'],
+                devices=options['devices'],
+                heartbeats=options['heartbeats'],
+                members=options['members'],
+                workers=options['workers'],
+            )
+        finally:
+            # Write what is still buffered while the test database exists
+            message_queue.flush_sync()
+            last_online_writer.flush()
+            teardown_databases(old_config, verbosity=0)
+
+        report = {
+            'commit': current_commit(),
+            'date': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'result': result,
+            # Handlers that held the event loop longer than the threshold
+            'blocking': blocking_monitor.stats(),
+            'outbound': outbound_stats.snapshot(),
+        }
+        self.stdout.write(json.dumps(report, indent=2))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+        if options['compare']:
+            with open(options['compare']) as previous:
+                self.compare(json.load(previous), report)
+
+    def compare(self, before, after):
+        old, new = flatten(before['result']), flatten(after['result'])
+        self.stdout.write(f"\n{'metric':<45} {before['commit'] or '?':>12} {after['commit'] or '?':>12} {'change':>9}")
+        for metric in sorted(set(old) & set(new)):
+            change = ''
+            if old[metric]:
+                change = f'{(new[metric] - old[metric]) / old[metric] * 100:+.1f}%'
+            self.stdout.write(f'{metric:<45} {old[metric]:>12} {new[metric]:>12} {change:>9}')
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.attachments import expire_uploads
+
+
+class Command(BaseCommand):
+    help = 'Delete the attachment uploads left incomplete, with their partial files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=int, default=settings.CHAT_ATTACHMENT_UPLOAD_EXPIRY_HOURS,
+            help='delete the uploads without new bytes for this number of hours',
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        count = expire_uploads(cutoff)
+        self.stdout.write(self.style.SUCCESS(f'{count} incomplete uploads deleted (idle since {cutoff:%Y-%m-%d %H:%M})'))
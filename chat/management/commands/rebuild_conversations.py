@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Conversation
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the conversation summaries (last message of each conversation) from the messages.'
+
+    def handle(self, *args, **options):
+        count = Conversation.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'{count} conversation summaries rebuilt'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from chat.search import install_search_index, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Create the full-text message index if needed and rebuild it from the messages.'
+
+    def handle(self, *args, **options):
+        install_search_index()
+        rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS('Message search index rebuilt'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import UnreadCounter
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the unread message counters from the messages.'
+
+    def handle(self, *args, **options):
+        count = UnreadCounter.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'{count} unread counters rebuilt'))
@@ -0,0 +1,49 @@
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.workers import WorkerSupervisor, worker_count
+
+
+class Command(BaseCommand):
+    help = (
+        'Serve the ASGI application with several Daphne worker processes listening on the same port '
+        '(SO_REUSEPORT). SIGHUP restarts the workers one at a time, SIGTERM drains them and exits.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument('--workers', type=int, help='worker processes (default: CHAT_WORKERS, or one per core)')
+        parser.add_argument(
+            '--drain-timeout', type=float,
+            help='seconds a stopping worker waits for its connections to close (default: CHAT_WORKER_DRAIN_TIMEOUT)',
+        )
+        parser.add_argument('--ready-fd', type=int, help='pipe to write a byte to once listening')
+        # Started by the supervisor
+        parser.add_argument('--worker', action='store_true', help='run a single worker (used by the supervisor)')
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            from chat.server import run_worker
+            from django_chat.asgi import application
+
+            run_worker(
+                application, options['host'], options['port'],
+                ready_fd=options['ready_fd'], drain_timeout=options['drain_timeout'], verbosity=options['verbosity'],
+            )
+            return
+
+        workers = worker_count(options['workers'])
+        if workers > 1 and isinstance(get_channel_layer(), InMemoryChannelLayer):
+            raise CommandError('Several workers need a channel layer they share (Redis), not the in-memory one.')
+        if workers > 1 and not settings.CHAT_PRESENCE_REDIS_URL:
+            raise CommandError('Several workers need a presence registry they share: set CHAT_PRESENCE_REDIS_URL.')
+        self.stdout.write(f"Starting {workers} workers on {options['host']}:{options['port']}")
+        try:
+            WorkerSupervisor(
+                options['host'], options['port'], workers,
+                drain_timeout=options['drain_timeout'], ready_fd=options['ready_fd'],
+            ).run()
+        except RuntimeError as error:
+            raise CommandError(error)
@@ -0,0 +1,225 @@
+"""
+METRICS (PROMETHEUS TEXT FORMAT)
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+# Handler running in the current context, as (consumer, handler) labels.
+# Copied by sync_to_async into the threads doing the ORM work of the handler.
+current_handler = contextvars.ContextVar('current_handler', default=None)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labelnames, labels, value) for labels, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labelnames, labels, value in self.samples():
+            lines.append(f'{name}{format_labels(labelnames, labels)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per bucket counts (not cumulative), then sum and count
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        samples = []
+        bucket_labelnames = self.labelnames + ('le',)
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((f'{self.name}_bucket', bucket_labelnames, labels + (bound,), cumulative))
+                samples.append((f'{self.name}_bucket', bucket_labelnames, labels + ('+Inf',), count))
+                samples.append((f'{self.name}_sum', self.labelnames, labels, total))
+                samples.append((f'{self.name}_count', self.labelnames, labels, count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Metrics of this process. Instrumented code checks ``enabled`` before
+    measuring anything, so disabled metrics cost one attribute lookup.
+    ``collectors`` are called at render time for values kept elsewhere.
+    """
+
+    def __init__(self, enabled=None):
+        self.enabled = settings.CHAT_METRICS_ENABLED if enabled is None else enabled
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, function):
+        self.collectors.append(function)
+        return function
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            for metric in collect():
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+connections_open = registry.gauge('chat_connections', 'Open WebSocket connections.', ['consumer'])
+frames_received = registry.counter('chat_frames_received_total', 'WebSocket frames received.', ['consumer'])
+messages_sent = registry.counter('chat_messages_total', 'Chat messages sent by the clients.')
+handler_seconds = registry.histogram(
+    'chat_handler_seconds', 'Time spent in consumer handlers, awaits included.', ['consumer', 'handler']
+)
+handler_queries = registry.counter(
+    'chat_handler_queries_total', 'Database queries run by consumer handlers.', ['consumer', 'handler']
+)
+group_send_seconds = registry.histogram('chat_group_send_seconds', 'Channel layer group_send latency.')
+
+
+def handler_scope(consumer, handler):
+    """
+    Context timing a consumer handler and attributing the queries it runs
+    to it. Does nothing when the metrics are disabled.
+    """
+    if not registry.enabled:
+        return nullcontext()
+    return _handler_scope(consumer, handler)
+
+
+@contextmanager
+def _handler_scope(consumer, handler):
+    token = current_handler.set((consumer, handler))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        handler_seconds.observe(time.perf_counter() - start, consumer, handler)
+        current_handler.reset(token)
+
+
+def count_query(execute, sql, params, many, context):
+    labels = current_handler.get()
+    if labels is not None:
+        handler_queries.inc(*labels)
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    if registry.enabled and count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+connection_created.connect(install_query_counter)
+
+
+@registry.collector
+def collect_outbound():
+    from .outbound import outbound_stats
+
+    stats = outbound_stats.snapshot()
+    frames = Counter('chat_outbound_frames_total', 'Frames through the outbound queues.', ['result'])
+    for result in ('queued', 'sent', 'coalesced', 'dropped'):
+        frames.inc(result, amount=stats.get(result, 0))
+    disconnects = Counter('chat_outbound_disconnects_total', 'Slow clients disconnected.')
+    disconnects.inc(amount=stats.get('overflow_disconnects', 0))
+    paused = Counter('chat_outbound_paused_total', 'Writes held back because a client transport was full.')
+    paused.inc(amount=stats.get('paused', 0))
+    depth = Gauge('chat_outbound_queue_depth', 'Frames waiting in the outbound queues.')
+    depth.set(stats['depth'])
+    max_depth = Gauge('chat_outbound_queue_max_depth', 'Frames waiting in the longest outbound queue.')
+    max_depth.set(stats['max_depth'])
+    return [frames, disconnects, paused, depth, max_depth]
+
+
+@registry.collector
+def collect_blocking():
+    from .blocking import blocking_monitor
+
+    blocked = Counter('chat_loop_blocked_total', 'Handler slices over the blocking threshold.', ['handler'])
+    for name, entry in blocking_monitor.stats().items():
+        blocked.inc(name, amount=entry['count'])
+    return [blocked]
@@ -1,12 +1,102 @@
-from django.db import models
+from collections import Counter
+
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.urls import reverse
 from channels.layers import get_channel_layer
-from channels.db import database_sync_to_async
 
 from asgiref.sync import async_to_sync
 from account.models import Profile
+from .db import run_sync
+from .groups import user_inbox_group
+from .identity import identities
+from .protocol import group_event
+from .thumbnails import IMAGE_TYPES
 from django.utils import timezone
 
 
+class MessageManager(models.Manager):
+
+    def create_batch(self, messages):
+        """
+        Insert new messages with a single INSERT, together with the
+        bookkeeping that must stay consistent with them (sequence numbers,
+        unread counters).
+        """
+        with transaction.atomic():
+            self.assign_sequences(messages)
+            self.bulk_create(messages)
+            self.after_create(messages)
+        return messages
+
+    def assign_sequences(self, messages):
+        """
+        Number ``messages`` (in order) in their conversation and in their
+        receiver's inbox. Must run in the transaction that saves them.
+        """
+        counts = Counter()
+        for message in messages:
+            counts[conversation_sequence(message.sender_id, message.receiver_id)] += 1
+            counts[inbox_sequence(message.receiver_id)] += 1
+        following = Sequence.objects.reserve(counts)
+        for message in messages:
+            conversation = conversation_sequence(message.sender_id, message.receiver_id)
+            inbox = inbox_sequence(message.receiver_id)
+            message.conversation_seq, message.inbox_seq = following[conversation], following[inbox]
+            following[conversation] += 1
+            following[inbox] += 1
+
+    def backfill_sequences(self, batch_size=1000):
+        """
+        Number the messages saved before sequence numbers existed, oldest
+        first. Returns the number of messages numbered.
+        """
+        numbered = 0
+        while True:
+            with transaction.atomic():
+                messages = list(self.filter(conversation_seq__isnull=True).order_by('id')[:batch_size])
+                if not messages:
+                    return numbered
+                self.assign_sequences(messages)
+                self.bulk_update(messages, ['conversation_seq', 'inbox_seq'])
+            numbered += len(messages)
+
+    def after_create(self, messages):
+        """
+        Work done in the transaction that inserted ``messages``.
+        """
+        from .search import index_messages
+
+        UnreadCounter.objects.increment(messages)
+        Conversation.objects.record(messages)
+        index_messages(messages)
+
+    def mark_read_up_to(self, receiver_id, sender_id, up_to):
+        """
+        Mark the messages of ``sender_id`` to ``receiver_id`` with an id up to
+        ``up_to`` as read, with a single UPDATE. Returns the number of
+        messages marked.
+        """
+        with transaction.atomic():
+            read = self.filter(
+                receiver_id=receiver_id, sender_id=sender_id, id__lte=up_to, is_read=False
+            ).update(is_read=True)
+            if read:
+                UnreadCounter.objects.decrement(receiver_id, sender_id, read)
+        return read
+
+    def mark_conversation_read(self, receiver_id, sender_id):
+        """
+        Mark every message of ``sender_id`` to ``receiver_id`` as read and
+        reset their unread counter. Returns the number of messages marked.
+        """
+        with transaction.atomic():
+            read = self.filter(receiver_id=receiver_id, sender_id=sender_id, is_read=False).update(is_read=True)
+            UnreadCounter.objects.filter(receiver_id=receiver_id, sender_id=sender_id).update(count=0)
+        return read
+
+
 class Message(models.Model):
     """
     Name: Message model
@@ -18,6 +108,26 @@ class Message(models.Model):
     content = models.TextField()
     timestamp = models.DateTimeField(default=timezone.now)
     is_read = models.BooleanField(default=False)
+    # Position in the conversation and in the receiver's inbox, without gaps,
+    # assigned when the message is written (see MessageManager.assign_sequences)
+    conversation_seq = models.PositiveBigIntegerField(null=True, blank=True)
+    inbox_seq = models.PositiveBigIntegerField(null=True, blank=True)
+    # File sent with the message, uploaded beforehand (see attachments.py)
+    attachment = models.OneToOneField(
+        'Attachment', on_delete=models.SET_NULL, null=True, blank=True, related_name='message'
+    )
+
+    objects = MessageManager()
+
+    class Meta:
+        indexes = [
+            # Serve the keyset-paginated history of a conversation (see history.py)
+            models.Index(fields=['sender', 'receiver', 'timestamp', 'id'], name='chat_message_conv_idx'),
+            models.Index(fields=['receiver', 'sender', 'timestamp', 'id'], name='chat_message_conv_rev_idx'),
+            # Serve the reconnect catch-up by sequence number (see catchup.py)
+            models.Index(fields=['sender', 'receiver', 'conversation_seq'], name='chat_message_conv_seq_idx'),
+            models.Index(fields=['receiver', 'inbox_seq'], name='chat_message_inbox_seq_idx'),
+        ]
 
     def sent_time(self):
         now = timezone.now()
@@ -41,31 +151,434 @@ class Message(models.Model):
     async def mark_as_read(self):
         if not self.is_read:
             self.is_read = True
-            await database_sync_to_async(self.save)()
+            sender_user_id = await run_sync(self._save_read)
+            if sender_user_id is None:
+                # Already read meanwhile (read watermark), already notified
+                return
 
             # Send notification to the sender that the message has been read
             channel_layer = get_channel_layer()
             await channel_layer.group_send(
-                f'user_{self.sender.id}',
-                {
-                    'type': 'chat.message.read',
-                    'message_id': self.id
-                }
+                user_inbox_group(sender_user_id),
+                group_event('chat.message.read', {'message_read': {'message_id': self.id}})
             )
 
+    def _save_read(self):
+        # Only the UPDATE that actually reads the message counts it: this
+        # instance may be older than a read watermark that already did
+        with transaction.atomic():
+            if not Message.objects.filter(pk=self.pk, is_read=False).update(is_read=True):
+                return None
+            UnreadCounter.objects.decrement(self.receiver_id, self.sender_id)
+        return identities.resolve_profile(self.sender_id).user_id
+
+    def notification(self, sender=None):
+        """
+        'user.new_message' event sent to the receiver's inbox. ``sender`` is
+        the sender's Identity, taken from the identity cache when not given.
+        Sent from a socket, the message has no id yet: its ``client_id``
+        matches it with the id in the 'inbox_persisted' event that follows.
+        """
+        sender = sender or identities.resolve_profile(self.sender_id)
+        return group_event('user.new_message', {
+            'new_message': {
+                'message_id': self.id,
+                'client_id': getattr(self, 'client_id', None),
+                'sender_id': sender.user_id,
+                'sender_name': sender.username,
+                'sender_avatar': sender.avatar_url,
+                'message': self.content,
+                'sent_time': self.sent_time(),
+                'inbox_seq': self.inbox_seq,
+                'attachment': self.attachment.metadata() if self.attachment_id else None,
+            }
+        })
+
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
+        created = self.pk is None
+        with transaction.atomic():
+            if created:
+                Message.objects.assign_sequences([self])
+            super().save(*args, **kwargs)
+            if created:
+                Message.objects.after_create([self])
+        if not created:
+            return
+        receiver = identities.resolve_profile(self.receiver_id)
         channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f'user-{self.recipient.id}',
-            {
-                'type': 'user.new_message',
-                'sender_id': self.sender.id,
-                'sender_name': self.sender.profile.get_full_name(),
-                'message': self.message,
-                'sent_time': self.sent_time(),
+        async_to_sync(channel_layer.group_send)(user_inbox_group(receiver.user_id), self.notification())
+
+    def __str__(self):
+        return f'{self.sender.user.username} to {self.receiver.user.username}: {self.content[:50]}...'
+
+
+class UnreadCounterManager(models.Manager):
+
+    def increment(self, messages):
+        """
+        Count the unread ``messages`` in the counters of their (receiver, sender).
+        """
+        pairs = Counter((message.receiver_id, message.sender_id) for message in messages if not message.is_read)
+        for (receiver_id, sender_id), count in pairs.items():
+            counter = self.filter(receiver_id=receiver_id, sender_id=sender_id)
+            if counter.update(count=F('count') + count):
+                continue
+            try:
+                with transaction.atomic():
+                    self.create(receiver_id=receiver_id, sender_id=sender_id, count=count)
+            except IntegrityError:
+                # Created meanwhile by another worker
+                counter.update(count=F('count') + count)
+
+    def decrement(self, receiver_id, sender_id, count=1):
+        self.filter(receiver_id=receiver_id, sender_id=sender_id).update(count=Greatest(F('count') - count, 0))
+
+    def counts_for(self, receiver_id):
+        """
+        {sender profile id: number of unread messages} for a receiver.
+        """
+        return dict(self.filter(receiver_id=receiver_id, count__gt=0).values_list('sender_id', 'count'))
+
+    def rebuild(self, batch_size=1000):
+        """
+        Recompute every counter from the messages. Returns the number of counters.
+        """
+        rows = (
+            Message.objects.filter(is_read=False)
+            .order_by()
+            .values_list('receiver_id', 'sender_id')
+            .annotate(count=models.Count('id'))
+        )
+        with transaction.atomic():
+            self.all().delete()
+            counters = [
+                UnreadCounter(receiver_id=receiver_id, sender_id=sender_id, count=count)
+                for receiver_id, sender_id, count in rows.iterator()
+            ]
+            self.bulk_create(counters, batch_size=batch_size)
+        return len(counters)
+
+
+class UnreadCounter(models.Model):
+    """
+    Name: UnreadCounter model
+    Description: Number of unread messages sent by a sender to a receiver, maintained when
+                 messages are created and read so the sidebar never has to count them
+    author: donaldtedom0@gmail.com
+    """
+    receiver = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='unread_counters')
+    sender = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+
+    objects = UnreadCounterManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['receiver', 'sender'], name='chat_unread_counter_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.count} unread from {self.sender_id} to {self.receiver_id}'
+
+
+# Characters of the last message kept in the conversation list
+SNIPPET_LENGTH = 100
+
+
+def message_snippet(message):
+    if message.content:
+        return message.content[:SNIPPET_LENGTH]
+    return message.attachment.name[:SNIPPET_LENGTH] if message.attachment_id else ''
+
+
+class ConversationManager(models.Manager):
+
+    def record(self, messages):
+        """
+        Make the last of ``messages`` of each conversation its last message,
+        in the summaries of both participants. Must run in the transaction
+        that saves them: the conversation sequence they were numbered in
+        stays locked until it ends, so summaries are updated in order.
+        """
+        last = {}
+        for message in messages:
+            last[frozenset((message.sender_id, message.receiver_id))] = message
+        for message in last.values():
+            fields = {
+                'last_message_id': message.pk,
+                'last_sender_id': message.sender_id,
+                'snippet': message_snippet(message),
+                'last_message_at': message.timestamp,
             }
+            for owner_id, other_id in {(message.sender_id, message.receiver_id), (message.receiver_id, message.sender_id)}:
+                summary = self.filter(owner_id=owner_id, other_id=other_id)
+                if summary.update(**fields):
+                    continue
+                try:
+                    with transaction.atomic():
+                        self.create(owner_id=owner_id, other_id=other_id, **fields)
+                except IntegrityError:
+                    # Created meanwhile by another worker
+                    summary.update(**fields)
+
+    def rebuild(self, batch_size=1000):
+        """
+        Recompute every summary from the messages. Returns the number of summaries.
+        """
+        last_ids = (
+            Message.objects.order_by()
+            .values('sender_id', 'receiver_id')
+            .annotate(last_id=models.Max('id'))
+            .values_list('last_id', flat=True)
         )
+        with transaction.atomic():
+            self.all().delete()
+            last = {}
+            for message in Message.objects.filter(id__in=last_ids).select_related('attachment').iterator(batch_size):
+                pair = frozenset((message.sender_id, message.receiver_id))
+                if pair not in last or last[pair].id < message.id:
+                    last[pair] = message
+            summaries = [
+                Conversation(
+                    owner_id=owner_id, other_id=other_id, last_message_id=message.id,
+                    last_sender_id=message.sender_id, snippet=message_snippet(message),
+                    last_message_at=message.timestamp,
+                )
+                for message in last.values()
+                for owner_id, other_id in {(message.sender_id, message.receiver_id), (message.receiver_id, message.sender_id)}
+            ]
+            self.bulk_create(summaries, batch_size=batch_size)
+        return len(summaries)
+
+
+class Conversation(models.Model):
+    """
+    Name: Conversation model
+    Description: Summary of a conversation for one of its participants (the owner): its
+                 last message, maintained when messages are created so the conversation
+                 list never has to group the messages
+    author: donaldtedom0@gmail.com
+    """
+    owner = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='conversations')
+    other = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='+')
+    # Not a foreign key: the message may since have been archived (see archive.py)
+    last_message_id = models.PositiveBigIntegerField(null=True, blank=True)
+    last_sender = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='+')
+    snippet = models.CharField(max_length=SNIPPET_LENGTH, blank=True)
+    last_message_at = models.DateTimeField()
+
+    objects = ConversationManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'other'], name='chat_conversation_unique'),
+        ]
+        indexes = [
+            # Serve the keyset-paginated conversation list, most recent first (see conversations.py)
+            models.Index(fields=['owner', 'last_message_at', 'id'], name='chat_conversation_recent_idx'),
+        ]
 
     def __str__(self):
-        return f'{self.sender.user.username} to {self.receiver.user.username}: {self.content[:50]}...'
+        return f'{self.owner_id} with {self.other_id}: {self.snippet[:50]}'
+
+
+class ArchivedMonth(models.Model):
+    """
+    Name: ArchivedMonth model
+    Description: One month of messages moved out of the Message table into a compressed
+                 JSONL file by the archive_messages command (see archive.py)
+    author: donaldtedom0@gmail.com
+    """
+    month = models.DateField(unique=True)  # first day of the month
+    path = models.CharField(max_length=500)
+    message_count = models.PositiveIntegerField(default=0)
+    # Bytes of the file holding archived messages, anything after them is a
+    # write that did not complete (None: archived before the size was kept)
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.month:%Y-%m}: {self.message_count} messages in {self.path}'
+
+
+def conversation_sequence(profile_id, other_profile_id):
+    # Same sequence for both directions of a conversation
+    return 'conversation:{}:{}'.format(*sorted((profile_id, other_profile_id)))
+
+
+def inbox_sequence(profile_id):
+    return f'inbox:{profile_id}'
+
+
+class SequenceManager(models.Manager):
+
+    def reserve(self, counts):
+        """
+        Reserve ``count`` consecutive numbers in each named sequence of
+        ``counts`` ({name: count}) and return {name: first reserved number}.
+        The sequences stay locked until the end of the caller's transaction,
+        so numbers are handed out without gaps nor duplicates.
+        """
+        first = {}
+        # Always lock the sequences in the same order: no deadlock between writers
+        for name in sorted(counts):
+            count = counts[name]
+            value = self._increment(name, count)
+            if value is None:
+                try:
+                    with transaction.atomic():
+                        value = self.create(name=name, value=count).value
+                except IntegrityError:
+                    # Created meanwhile by another writer
+                    value = self._increment(name, count)
+            first[name] = value - count + 1
+        return first
+
+    def _increment(self, name, count):
+        # New value of the sequence, None when it does not exist yet
+        connection = connections[self.db]
+        if connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert:
+            # One statement instead of an UPDATE and a SELECT
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {self.model._meta.db_table} SET value = value + %s WHERE name = %s RETURNING value',
+                    [count, name],
+                )
+                row = cursor.fetchone()
+            return None if row is None else row[0]
+        if not self.filter(name=name).update(value=F('value') + count):
+            return None
+        return self.filter(name=name).values_list('value', flat=True).get()
+
+
+class Sequence(models.Model):
+    """
+    Name: Sequence model
+    Description: Last number handed out by a named counter: the messages of a
+                 conversation or of a user's inbox (see MessageManager.assign_sequences)
+    author: donaldtedom0@gmail.com
+    """
+    name = models.CharField(max_length=100, unique=True)
+    value = models.PositiveBigIntegerField(default=0)
+
+    objects = SequenceManager()
+
+    def __str__(self):
+        return f'{self.name}: {self.value}'
+
+
+class Room(models.Model):
+    """
+    Name: Room model
+    Description: Group conversation between its members (see Membership)
+    author: donaldtedom0@gmail.com
+    """
+    name = models.CharField(max_length=100)
+    created_by = models.ForeignKey(Profile, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now)
+    members = models.ManyToManyField(Profile, through='Membership', related_name='rooms')
+
+    def __str__(self):
+        return self.name
+
+
+class Membership(models.Model):
+    """
+    Name: Membership model
+    Description: A profile taking part in a room
+    author: donaldtedom0@gmail.com
+    """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='memberships')
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='memberships')
+    joined_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'profile'], name='chat_membership_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.profile} in {self.room}'
+
+
+def room_sequence(room_id):
+    return f'room:{room_id}'
+
+
+class RoomMessageManager(models.Manager):
+
+    def create_message(self, room_id, sender_id, content):
+        """
+        Write a message of a room, numbered in the room's sequence. It is
+        stored once whatever the number of members.
+        """
+        with transaction.atomic():
+            name = room_sequence(room_id)
+            seq = Sequence.objects.reserve({name: 1})[name]
+            return self.create(room_id=room_id, sender_id=sender_id, content=content, seq=seq)
+
+
+class RoomMessage(models.Model):
+    """
+    Name: RoomMessage model
+    Description: Message sent to a room, stored once for all its members
+    author: donaldtedom0@gmail.com
+    """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='messages')
+    sender = models.ForeignKey(Profile, on_delete=models.SET_NULL, null=True, related_name='+')
+    content = models.TextField()
+    timestamp = models.DateTimeField(default=timezone.now)
+    # Position in the room, without gaps (history and catch-up, see rooms.py)
+    seq = models.PositiveBigIntegerField()
+
+    objects = RoomMessageManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='chat_room_message_seq_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.room}: {self.content[:50]}...'
+
+
+class Attachment(models.Model):
+    """
+    Name: Attachment model
+    Description: File uploaded by a profile to be sent with a message (see attachments.py)
+    author: donaldtedom0@gmail.com
+    """
+    uploader = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='attachments')
+    name = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    # Relative to CHAT_ATTACHMENT_DIR
+    path = models.CharField(max_length=500)
+    created_at = models.DateTimeField(default=timezone.now)
+    # None until every byte is uploaded
+    completed_at = models.DateTimeField(null=True, blank=True)
+    # Set by the first message sending it (the message itself may still be queued)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    # Set with sent_at: the receiver keeps access once the message is archived
+    receiver = models.ForeignKey(Profile, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # Images only (IMAGE_TYPES), once the thumbnail is made
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    thumbnail = models.CharField(max_length=500, blank=True)
+
+    def metadata(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'content_type': self.content_type,
+            'size': self.size,
+            'width': self.width,
+            'height': self.height,
+            'url': reverse('chatd:attachment-file', args=[self.id]),
+            # Found once the thumbnail is made, shortly after the upload
+            'thumbnail_url': (
+                reverse('chatd:attachment-thumbnail', args=[self.id]) if self.content_type in IMAGE_TYPES else None
+            ),
+        }
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,281 @@
+"""
+PER-CONNECTION OUTBOUND QUEUES (BACKPRESSURE)
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import asyncio
+import logging
+import threading
+import weakref
+from collections import Counter, deque
+from functools import partial
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# What may happen to a queued frame when its client reads slower than we write
+RELIABLE = 'reliable'  # chat messages and replies: always delivered, in order
+COALESCE = 'coalesce'  # state updates (presence): only the latest per key is kept
+DROPPABLE = 'droppable'  # other events: the oldest are dropped when the queue is full
+
+# ASGI scope extension carrying the TransportFlowControl of the connection
+FLOW_CONTROL_EXTENSION = 'chat.flow_control'
+
+
+class OutboundStats:
+    """
+    Counters shared by the queues of the process, plus their current depth.
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._queues = weakref.WeakSet()
+
+    def register(self, queue):
+        self._queues.add(queue)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counts[name] += value
+
+    def snapshot(self):
+        depths = [len(queue) for queue in list(self._queues)]
+        with self._lock:
+            counts = dict(self._counts)
+        return dict(
+            counts,
+            connections=len(depths),
+            depth=sum(depths),
+            max_depth=max(depths, default=0),
+        )
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+outbound_stats = OutboundStats()
+
+
+class TransportFlowControl:
+    """
+    Push producer registered on the Twisted transport of a connection (by
+    runworkers or FlowControlMiddleware). Daphne's send never waits: the
+    frame goes straight into the transport's buffer, which grows as long as
+    the client does not read. The transport pauses its producer once more than its buffer size (64 KB) is
+    waiting and resumes it when the buffer is written to the socket; the
+    outbound queue stops sending in between, so the frames wait in the queue
+    where the slow client policies apply.
+
+    ``previous`` is the producer it replaces on the transport (the HTTP
+    channel that handled the upgrade), still told to pause and resume.
+    """
+
+    def __init__(self, previous=None):
+        self.previous = previous
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    @classmethod
+    def register(cls, transport):
+        """
+        Register a new flow control on ``transport`` in place of its producer
+        (a transport has only one) and return it.
+        """
+        previous = getattr(transport, 'producer', None)
+        if previous is not None:
+            transport.unregisterProducer()
+        flow_control = cls(previous)
+        transport.registerProducer(flow_control, True)
+        return flow_control
+
+    def pauseProducing(self):
+        self.writable.clear()
+        if self.previous is not None:
+            self.previous.pauseProducing()
+
+    def resumeProducing(self):
+        self.writable.set()
+        if self.previous is not None:
+            self.previous.resumeProducing()
+
+    def stopProducing(self):
+        # Connection lost: nothing is written anymore, do not hold the writer
+        self.writable.set()
+        if self.previous is not None:
+            self.previous.stopProducing()
+
+
+class FlowControlMiddleware:
+    """
+    ASGI middleware giving the WebSocket connections of a stock Daphne server
+    (daphne, runserver) the ``chat.flow_control`` scope extension that
+    runworkers sets itself (see server.py). It has to wrap the application
+    before any middleware wrapping ``send``: it recognizes Daphne's send,
+    partial(server.handle_reply, protocol), to reach the protocol's transport.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        extensions = scope.get('extensions') or {}
+        if scope['type'] == 'websocket' and FLOW_CONTROL_EXTENSION not in extensions:
+            transport = self._daphne_transport(send)
+            if transport is not None:
+                extensions = dict(extensions)
+                extensions[FLOW_CONTROL_EXTENSION] = TransportFlowControl.register(transport)
+                scope = dict(scope, extensions=extensions)
+        return await self.inner(scope, receive, send)
+
+    @staticmethod
+    def _daphne_transport(send):
+        if not (isinstance(send, partial) and send.args and getattr(send.func, '__name__', None) == 'handle_reply'):
+            return None
+        transport = getattr(send.args[0], 'transport', None)
+        if transport is None or not hasattr(transport, 'registerProducer'):
+            return None
+        return transport
+
+
+_warned_without_flow_control = False
+
+
+def find_flow_control(scope):
+    """
+    Flow control of a WebSocket connection, from the scope extensions. None
+    under servers other than Daphne, where the outbound queue never fills up
+    and its policies do not apply (logged once).
+    """
+    global _warned_without_flow_control
+
+    flow_control = scope.get('extensions', {}).get(FLOW_CONTROL_EXTENSION)
+    if flow_control is None and not _warned_without_flow_control:
+        _warned_without_flow_control = True
+        logger.warning(
+            'The server gives no flow control: slow WebSocket clients are not detected, '
+            'the outbound queue policies do not apply'
+        )
+    return flow_control
+
+
+class OutboundQueue:
+    """
+    Frames waiting to be written to one WebSocket.
+
+    Handlers only append here and return, a writer task does the actual
+    sends: a slow client never holds the consumer, which keeps reading its
+    channel layer messages. A presence update replaces the queued one of the
+    same user, and past ``max_size`` frames the oldest droppable frame (then
+    the oldest presence update) makes room for the new one. Reliable frames are never dropped; once
+    ``disconnect_after`` frames are waiting the client is considered gone and
+    ``put`` returns False so the consumer closes the connection.
+
+    ``flow_control`` (a TransportFlowControl) tells when the transport can
+    take more bytes. Without it, the queue only grows while ``send`` is
+    awaited, which under Daphne is never.
+    """
+
+    def __init__(self, send, max_size=None, disconnect_after=None, flow_control=None):
+        self.send = send
+        self.flow_control = flow_control
+        self.max_size = max_size or settings.CHAT_OUTBOUND_QUEUE_SIZE
+        self.disconnect_after = disconnect_after or settings.CHAT_OUTBOUND_DISCONNECT_AFTER
+        self._entries = deque()  # [policy, key, message]
+        self._by_key = {}  # coalescing key -> its queued entry
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closed = False
+        self._writer = asyncio.get_running_loop().create_task(self._write())
+        outbound_stats.register(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def put(self, message, policy=RELIABLE, key=None):
+        """
+        Queue an ASGI send message. Returns False when the client has to be
+        disconnected.
+        """
+        if self._closed:
+            # The connection is being closed, nothing more is written
+            return True
+        outbound_stats.incr('queued')
+        if policy == COALESCE:
+            entry = self._by_key.get(key)
+            if entry is not None:
+                # Same place in the queue, latest state
+                entry[2] = message
+                outbound_stats.incr('coalesced')
+                return True
+        entry = [policy, key, message]
+        self._entries.append(entry)
+        if policy == COALESCE:
+            self._by_key[key] = entry
+        if len(self._entries) > self.max_size:
+            self._drop_oldest()
+        self._ready.set()
+        self._idle.clear()
+        if len(self._entries) >= self.disconnect_after:
+            outbound_stats.incr('overflow_disconnects')
+            logger.warning('Closing a WebSocket with %d frames waiting', len(self._entries))
+            self.close()
+            return False
+        return True
+
+    def _drop_oldest(self):
+        # Plain events go first: coalesced updates are already one per key
+        for policy in (DROPPABLE, COALESCE):
+            for entry in self._entries:
+                if entry[0] == policy:
+                    self._entries.remove(entry)
+                    if policy == COALESCE:
+                        del self._by_key[entry[1]]
+                    outbound_stats.incr('dropped')
+                    return
+
+    async def _write(self):
+        while True:
+            await self._ready.wait()
+            while self._entries:
+                if self.flow_control is not None and not self.flow_control.writable.is_set():
+                    # The frames wait here, where they can be coalesced or dropped
+                    outbound_stats.incr('paused')
+                    await self.flow_control.writable.wait()
+                    continue
+                policy, key, message = self._entries.popleft()
+                if policy == COALESCE:
+                    del self._by_key[key]
+                try:
+                    await self.send(message)
+                except Exception:
+                    logger.exception('Could not write to a WebSocket')
+                    self.close()
+                    return
+                outbound_stats.incr('sent')
+            self._ready.clear()
+            self._idle.set()
+
+    async def drain(self):
+        """
+        Wait until every queued frame is written (or the queue is closed).
+        """
+        await self._idle.wait()
+
+    def close(self):
+        """
+        Stop writing, the frames still queued are discarded.
+        """
+        if not self._closed:
+            self._closed = True
+            self._writer.cancel()
+            self._entries.clear()
+            self._by_key.clear()
+            self._idle.set()
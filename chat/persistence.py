@@ -0,0 +1,163 @@
+"""
+WRITE-BEHIND MESSAGE PERSISTENCE
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import asyncio
+import atexit
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DataError, DatabaseError, IntegrityError
+
+from .db import run_sync
+from .groups import private_room_name, user_inbox_group
+from .models import Message
+from .protocol import group_event
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBehindQueue:
+    """
+    Collects the messages received by the consumers and writes them to the
+    database with ``bulk_create``, in a worker thread, so the event loop is
+    never blocked by an INSERT.
+
+    A batch is written as soon as ``batch_size`` messages are pending or when
+    the oldest pending message has waited ``max_latency`` seconds. Messages
+    only leave the buffer once their batch is committed: a failed flush puts
+    them back and they are retried by the next one (at-least-once delivery).
+    """
+
+    def __init__(self, batch_size=None, max_latency=None):
+        self.batch_size = batch_size or settings.CHAT_MESSAGE_BATCH_SIZE
+        self.max_latency = max_latency or settings.CHAT_MESSAGE_BATCH_LATENCY
+        self._pending = []
+        self._timer = None
+        self._flush_lock = None
+        self._loop = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _bind_loop(self):
+        # The lock and the timer belong to the loop that is running; when the
+        # queue is used from a new loop (tests, management commands) start fresh.
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._timer = None
+            self._flush_lock = asyncio.Lock()
+        return loop
+
+    async def put(self, sender, receiver, content, client_id=None, attachment=None):
+        """
+        Queue a new message from ``sender`` to ``receiver`` (identities, see
+        identity.py), with an optional ``attachment``, and return the
+        (unsaved) Message instance.
+
+        Once written, the ids of the messages are announced to their
+        conversation group as a 'chat_persisted' event, matched by ``client_id``.
+        """
+        loop = self._bind_loop()
+        message = Message(
+            sender_id=sender.profile_id, receiver_id=receiver.profile_id, content=content, attachment=attachment
+        )
+        message.client_id = client_id
+        message.room = private_room_name(sender.user_id, receiver.user_id)
+        message.inbox = user_inbox_group(receiver.user_id)
+        self._pending.append(message)
+
+        if len(self._pending) >= self.batch_size:
+            loop.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_latency, self._on_timer)
+        return message
+
+    def _on_timer(self):
+        self._timer = None
+        if self._pending:
+            self._loop.create_task(self.flush())
+
+    async def flush(self):
+        """
+        Write every pending message to the database.
+        """
+        self._bind_loop()
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            while self._pending:
+                batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+                try:
+                    await run_sync(self._write, batch)
+                except DatabaseError:
+                    # Keep the batch (in order) for the next flush
+                    logger.exception('Could not persist %d chat messages, will retry', len(batch))
+                    self._pending[:0] = batch
+                    self._timer = self._loop.call_later(self.max_latency, self._on_timer)
+                    return
+                await self._announce(batch)
+
+    async def _announce(self, batch):
+        # One event per conversation and per inbox and batch, not per message.
+        # Clients keep the last sequence numbers to catch up after a reconnect.
+        rooms = {}
+        inboxes = {}
+        for message in batch:
+            if message.pk is None or message.client_id is None:
+                continue
+            rooms.setdefault(message.room, []).append(
+                {'client_id': message.client_id, 'id': message.pk, 'seq': message.conversation_seq}
+            )
+            inboxes.setdefault(message.inbox, []).append(
+                {'client_id': message.client_id, 'id': message.pk, 'inbox_seq': message.inbox_seq}
+            )
+        channel_layer = get_channel_layer()
+        events = [(room, group_event('chat_persisted', {'persisted': messages})) for room, messages in rooms.items()]
+        events += [
+            (inbox, group_event('chat.inbox_persisted', {'inbox_persisted': messages}))
+            for inbox, messages in inboxes.items()
+        ]
+        for group, event in events:
+            try:
+                await channel_layer.group_send(group, event)
+            except Exception:
+                # The batch is committed: the clients get the ids with their next catch-up
+                logger.exception('Could not announce %d written chat messages to %s', len(batch), group)
+
+    def flush_sync(self):
+        """
+        Write every pending message from synchronous code (used at shutdown).
+        """
+        while self._pending:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            try:
+                self._write(batch)
+            except DatabaseError:
+                logger.exception('Lost %d chat messages at shutdown', len(batch) + len(self._pending))
+                return
+
+    def _write(self, batch):
+        try:
+            Message.objects.create_batch(batch)
+            return
+        except (IntegrityError, DataError):
+            # One bad row must not hold back the whole batch: retry row by row
+            # and only drop the rows that the database refuses.
+            pass
+
+        for message in batch:
+            try:
+                Message.objects.create_batch([message])
+            except (IntegrityError, DataError):
+                logger.exception('Dropping chat message %r refused by the database', message.content[:50])
+
+
+message_queue = MessageWriteBehindQueue()
+
+# Do not lose what is still buffered when the server process stops
+atexit.register(message_queue.flush_sync)
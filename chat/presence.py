@@ -0,0 +1,202 @@
+"""
+PRESENCE REGISTRY
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import asyncio
+import time
+import uuid
+
+from django.conf import settings
+
+from .protocol import group_event
+
+
+USER_LIST_GROUP = 'user_list'
+
+
+class PresenceRegistry:
+    """
+    In-memory record of who is online, for a single server process.
+
+    A user is online as long as one of their sockets is open and they sent a
+    heartbeat less than ``ttl`` seconds ago. Several processes need the
+    shared registry (RedisPresenceRegistry), each of them only sees its own
+    sockets here.
+
+    Every method that changes the state returns ``True`` only when the user
+    actually went online or offline, so callers broadcast transitions only.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl or settings.PRESENCE_TTL
+        self._connections = {}  # user id -> number of open sockets
+        self._last_beat = {}  # user id -> time of the last heartbeat
+
+    async def is_online(self, user_id):
+        return user_id in self._last_beat
+
+    async def online_users(self):
+        return set(self._last_beat)
+
+    async def connect(self, user_id):
+        self._connections[user_id] = self._connections.get(user_id, 0) + 1
+        return await self.heartbeat(user_id)
+
+    async def disconnect(self, user_id):
+        count = self._connections.get(user_id, 0) - 1
+        if count > 0:
+            self._connections[user_id] = count
+            return False
+        self._connections.pop(user_id, None)
+        return self._last_beat.pop(user_id, None) is not None
+
+    async def heartbeat(self, user_id):
+        was_online = user_id in self._last_beat
+        self._last_beat[user_id] = time.monotonic()
+        return not was_online
+
+    async def expire(self):
+        """
+        Forget the users whose last heartbeat is older than the TTL and
+        return their ids.
+        """
+        deadline = time.monotonic() - self.ttl
+        expired = [user_id for user_id, beat in self._last_beat.items() if beat < deadline]
+        for user_id in expired:
+            del self._last_beat[user_id]
+        return expired
+
+
+# KEYS[1] processes of the user (sorted set: process -> expiry), KEYS[2]
+# online users (sorted set: user id -> expiry); ARGV process, now, ttl, user
+# id. Returns 1 when the user was offline.
+BEAT_SCRIPT = """
+local now = tonumber(ARGV[2])
+local expires = now + tonumber(ARGV[3])
+local score = redis.call('ZSCORE', KEYS[2], ARGV[4])
+redis.call('ZADD', KEYS[1], expires, ARGV[1])
+redis.call('PEXPIRE', KEYS[1], math.ceil(tonumber(ARGV[3]) * 1000))
+redis.call('ZADD', KEYS[2], expires, ARGV[4])
+if score and tonumber(score) > now then
+    return 0
+end
+return 1
+"""
+
+# Same keys; ARGV process, now, user id. Returns 1 when the user went offline
+# (no other process has a live socket of theirs).
+LEAVE_SCRIPT = """
+local now = tonumber(ARGV[2])
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+if #last > 0 then
+    redis.call('ZADD', KEYS[2], last[2], ARGV[3])
+    return 0
+end
+local score = redis.call('ZSCORE', KEYS[2], ARGV[3])
+redis.call('ZREM', KEYS[2], ARGV[3])
+if score and tonumber(score) > now then
+    return 1
+end
+return 0
+"""
+
+# KEYS[1] online users; ARGV now. Removes and returns the expired users: each
+# one is returned to a single caller, whatever the number of processes.
+EXPIRE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if #expired > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+end
+return expired
+"""
+
+
+class RedisPresenceRegistry(PresenceRegistry):
+    """
+    Record of who is online kept in Redis, shared by every worker process.
+
+    Each heartbeat stores its expiry (now + ``ttl``) for the user and the
+    process, so a user connected to several workers stays online until the
+    last one lets go, and the users of a worker that died expire on their
+    own. The snapshot of a new worker reads the same record as the others.
+    """
+
+    def __init__(self, url, ttl=None, prefix='chat:presence:'):
+        import redis.asyncio
+
+        super().__init__(ttl)
+        self.prefix = prefix
+        self.process = uuid.uuid4().hex
+        self._redis = redis.asyncio.Redis.from_url(url)
+        self._beat = self._redis.register_script(BEAT_SCRIPT)
+        self._leave = self._redis.register_script(LEAVE_SCRIPT)
+        self._expire = self._redis.register_script(EXPIRE_SCRIPT)
+
+    def _keys(self, user_id):
+        return [f'{self.prefix}user:{user_id}', f'{self.prefix}online']
+
+    async def is_online(self, user_id):
+        score = await self._redis.zscore(f'{self.prefix}online', user_id)
+        return score is not None and score > time.time()
+
+    async def online_users(self):
+        user_ids = await self._redis.zrangebyscore(f'{self.prefix}online', f'({time.time()}', '+inf')
+        return {int(user_id) for user_id in user_ids}
+
+    async def disconnect(self, user_id):
+        count = self._connections.get(user_id, 0) - 1
+        if count > 0:
+            self._connections[user_id] = count
+            return False
+        self._connections.pop(user_id, None)
+        return bool(await self._leave(keys=self._keys(user_id), args=[self.process, time.time(), user_id]))
+
+    async def heartbeat(self, user_id):
+        return bool(await self._beat(keys=self._keys(user_id), args=[self.process, time.time(), self.ttl, user_id]))
+
+    async def expire(self):
+        expired = await self._expire(keys=[f'{self.prefix}online'], args=[time.time()])
+        return [int(user_id) for user_id in expired]
+
+
+def get_presence():
+    """
+    Presence registry shared by the workers when CHAT_PRESENCE_REDIS_URL is
+    set, per process otherwise.
+    """
+    if settings.CHAT_PRESENCE_REDIS_URL:
+        return RedisPresenceRegistry(settings.CHAT_PRESENCE_REDIS_URL)
+    return PresenceRegistry()
+
+
+presence = get_presence()
+
+_reapers = {}
+
+
+def start_reaper(channel_layer):
+    """
+    Start (once per event loop) the task that marks silent users offline.
+    """
+    loop = asyncio.get_running_loop()
+    task = _reapers.get(loop)
+    if task is None or task.done():
+        _reapers.clear()
+        _reapers[loop] = loop.create_task(_reap(channel_layer))
+
+
+async def _reap(channel_layer):
+    while True:
+        await asyncio.sleep(presence.ttl / 2)
+        for user_id in await presence.expire():
+            await channel_layer.group_send(USER_LIST_GROUP, presence_event(user_id, False))
+
+
+def presence_event(user_id, online):
+    """
+    'user X is online/offline' delta broadcast on the user list group.
+    """
+    status = 'online' if online else 'offline'
+    return group_event(f'user_{status}', {'presence': {'user_id': user_id, 'status': status}}, user_id=user_id)
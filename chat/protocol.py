@@ -0,0 +1,173 @@
+"""
+WEBSOCKET WIRE PROTOCOLS (JSON / MSGPACK)
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import json
+
+import msgpack
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+
+from .blocking import blocking_monitor
+from .metrics import connections_open, frames_received, handler_scope, registry
+from .outbound import COALESCE, RELIABLE, OutboundQueue, find_flow_control
+from .ratelimit import TokenBucket, user_rate_limiter
+
+
+# Clients asking for this subprotocol exchange msgpack binary frames,
+# the others JSON text frames
+MSGPACK_SUBPROTOCOL = 'chat.msgpack'
+
+# Close code sent to a client too slow to keep up with its frames
+SLOW_CLIENT_CLOSE_CODE = 4008
+
+# Close code sent by a worker that is restarting or stopping: reconnect (see server.py)
+SERVICE_RESTART_CLOSE_CODE = 4012
+
+
+def encode_frame(payload):
+    """
+    Serialize a payload once for every protocol. Broadcast events carry the
+    result as their 'frame' so each socket of the group only picks the
+    encoding it speaks instead of serializing the payload again.
+    """
+    return {
+        'json': json.dumps(payload),
+        'msgpack': msgpack.packb(payload, use_bin_type=True),
+    }
+
+
+def group_event(event_type, payload, **extra):
+    """
+    Channel layer event of type ``event_type`` carrying the encoded payload.
+    """
+    return dict(extra, type=event_type, frame=encode_frame(payload))
+
+
+class ProtocolConsumer(AsyncWebsocketConsumer):
+    """
+    Base consumer speaking JSON text frames or, when negotiated with the
+    ``chat.msgpack`` subprotocol, msgpack binary frames. Subclasses implement
+    ``receive_payload``, or list their typed client events in
+    ``client_events``, and send with ``send_payload`` / ``send_frame``.
+
+    Once accepted, frames go through a bounded outbound queue (see
+    outbound.py); the ``policy`` of a frame says what happens to it when the
+    client falls behind. The queue knows the client is behind from the flow
+    control of the connection's transport (see outbound.find_flow_control).
+
+    The frames of a ``rate_limited`` consumer take a token from the bucket
+    of the connection, then from the bucket of its user (see ratelimit.py).
+    """
+
+    binary = False
+    outbound = None
+    rate_limited = False
+    rate_limit = None
+    # Event type -> handler(self, data), see receive_payload
+    client_events = {}
+
+    async def accept(self, subprotocol=None):
+        if subprotocol is None and MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', ()):
+            subprotocol = MSGPACK_SUBPROTOCOL
+        self.binary = subprotocol == MSGPACK_SUBPROTOCOL
+        await super().accept(subprotocol)
+        # Tells when the client reads slower than we write (see outbound.py)
+        flow_control = find_flow_control(self.scope)
+        self.outbound = OutboundQueue(self.base_send, flow_control=flow_control)
+        if self.rate_limited:
+            self.rate_limit = TokenBucket(settings.CHAT_RATE_LIMIT_CONNECTION_RATE, settings.CHAT_RATE_LIMIT_CONNECTION_BURST)
+        if registry.enabled:
+            connections_open.inc(type(self).__name__)
+
+    async def websocket_disconnect(self, message):
+        if self.outbound is not None:
+            self.outbound.close()
+            if registry.enabled:
+                connections_open.dec(type(self).__name__)
+        await super().websocket_disconnect(message)
+
+    async def dispatch(self, message):
+        # Every handler (connect, receive, group events...) is timed by the
+        # blocking detector (see blocking.py) and the metrics (see metrics.py)
+        consumer = type(self).__name__
+        with handler_scope(consumer, message['type']):
+            await blocking_monitor.watch(super().dispatch(message), f'{consumer}.{message["type"]}')
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if registry.enabled:
+            frames_received.inc(type(self).__name__)
+        # Oversized and excess frames are refused before they are parsed
+        size = len(bytes_data) if bytes_data is not None else len(text_data or '')
+        if size > settings.CHAT_MAX_FRAME_SIZE:
+            await self.send_throttled('size')
+            return
+        retry_after = await self.throttle()
+        if retry_after:
+            await self.send_throttled('rate', retry_after)
+            return
+        try:
+            if bytes_data is not None:
+                payload = msgpack.unpackb(bytes_data, raw=False)
+            else:
+                payload = json.loads(text_data)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError):
+            # The socket stays open, the client gets to know what was wrong
+            await self.send_payload({'error': 'malformed frame'})
+            return
+        if not isinstance(payload, dict):
+            # Every event is an object: {'type': ..., ...}
+            await self.send_payload({'error': 'an event must be an object'})
+            return
+        await self.receive_payload(payload)
+
+    async def throttle(self):
+        """
+        Seconds the client has to wait before this frame is accepted, 0 to
+        accept it now. No limit unless the consumer is ``rate_limited``.
+        """
+        if self.rate_limit is None:
+            return 0
+        return self.rate_limit.take() or await user_rate_limiter.take(f"user:{self.scope['user'].id}")
+
+    async def send_throttled(self, reason, retry_after=0):
+        # The socket stays open; a flooding client gets one pending notice, not one per frame
+        await self.send_payload({
+            'throttled': {
+                'reason': reason,
+                'retry_after': round(retry_after, 3),
+                'max_size': settings.CHAT_MAX_FRAME_SIZE,
+            },
+        }, COALESCE, 'throttled')
+
+    # Frames sent by the client are typed events: {'type': 'message', ...}.
+    # Frames without a type are read as before: {'command': 'history', ...}
+    # runs a command and {'message': ...} sends a chat message.
+    async def receive_payload(self, data):
+        event_type = data.get('type') or data.get('command') or 'message'
+        handler = self.client_events.get(event_type)
+        if handler is None:
+            await self.send_payload({'error': f'unknown event type {event_type!r}'})
+            return
+        await handler(self, data)
+
+    async def send_payload(self, payload, policy=RELIABLE, key=None):
+        if self.binary:
+            await self.queue_frame({'type': 'websocket.send', 'bytes': msgpack.packb(payload, use_bin_type=True)}, policy, key)
+        else:
+            await self.queue_frame({'type': 'websocket.send', 'text': json.dumps(payload)}, policy, key)
+
+    async def send_frame(self, frame, policy=RELIABLE, key=None):
+        """
+        Send a payload already encoded by ``encode_frame``.
+        """
+        if self.binary:
+            await self.queue_frame({'type': 'websocket.send', 'bytes': frame['msgpack']}, policy, key)
+        else:
+            await self.queue_frame({'type': 'websocket.send', 'text': frame['json']}, policy, key)
+
+    async def queue_frame(self, message, policy=RELIABLE, key=None):
+        if self.outbound is None:
+            await self.base_send(message)
+        elif not self.outbound.put(message, policy, key):
+            await self.close(code=SLOW_CLIENT_CLOSE_CODE)
@@ -0,0 +1,117 @@
+"""
+RATE LIMITING (TOKEN BUCKETS)
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class TokenBucket:
+    """
+    ``burst`` tokens, refilled at ``rate`` tokens per second. Each frame
+    takes one; a client can send ``burst`` frames at once, then ``rate`` per
+    second.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        """
+        Take a token. Returns 0 when there was one, otherwise the number of
+        seconds until there is one.
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + max(0, now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class LocalRateLimiter:
+    """
+    Token buckets kept in the memory of the process, one per key, for at
+    most ``max_keys`` keys (the least recently used are forgotten, which
+    gives them a full bucket again).
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def take(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.take()
+
+
+# Refill and take in one round trip, atomically: KEYS[1] bucket,
+# ARGV rate, burst, now (seconds). Returns the wait in milliseconds.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return wait
+"""
+
+
+class RedisRateLimiter:
+    """
+    Token buckets kept in Redis, shared by every worker process.
+    """
+
+    def __init__(self, url, rate, burst, prefix='chat:ratelimit:'):
+        import redis.asyncio
+
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self._redis = redis.asyncio.Redis.from_url(url)
+        self._script = self._redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def take(self, key):
+        wait_ms = await self._script(keys=[self.prefix + key], args=[self.rate, self.burst, time.time()])
+        return int(wait_ms) / 1000
+
+
+def get_user_rate_limiter():
+    """
+    Limiter of the frames of a user over all their connections: shared by
+    the workers when CHAT_RATE_LIMIT_REDIS_URL is set, per process otherwise.
+    """
+    rate, burst = settings.CHAT_RATE_LIMIT_USER_RATE, settings.CHAT_RATE_LIMIT_USER_BURST
+    if settings.CHAT_RATE_LIMIT_REDIS_URL:
+        return RedisRateLimiter(settings.CHAT_RATE_LIMIT_REDIS_URL, rate, burst)
+    return LocalRateLimiter(rate, burst)
+
+
+user_rate_limiter = get_user_rate_limiter()
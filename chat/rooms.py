@@ -0,0 +1,130 @@
+"""
+ROOMS: MEMBERSHIP CACHE, HISTORY AND CATCH-UP
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import asyncio
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import Membership, RoomMessage
+from .routers import read_from_replica
+
+
+ROOM_MESSAGE_FIELDS = ('id', 'room_id', 'sender_id', 'content', 'timestamp', 'seq')
+
+
+class MembershipCache:
+    """
+    User ids of the members of the most recently used rooms, shared by the
+    consumers of the process. A room's members are loaded with one query the
+    first time they are needed and kept until a membership of the room
+    changes (see signals.py). The sockets of a room that miss at once, right
+    after a change, wait for the same query.
+    """
+
+    def __init__(self, max_rooms=None):
+        self.max_rooms = max_rooms or settings.CHAT_MEMBERSHIP_CACHE_SIZE
+        self._members = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}  # room id -> task loading its members
+
+    def __len__(self):
+        return len(self._members)
+
+    def get(self, room_id):
+        with self._lock:
+            members = self._members.get(room_id)
+            if members is not None:
+                self._members.move_to_end(room_id)
+            return members
+
+    def add(self, room_id, members):
+        members = frozenset(members)
+        with self._lock:
+            self._members[room_id] = members
+            self._members.move_to_end(room_id)
+            while len(self._members) > self.max_rooms:
+                self._members.popitem(last=False)
+        return members
+
+    def invalidate(self, room_id):
+        with self._lock:
+            self._members.pop(room_id, None)
+            self._loading.pop(room_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._members.clear()
+            self._loading.clear()
+
+    def _queryset(self, room_id):
+        return Membership.objects.filter(room_id=room_id).values_list('profile__user_id', flat=True)
+
+    def members(self, room_id):
+        members = self.get(room_id)
+        if members is None:
+            members = self.add(room_id, self._queryset(room_id))
+        return members
+
+    async def amembers(self, room_id):
+        # A cache hit does not need to leave the event loop
+        members = self.get(room_id)
+        if members is not None:
+            return members
+        loading = self._loading.get(room_id)
+        if loading is None or loading.get_loop() is not asyncio.get_running_loop():
+            loading = self._loading[room_id] = asyncio.ensure_future(self._aload(room_id))
+        return await asyncio.shield(loading)
+
+    async def _aload(self, room_id):
+        try:
+            members = frozenset([user_id async for user_id in self._queryset(room_id)])
+        finally:
+            # Not kept when the room changed while it was loading
+            current = self._loading.get(room_id) is asyncio.current_task()
+            if current:
+                del self._loading[room_id]
+        return self.add(room_id, members) if current else members
+
+    async def ais_member(self, room_id, user_id):
+        return user_id in await self.amembers(room_id)
+
+
+memberships = MembershipCache()
+
+
+def _serialize(rows):
+    for row in rows:
+        row['timestamp'] = row['timestamp'].isoformat()
+    return rows
+
+
+def get_room_page(room_id, before=None, limit=None):
+    """
+    One page of the messages of a room, newest first, before the sequence
+    number ``before``, and the ``before`` of the next (older) page.
+    """
+    from .history import get_page_size
+
+    limit = get_page_size(limit)
+    queryset = RoomMessage.objects.filter(room_id=room_id)
+    if before is not None:
+        queryset = queryset.filter(seq__lt=int(before))
+    with read_from_replica():
+        rows = list(queryset.order_by('-seq').values(*ROOM_MESSAGE_FIELDS)[:limit + 1])
+    page = rows[:limit]
+    return {
+        'messages': _serialize(page),
+        'next_before': page[-1]['seq'] if len(rows) > limit else None,
+    }
+
+
+def room_gap(room_id, after, limit):
+    """
+    Up to ``limit`` messages of the room numbered after ``after``, in order.
+    """
+    return _serialize(list(
+        RoomMessage.objects.filter(room_id=room_id, seq__gt=after).order_by('seq').values(*ROOM_MESSAGE_FIELDS)[:limit]
+    ))
@@ -0,0 +1,58 @@
+"""
+DATABASE ROUTER (PRIMARY AND READ REPLICAS)
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import contextvars
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+# Replica chosen for the reads of the current context, None for the primary.
+# Copied by sync_to_async into the threads running the queries.
+replica_alias = contextvars.ContextVar('replica_alias', default=None)
+
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS]
+
+
+@contextmanager
+def read_from_replica():
+    """
+    Reads in this block go to a replica, the same one for all of them so
+    that they see the same state. Only for reads that may lag behind the
+    latest writes (history pages, user lists): without replicas, or inside
+    a transaction, they stay on the primary.
+    """
+    aliases = replica_aliases()
+    token = replica_alias.set(random.choice(aliases) if aliases else None)
+    try:
+        yield
+    finally:
+        replica_alias.reset(token)
+
+
+class PrimaryReplicaRouter:
+    """
+    Writes, and reads by default, go to the primary. A replica may lag
+    behind it, so reading from one is opt in (see ``read_from_replica``).
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = replica_alias.get()
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,223 @@
+"""
+FULL-TEXT MESSAGE SEARCH
+AUTHOR: DONALD PROGRAMMEUR
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+
+SEARCH_FIELDS = ('id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'is_read')
+ORDERS = ('relevance', 'recent')
+
+MESSAGE_TABLE = 'chat_message'
+FTS_TABLE = 'chat_message_fts'
+GIN_INDEX = 'chat_message_search_idx'
+
+
+class InvalidSearch(ValueError):
+    pass
+
+
+def search_terms(query):
+    """
+    Words of a user query. Operators and quotes are dropped so that any
+    input is a valid query for every backend; anything but text has none.
+    """
+    if not isinstance(query, str):
+        return []
+    return re.findall(r'\w+', query)[:settings.CHAT_SEARCH_MAX_TERMS]
+
+
+class SQLiteSearchIndex:
+    """
+    FTS5 inverted index over the message contents (external content table:
+    the text itself stays in chat_message). Rows are added in the transaction
+    that inserts the messages and removed when messages are archived.
+    """
+
+    def install(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"content, content='{MESSAGE_TABLE}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        )
+
+    def add(self, cursor, messages):
+        cursor.executemany(
+            f'INSERT INTO {FTS_TABLE} (rowid, content) VALUES (%s, %s)',
+            [(message.pk, message.content) for message in messages],
+        )
+
+    def remove(self, cursor, rows):
+        # An external content index needs the indexed text to forget a row
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, content) VALUES ('delete', %s, %s)",
+            [(row['id'], row['content']) for row in rows],
+        )
+
+    def rebuild(self, cursor):
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+
+    def match(self, cursor, terms, scope, order, limit, offset):
+        scope_sql, scope_params = scope
+        # Every term is quoted (no FTS5 syntax from users), the last one is a prefix
+        expression = ' '.join(f'"{term}"' for term in terms[:-1]) + f' "{terms[-1]}"*'
+        rank = f'bm25({FTS_TABLE}), ' if order == 'relevance' else ''
+        cursor.execute(
+            f'SELECT m.id FROM {FTS_TABLE} JOIN {MESSAGE_TABLE} m ON m.id = {FTS_TABLE}.rowid '
+            f'WHERE {FTS_TABLE} MATCH %s AND {scope_sql} '
+            f'ORDER BY {rank}m.timestamp DESC, m.id DESC LIMIT %s OFFSET %s',
+            [expression, *scope_params, limit, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearchIndex:
+    """
+    GIN index on to_tsvector(content). Postgres keeps it up to date on every
+    insert and delete, there is nothing to add or remove by hand.
+    """
+
+    def install(self, cursor):
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {GIN_INDEX} ON {MESSAGE_TABLE} '
+            f'USING GIN (to_tsvector(%s::regconfig, content))',
+            [settings.CHAT_SEARCH_CONFIG],
+        )
+
+    def add(self, cursor, messages):
+        pass
+
+    def remove(self, cursor, rows):
+        pass
+
+    def rebuild(self, cursor):
+        cursor.execute(f'REINDEX INDEX {GIN_INDEX}')
+
+    def match(self, cursor, terms, scope, order, limit, offset):
+        scope_sql, scope_params = scope
+        expression = ' & '.join(terms[:-1] + [f'{terms[-1]}:*'])
+        vector = 'to_tsvector(%s::regconfig, m.content)'
+        query = 'to_tsquery(%s::regconfig, %s)'
+        config = settings.CHAT_SEARCH_CONFIG
+        rank, rank_params = '', []
+        if order == 'relevance':
+            rank, rank_params = f'ts_rank({vector}, {query}) DESC, ', [config, config, expression]
+        cursor.execute(
+            f'SELECT m.id FROM {MESSAGE_TABLE} m WHERE {vector} @@ {query} AND {scope_sql} '
+            f'ORDER BY {rank}m.timestamp DESC, m.id DESC LIMIT %s OFFSET %s',
+            [config, config, expression, *scope_params, *rank_params, limit, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class ScanSearchIndex:
+    """
+    Other databases: no index, the messages of the scope are scanned.
+    """
+
+    def install(self, cursor):
+        pass
+
+    def add(self, cursor, messages):
+        pass
+
+    def remove(self, cursor, rows):
+        pass
+
+    def rebuild(self, cursor):
+        pass
+
+    def match(self, cursor, terms, scope, order, limit, offset):
+        return None
+
+
+def get_search_index():
+    if connection.vendor == 'sqlite':
+        return SQLiteSearchIndex()
+    if connection.vendor == 'postgresql':
+        return PostgresSearchIndex()
+    return ScanSearchIndex()
+
+
+def install_search_index():
+    with connection.cursor() as cursor:
+        get_search_index().install(cursor)
+
+
+def index_messages(messages):
+    """
+    Add newly inserted messages to the index (see MessageManager.after_create).
+    """
+    with connection.cursor() as cursor:
+        get_search_index().add(cursor, messages)
+
+
+def unindex_messages(rows):
+    """
+    Remove messages, given as dicts with their id and content, from the index.
+    """
+    with connection.cursor() as cursor:
+        get_search_index().remove(cursor, rows)
+
+
+def rebuild_search_index():
+    with connection.cursor() as cursor:
+        get_search_index().rebuild(cursor)
+
+
+def search_messages(profile_id, query, other_profile_id=None, order='relevance', page=1, limit=None):
+    """
+    Messages sent or received by ``profile_id`` matching every word of
+    ``query`` (the last one as a prefix), only those exchanged with
+    ``other_profile_id`` when given. Ordered by relevance then time, or by
+    time only with ``order='recent'``; ``page`` counts from 1.
+    """
+    from .history import get_page_size
+    from .models import Message
+
+    if order not in ORDERS:
+        raise InvalidSearch(order)
+    terms = search_terms(query)
+    if not terms:
+        raise InvalidSearch(query)
+    limit = get_page_size(limit)
+    try:
+        page = int(page)
+    except TypeError:
+        raise InvalidSearch(page)
+    if page < 1:
+        raise InvalidSearch(page)
+    offset = (page - 1) * limit
+
+    if other_profile_id is None:
+        scope = Q(sender_id=profile_id) | Q(receiver_id=profile_id)
+        raw_scope = ('(m.sender_id = %s OR m.receiver_id = %s)', [profile_id, profile_id])
+    else:
+        scope = Q(sender_id=profile_id, receiver_id=other_profile_id) | Q(sender_id=other_profile_id, receiver_id=profile_id)
+        raw_scope = (
+            '((m.sender_id = %s AND m.receiver_id = %s) OR (m.sender_id = %s AND m.receiver_id = %s))',
+            [profile_id, other_profile_id, other_profile_id, profile_id],
+        )
+
+    with connection.cursor() as cursor:
+        ids = get_search_index().match(cursor, terms, raw_scope, order, limit + 1, offset)
+    if ids is None:
+        queryset = Message.objects.filter(scope)
+        for term in terms:
+            queryset = queryset.filter(content__icontains=term)
+        rows = list(queryset.order_by('-timestamp', '-id').values(*SEARCH_FIELDS)[offset:offset + limit + 1])
+    else:
+        # Rows of the matched ids, in the order of the index
+        by_id = {row['id']: row for row in Message.objects.filter(id__in=ids).values(*SEARCH_FIELDS)}
+        rows = [by_id[message_id] for message_id in ids if message_id in by_id]
+
+    results = rows[:limit]
+    for row in results:
+        row['timestamp'] = row['timestamp'].isoformat()
+    return {
+        'results': results,
+        'next_page': page + 1 if len(rows) > limit else None,
+    }
@@ -0,0 +1,129 @@
+"""
+MULTI-PROCESS ASGI SERVER: WORKER
+AUTHOR: DONALD PROGRAMMEUR
+
+Only imported by the worker processes started by runworkers (see
+workers.py): importing daphne.server installs the asyncio Twisted reactor.
+"""
+import asyncio
+import os
+import signal
+import socket
+import time
+
+from daphne.server import Server  # isort:skip
+from channels.layers import get_channel_layer
+from django.conf import settings
+from twisted.internet import reactor
+
+from account.last_online import last_online_writer
+from .db import run_sync
+from .invalidation import listen
+from .outbound import FLOW_CONTROL_EXTENSION, TransportFlowControl
+from .persistence import message_queue
+from .protocol import SERVICE_RESTART_CLOSE_CODE
+
+
+def reuseport_socket(host, port, backlog=1024):
+    """
+    IPv4 listening socket on host:port that the other workers bind too
+    (Twisted's "fd:" endpoint strings can only adopt IPv4 sockets).
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError('SO_REUSEPORT is not supported on this platform')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class DrainingServer(Server):
+    """
+    Daphne server that, on ``drain``, stops accepting connections (the other
+    workers still listen on the port), closes its WebSockets with code 4012 so
+    the clients reconnect to another worker, waits for the consumers to
+    finish, writes what the write-behind queues still hold, then stops.
+
+    Each WebSocket gets a TransportFlowControl registered on its transport
+    and passed to the consumer in the scope, so its outbound queue stops
+    writing while the client does not read (see outbound.py).
+    """
+
+    def __init__(self, application, ready_fd=None, drain_timeout=None, **kwargs):
+        super().__init__(application, **kwargs)
+        self.ready_fd = ready_fd
+        self.drain_timeout = drain_timeout or settings.CHAT_WORKER_DRAIN_TIMEOUT
+        self.ports = []
+        self.draining = False
+        self.invalidations = None
+
+    def run(self):
+        reactor.callWhenRunning(self.start_invalidation_listener)
+        super().run()
+
+    def start_invalidation_listener(self):
+        # The caches of this process learn about the writes of the other workers
+        self.invalidations = asyncio.ensure_future(listen(get_channel_layer()))
+
+    def create_application(self, protocol, scope):
+        if scope.get('type') == 'websocket':
+            scope.setdefault('extensions', {})[FLOW_CONTROL_EXTENSION] = self.register_flow_control(protocol)
+        return super().create_application(protocol, scope)
+
+    def register_flow_control(self, protocol):
+        # The HTTP channel of the upgrade request is still the producer of the
+        # transport: ours takes its place and relays to it
+        return TransportFlowControl.register(protocol.transport)
+
+    def listen_success(self, port):
+        super().listen_success(port)
+        self.ports.append(port)
+        if self.ready_fd is not None:
+            # Tell the supervisor this worker takes connections
+            os.write(self.ready_fd, b'1')
+            os.close(self.ready_fd)
+            self.ready_fd = None
+
+    def drain(self):
+        if self.draining:
+            return
+        self.draining = True
+        for port in self.ports:
+            port.stopListening()
+        for protocol in list(self.connections):
+            if hasattr(protocol, 'serverClose'):
+                protocol.serverClose(code=SERVICE_RESTART_CLOSE_CODE)
+        asyncio.ensure_future(self._finish_drain())
+
+    async def _finish_drain(self):
+        # Daphne forgets a connection once it is closed and its consumer is done
+        deadline = time.monotonic() + self.drain_timeout
+        while self.connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.invalidations is not None:
+            self.invalidations.cancel()
+        await message_queue.flush()
+        await run_sync(last_online_writer.flush)
+        reactor.stop()
+
+
+def run_worker(application, host, port, ready_fd=None, drain_timeout=None, verbosity=1):
+    """
+    Serve ``application`` on host:port in this process until SIGTERM or
+    SIGINT, then drain.
+    """
+    sock = reuseport_socket(host, port)
+    server = DrainingServer(
+        application,
+        ready_fd=ready_fd,
+        drain_timeout=drain_timeout,
+        endpoints=[f'fd:fileno={sock.fileno()}'],
+        signal_handlers=False,
+        verbosity=verbosity,
+    )
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: reactor.callFromThread(server.drain))
+    server.run()
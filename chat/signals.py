@@ -0,0 +1,72 @@
+"""
+SIGNAL HANDLERS
+AUTHOR: DONALD PROGRAMMEUR
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from account.avatars import avatar_urls_changed
+from account.models import Profile
+from .invalidation import invalidate
+from .models import Membership, Room
+from .search import install_search_index
+
+
+@receiver([post_save, post_delete], sender=Profile)
+def invalidate_profile_identity(sender, instance, **kwargs):
+    invalidate('identity', instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=get_user_model())
+def invalidate_user_identity(sender, instance, **kwargs):
+    invalidate('identity', instance.pk)
+
+
+@receiver(avatar_urls_changed)
+def invalidate_avatar(sender, user_id, **kwargs):
+    # The avatar URLs cached by the other processes too (and the identities)
+    invalidate('avatar', user_id)
+
+
+@receiver(post_migrate)
+def create_search_index(sender, **kwargs):
+    # The full-text index is not a model: created once the chat tables exist
+    if sender.name == 'chat':
+        install_search_index()
+
+
+@receiver([post_save, post_delete], sender=Membership)
+def invalidate_room_members(sender, instance, **kwargs):
+    invalidate('room', instance.room_id)
+
+
+@receiver(post_delete, sender=Room)
+def forget_room_members(sender, instance, **kwargs):
+    invalidate('room', instance.pk)
+
+
+@receiver(m2m_changed, sender=Room.members.through)
+def invalidate_changed_room_members(sender, instance, action, reverse, pk_set, **kwargs):
+    # room.members.add(...) and profile.rooms.add(...) do not send post_save
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate('room', instance.pk)
+    elif pk_set is None:
+        invalidate('room')
+    else:
+        for room_id in pk_set:
+            invalidate('room', room_id)
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    # Write-ahead log: readers no longer wait for the writer, and a commit
+    # appends to the log instead of rewriting pages (synced at checkpoints)
+    if connection.vendor == 'sqlite' and settings.SQLITE_WAL:
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
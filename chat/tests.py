@@ -1,3 +1,1168 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+from datetime import timedelta
+from functools import partial
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from PIL import Image
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connection
+from django.db import OperationalError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from account.last_online import last_online_writer
+from account.models import Profile
+from django_chat.routing import websocket_urlpatterns
+from .archive import archive_messages, archive_path, read_archived_page
+from .attachments import (
+    UploadOffsetMismatch, create_upload, expire_uploads, full_path, part_path, readable_attachment, sendable_attachment,
+    upload_offset, write_chunk,
+)
+from .consumers import REMOVED_FROM_ROOM_CLOSE_CODE, send_catch_up
+from .conversations import get_conversation_list
+from .ephemeral import EphemeralCoalescer
+from .groups import private_room_name
+from .history import InvalidCursor, decode_cursor, encode_cursor, get_conversation_page
+from .identity import Identity, identities
+from .layers import HashRing
+from .models import ArchivedMonth, Attachment, Membership, Message, Room, UnreadCounter
+from .persistence import MessageWriteBehindQueue
+from .presence import PresenceRegistry
+from .outbound import (
+    COALESCE, DROPPABLE, FLOW_CONTROL_EXTENSION, RELIABLE, FlowControlMiddleware, OutboundQueue,
+    TransportFlowControl, outbound_stats,
+)
+from .protocol import ProtocolConsumer
+from .ratelimit import LocalRateLimiter, TokenBucket
+from .routers import PrimaryReplicaRouter
+from .rooms import memberships
+from .search import FTS_TABLE, InvalidSearch, search_messages
+from .thumbnails import make_thumbnail
+
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def frame(text):
+    return {'type': 'websocket.send', 'text': text}
+
+
+async def settle():
+    # Let the writer task run until it waits again
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+class SlowClientTests(SimpleTestCase):
+    """
+    A client that does not read fills its transport, which pauses the
+    outbound queue: the frames wait in the queue and its policies apply.
+    """
+
+    def setUp(self):
+        self.sent = []
+        self.flow_control = TransportFlowControl()
+        outbound_stats.reset()
+
+    def make_queue(self, max_size=3, disconnect_after=6):
+        async def send(message):
+            self.sent.append(message['text'])
+
+        return OutboundQueue(send, max_size=max_size, disconnect_after=disconnect_after, flow_control=self.flow_control)
+
+    async def test_writes_until_the_transport_is_full(self):
+        queue = self.make_queue()
+        queue.put(frame('a'))
+        await queue.drain()
+        self.assertEqual(self.sent, ['a'])
+
+        self.flow_control.pauseProducing()
+        queue.put(frame('b'))
+        await settle()
+        self.assertEqual(self.sent, ['a'])
+        self.assertEqual(len(queue), 1)
+
+        self.flow_control.resumeProducing()
+        await queue.drain()
+        self.assertEqual(self.sent, ['a', 'b'])
+        self.assertEqual(len(queue), 0)
+        queue.close()
+
+    async def test_coalesces_while_paused(self):
+        self.flow_control.pauseProducing()
+        queue = self.make_queue()
+        for state in ('online', 'offline', 'online'):
+            queue.put(frame(f'u1 {state}'), COALESCE, 'presence:1')
+        queue.put(frame('u2 online'), COALESCE, 'presence:2')
+        await settle()
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(outbound_stats.snapshot()['coalesced'], 2)
+
+        self.flow_control.resumeProducing()
+        await queue.drain()
+        self.assertEqual(self.sent, ['u1 online', 'u2 online'])
+        queue.close()
+
+    async def test_drops_the_oldest_droppable_frame_when_full(self):
+        self.flow_control.pauseProducing()
+        queue = self.make_queue(max_size=3)
+        queue.put(frame('read 1'), DROPPABLE)
+        queue.put(frame('message 1'))
+        queue.put(frame('read 2'), DROPPABLE)
+        queue.put(frame('message 2'))
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(outbound_stats.snapshot()['dropped'], 1)
+
+        self.flow_control.resumeProducing()
+        await queue.drain()
+        self.assertEqual(self.sent, ['message 1', 'read 2', 'message 2'])
+        queue.close()
+
+    async def test_never_drops_reliable_frames(self):
+        self.flow_control.pauseProducing()
+        queue = self.make_queue(max_size=2, disconnect_after=10)
+        for index in range(5):
+            self.assertTrue(queue.put(frame(f'message {index}')))
+        self.assertEqual(len(queue), 5)
+        self.assertEqual(outbound_stats.snapshot().get('dropped', 0), 0)
+
+        self.flow_control.resumeProducing()
+        await queue.drain()
+        self.assertEqual(self.sent, [f'message {index}' for index in range(5)])
+        queue.close()
+
+    async def test_disconnects_a_client_that_stopped_reading(self):
+        self.flow_control.pauseProducing()
+        queue = self.make_queue(max_size=3, disconnect_after=6)
+        results = [queue.put(frame(f'message {index}'), RELIABLE) for index in range(6)]
+        self.assertEqual(results, [True] * 5 + [False])
+        self.assertEqual(outbound_stats.snapshot()['overflow_disconnects'], 1)
+        # Closed: nothing is written anymore
+        self.assertEqual(len(queue), 0)
+        self.flow_control.resumeProducing()
+        await settle()
+        self.assertEqual(self.sent, [])
+
+    async def test_lost_connection_does_not_hold_the_writer(self):
+        self.flow_control.pauseProducing()
+        queue = self.make_queue()
+        queue.put(frame('a'))
+        self.flow_control.stopProducing()
+        await asyncio.wait_for(queue.drain(), 1)
+        queue.close()
+
+    def test_relays_to_the_producer_it_replaces(self):
+        calls = []
+
+        class HTTPChannel:
+            def pauseProducing(self):
+                calls.append('pause')
+
+            def resumeProducing(self):
+                calls.append('resume')
+
+            def stopProducing(self):
+                calls.append('stop')
+
+        flow_control = TransportFlowControl(HTTPChannel())
+        flow_control.pauseProducing()
+        self.assertFalse(flow_control.writable.is_set())
+        flow_control.resumeProducing()
+        self.assertTrue(flow_control.writable.is_set())
+        flow_control.stopProducing()
+        self.assertEqual(calls, ['pause', 'resume', 'stop'])
+
+
+class DaphneTransport:
+    # The producer registration of a Twisted transport
+    def __init__(self, producer):
+        self.producer = producer
+
+    def registerProducer(self, producer, streaming):
+        assert self.producer is None
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class DaphneServer:
+    def __init__(self):
+        self.sent = []
+
+    async def handle_reply(self, protocol, message):
+        self.sent.append(message)
+
+
+class DaphneProtocol:
+    def __init__(self, transport):
+        self.transport = transport
+
+
+class FlowControlMiddlewareTests(SimpleTestCase):
+    """
+    Under a stock Daphne server the middleware registers the flow control
+    on the transport behind Daphne's send.
+    """
+
+    async def call(self, scope, send):
+        scopes = []
+
+        async def inner(scope, receive, send):
+            scopes.append(scope)
+
+        await FlowControlMiddleware(inner)(scope, None, send)
+        return scopes[0]
+
+    async def test_registers_on_the_daphne_transport(self):
+        http_channel = TransportFlowControl()
+        transport = DaphneTransport(http_channel)
+        send = partial(DaphneServer().handle_reply, DaphneProtocol(transport))
+        scope = await self.call({'type': 'websocket', 'extensions': {}}, send)
+        flow_control = scope['extensions'][FLOW_CONTROL_EXTENSION]
+        self.assertIs(transport.producer, flow_control)
+        # The producer it replaced is still paused with it
+        transport.producer.pauseProducing()
+        self.assertFalse(http_channel.writable.is_set())
+
+    async def test_keeps_the_flow_control_of_the_server(self):
+        flow_control = TransportFlowControl()
+        transport = DaphneTransport(None)
+        send = partial(DaphneServer().handle_reply, DaphneProtocol(transport))
+        scope = {'type': 'websocket', 'extensions': {FLOW_CONTROL_EXTENSION: flow_control}}
+        scope = await self.call(scope, send)
+        self.assertIs(scope['extensions'][FLOW_CONTROL_EXTENSION], flow_control)
+        self.assertIsNone(transport.producer)
+
+    async def test_other_servers_get_none(self):
+        async def send(message):
+            pass
+
+        scope = await self.call({'type': 'websocket'}, send)
+        self.assertNotIn(FLOW_CONTROL_EXTENSION, scope.get('extensions') or {})
+
+
+class ThrottledConsumer(ProtocolConsumer):
+    # Refuses every frame, like a client over its rate limit
+    async def connect(self):
+        await self.accept()
+
+    async def throttle(self):
+        return 1.0
+
+    async def receive_payload(self, payload):
+        await self.send_payload({'echo': payload})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ThrottledFloodTests(SimpleTestCase):
+
+    async def test_flood_against_a_slow_client_gets_one_notice(self):
+        flow_control = TransportFlowControl()
+        communicator = WebsocketCommunicator(ThrottledConsumer.as_asgi(), '/ws/test/')
+        communicator.scope['extensions'] = {FLOW_CONTROL_EXTENSION: flow_control}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        flow_control.pauseProducing()
+        for index in range(20):
+            await communicator.send_json_to({'message': index})
+        self.assertTrue(await communicator.receive_nothing(0.2))
+
+        flow_control.resumeProducing()
+        notice = await communicator.receive_json_from()
+        self.assertEqual(notice['throttled']['reason'], 'rate')
+        self.assertTrue(await communicator.receive_nothing(0.2))
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class PrivateChatTestCase(TransactionTestCase):
+    """
+    Two users with a profile; the first one connects to their conversation.
+    """
+
+    def setUp(self):
+        # Ids are reused from one test to the next
+        identities.clear()
+        self.users = [User.objects.create_user(f'user{index}', password='x') for index in range(2)]
+        Profile.objects.bulk_create([Profile(user=user, gender='M') for user in self.users])
+
+    def tearDown(self):
+        # Written now, while the test database still exists
+        last_online_writer.flush()
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/private_chat/{self.users[1].id}/')
+        communicator.scope['user'] = self.users[0]
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+
+class MalformedEventTests(PrivateChatTestCase):
+    """
+    A malformed client event gets an error reply, the socket stays open.
+    """
+
+    async def assert_error_reply(self, communicator, event):
+        await communicator.send_json_to(event)
+        reply = await communicator.receive_json_from()
+        self.assertIn('error', reply)
+        # Still open: the next event is answered
+        await communicator.send_json_to({'type': 'ping', 'id': 1})
+        self.assertEqual(await communicator.receive_json_from(), {'pong': 1})
+
+    async def test_anonymous_user_is_refused(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/private_chat/{self.users[1].id}/')
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_not_an_object(self):
+        communicator = await self.connect()
+        await self.assert_error_reply(communicator, [1, 2])
+        await self.assert_error_reply(communicator, 'message')
+        await communicator.disconnect()
+
+    async def test_malformed_frame(self):
+        communicator = await self.connect()
+        for text in ('{"type": "read"', 'not json', '\x00'):
+            await communicator.send_to(text_data=text)
+            self.assertIn('error', await communicator.receive_json_from())
+        await communicator.send_json_to({'type': 'ping', 'id': 1})
+        self.assertEqual(await communicator.receive_json_from(), {'pong': 1})
+        await communicator.disconnect()
+
+    async def test_malformed_msgpack_frame(self):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/private_chat/{self.users[1].id}/', subprotocols=['chat.msgpack']
+        )
+        communicator.scope['user'] = self.users[0]
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        for data in (b'\xc1', b'\x81\xa4type', msgpack.packb({'type': 'ping'}) + b'\x01'):
+            await communicator.send_to(bytes_data=data)
+            self.assertIn('error', msgpack.unpackb(await communicator.receive_from()))
+        await communicator.send_to(bytes_data=msgpack.packb({'type': 'ping', 'id': 1}))
+        self.assertEqual(msgpack.unpackb(await communicator.receive_from()), {'pong': 1})
+        await communicator.disconnect()
+
+    async def test_history(self):
+        communicator = await self.connect()
+        await self.assert_error_reply(communicator, {'type': 'history', 'cursor': 5})
+        await self.assert_error_reply(communicator, {'type': 'history', 'cursor': 'abc'})
+        await self.assert_error_reply(communicator, {'type': 'history', 'limit': [1]})
+        await self.assert_error_reply(communicator, {'type': 'history', 'limit': {'a': 1}})
+        await communicator.disconnect()
+
+    async def test_catch_up(self):
+        communicator = await self.connect()
+        await self.assert_error_reply(communicator, {'type': 'catch_up', 'after': [1]})
+        await self.assert_error_reply(communicator, {'type': 'catch_up', 'after': 'abc'})
+        await self.assert_error_reply(communicator, {'type': 'catch_up', 'limit': {'a': 1}})
+        await communicator.disconnect()
+
+    async def test_search(self):
+        communicator = await self.connect()
+        await self.assert_error_reply(communicator, {'type': 'search', 'q': 5})
+        await self.assert_error_reply(communicator, {'type': 'search', 'q': ['hello']})
+        await self.assert_error_reply(communicator, {'type': 'search', 'q': 'hello', 'page': [1]})
+        await self.assert_error_reply(communicator, {'type': 'search', 'q': 'hello', 'order': 'random'})
+        await communicator.disconnect()
+
+    async def test_read(self):
+        communicator = await self.connect()
+        await self.assert_error_reply(communicator, {'type': 'read', 'up_to': 'abc'})
+        await self.assert_error_reply(communicator, {'type': 'read'})
+        await communicator.disconnect()
+
+    async def test_ack(self):
+        communicator = await self.connect()
+        await self.assert_error_reply(communicator, {'type': 'ack', 'up_to': 'abc'})
+        await self.assert_error_reply(communicator, {'type': 'ack', 'up_to': None})
+        await communicator.disconnect()
+
+    async def test_message(self):
+        communicator = await self.connect()
+        await self.assert_error_reply(communicator, {'type': 'message'})
+        await self.assert_error_reply(communicator, {'type': 'message', 'message': ['hello']})
+        await self.assert_error_reply(communicator, {'type': 'message', 'attachment_id': 'abc'})
+        await self.assert_error_reply(communicator, {'type': 'message', 'message': 'hello', 'attachment_id': [1]})
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class RoomConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        identities.clear()
+        memberships.clear()
+        self.users = [User.objects.create_user(f'user{index}', password='x') for index in range(2)]
+        profiles = Profile.objects.bulk_create([Profile(user=user, gender='M') for user in self.users])
+        self.room = Room.objects.create(name='room')
+        Membership.objects.bulk_create([Membership(room=self.room, profile=profile) for profile in profiles])
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/room/{self.room.id}/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_message_without_text(self):
+        communicator = await self.connect(self.users[0])
+        for event in ({'type': 'message'}, {'type': 'message', 'message': 5}):
+            await communicator.send_json_to(event)
+            self.assertIn('error', await communicator.receive_json_from())
+        await communicator.send_json_to({'type': 'message', 'message': 'hello'})
+        reply = await communicator.receive_json_from()
+        self.assertEqual(reply['room_message']['message'], 'hello')
+        await communicator.disconnect()
+
+    async def test_history_with_invalid_before(self):
+        communicator = await self.connect(self.users[0])
+        for before in ([1], {'seq': 1}, 'abc'):
+            await communicator.send_json_to({'type': 'history', 'before': before})
+            self.assertIn('error', await communicator.receive_json_from())
+        await communicator.send_json_to({'type': 'history'})
+        self.assertEqual((await communicator.receive_json_from())['history']['messages'], [])
+        await communicator.disconnect()
+
+    async def test_removed_member_stops_receiving(self):
+        sender = await self.connect(self.users[0])
+        removed = await self.connect(self.users[1])
+        await database_sync_to_async(Membership.objects.filter(profile__user=self.users[1]).delete)()
+
+        await sender.send_json_to({'type': 'message', 'message': 'members only'})
+        self.assertEqual((await sender.receive_json_from())['room_message']['message'], 'members only')
+        self.assertEqual(await removed.receive_output(), {'type': 'websocket.close', 'code': REMOVED_FROM_ROOM_CLOSE_CODE})
+
+        # Out of the group: the next messages do not reach the socket at all
+        await sender.send_json_to({'type': 'message', 'message': 'again'})
+        await sender.receive_json_from()
+        self.assertTrue(await removed.receive_nothing(0.2))
+        await sender.disconnect()
+        await removed.disconnect()
+
+
+class ExpireUploadsTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        attachment_dir = override_settings(CHAT_ATTACHMENT_DIR=directory.name)
+        attachment_dir.enable()
+        self.addCleanup(attachment_dir.disable)
+        user = User.objects.create_user('uploader', password='x')
+        self.profile = Profile.objects.create(user=user, gender='M')
+
+    def start_upload(self, idle_hours):
+        attachment = create_upload(self.profile.id, 'photo.jpg', 100)
+        started = timezone.now() - timedelta(hours=idle_hours)
+        Attachment.objects.filter(pk=attachment.pk).update(created_at=started)
+        os.utime(part_path(attachment), (started.timestamp(), started.timestamp()))
+        return attachment
+
+    def test_deletes_abandoned_uploads_with_their_part_file(self):
+        abandoned = self.start_upload(idle_hours=48)
+        recent = self.start_upload(idle_hours=1)
+        self.assertEqual(expire_uploads(timezone.now() - timedelta(hours=24)), 1)
+        self.assertFalse(Attachment.objects.filter(pk=abandoned.pk).exists())
+        self.assertFalse(os.path.exists(part_path(abandoned)))
+        self.assertTrue(os.path.exists(part_path(recent)))
+
+    def test_keeps_an_old_upload_still_receiving_bytes(self):
+        attachment = self.start_upload(idle_hours=48)
+        os.utime(part_path(attachment), (time.time(), time.time()))
+        self.assertEqual(expire_uploads(timezone.now() - timedelta(hours=24)), 0)
+        self.assertTrue(os.path.exists(part_path(attachment)))
+
+
+class UploadTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        attachment_dir = override_settings(CHAT_ATTACHMENT_DIR=self.directory.name)
+        attachment_dir.enable()
+        self.addCleanup(attachment_dir.disable)
+        user = User.objects.create_user('uploader', password='x')
+        self.profile = Profile.objects.create(user=user, gender='M')
+
+    def test_resumes_from_the_stored_offset(self):
+        attachment = create_upload(self.profile.id, 'notes.txt', 10, 'text/plain')
+        self.assertEqual(upload_offset(attachment), 0)
+        self.assertEqual(write_chunk(attachment, 0, BytesIO(b'hello')), 5)
+        self.assertEqual(upload_offset(attachment), 5)
+
+        # The connection broke after the server got 5 bytes: a retry from 3 is refused
+        with self.assertRaises(UploadOffsetMismatch) as raised:
+            write_chunk(attachment, 3, BytesIO(b'loworld'))
+        self.assertEqual(raised.exception.offset, 5)
+        self.assertEqual(upload_offset(attachment), 5)
+
+        # Bytes past the announced size are not kept
+        self.assertEqual(write_chunk(attachment, 5, BytesIO(b'world and more')), 10)
+        attachment.refresh_from_db()
+        self.assertIsNotNone(attachment.completed_at)
+        self.assertEqual(upload_offset(attachment), 10)
+        self.assertFalse(os.path.exists(part_path(attachment)))
+        with open(full_path(attachment.path), 'rb') as file:
+            self.assertEqual(file.read(), b'helloworld')
+        with self.assertRaises(UploadOffsetMismatch):
+            write_chunk(attachment, 10, BytesIO(b'!'))
+
+    def test_thumbnail_fits_the_size_and_keeps_the_ratio(self):
+        source = os.path.join(self.directory.name, 'photo.png')
+        target = os.path.join(self.directory.name, 'photo.thumb.jpg')
+        Image.new('RGBA', (400, 200), (255, 0, 0, 128)).save(source)
+        self.assertEqual(make_thumbnail(source, target, 100), (400, 200))
+        with Image.open(target) as thumbnail:
+            self.assertEqual(thumbnail.format, 'JPEG')
+            self.assertEqual(thumbnail.size, (100, 50))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = override_settings(CHAT_ARCHIVE_DIR=directory.name, CHAT_ATTACHMENT_DIR=directory.name)
+        storage.enable()
+        self.addCleanup(storage.disable)
+        identities.clear()
+        users = [User.objects.create_user(f'user{index}', password='x') for index in range(2)]
+        self.sender, self.receiver = Profile.objects.bulk_create([Profile(user=user, gender='M') for user in users])
+        self.old = timezone.now() - timedelta(days=400)
+
+    def send(self, content, attachment=None, timestamp=None):
+        message = Message(sender_id=self.sender.id, receiver_id=self.receiver.id, content=content, attachment=attachment)
+        message.save()
+        Message.objects.filter(pk=message.pk).update(timestamp=timestamp or self.old)
+        return message
+
+    def archive(self):
+        return archive_messages(timezone.now() - timedelta(days=365), chunk_size=2)
+
+    def archived_contents(self):
+        return [row['content'] for row in read_archived_page(self.sender.id, self.receiver.id)]
+
+    def test_torn_write_is_dropped(self):
+        for index in range(3):
+            self.send(f'message {index}')
+        self.assertEqual(self.archive(), 3)
+        path = archive_path(self.old.date().replace(day=1))
+        complete = os.path.getsize(path)
+        # A run that died in the middle of a gzip member
+        with open(path, 'ab') as archive:
+            archive.write(b'\x1f\x8b\x08\x00torn')
+        self.assertEqual(sorted(self.archived_contents()), ['message 0', 'message 1', 'message 2'])
+
+        self.send('message 3')
+        self.assertEqual(self.archive(), 1)
+        self.assertGreater(ArchivedMonth.objects.get().size, complete)
+        self.assertEqual(sorted(self.archived_contents()), ['message 0', 'message 1', 'message 2', 'message 3'])
+
+    def test_rolls_over_to_one_file_per_month(self):
+        later = self.old.replace(day=15)
+        earlier = later - timedelta(days=31)
+        # Chunks of 2 messages that straddle the two months
+        for index in range(5):
+            self.send(f'message {index}', timestamp=later if index % 2 else earlier)
+        self.assertEqual(self.archive(), 5)
+
+        months = list(ArchivedMonth.objects.order_by('month').values_list('month', 'message_count'))
+        self.assertEqual(months, [(earlier.date().replace(day=1), 3), (later.date().replace(day=1), 2)])
+        for month, _ in months:
+            self.assertTrue(os.path.exists(archive_path(month)))
+        self.assertEqual(self.archived_contents(), ['message 3', 'message 1', 'message 4', 'message 2', 'message 0'])
+        # A page filled by the newest month does not go on to the older one
+        page = read_archived_page(self.sender.id, self.receiver.id, limit=2)
+        self.assertEqual([row['content'] for row in page], ['message 3', 'message 1'])
+        page = read_archived_page(self.sender.id, self.receiver.id, before=(page[-1]['timestamp'], page[-1]['id']))
+        self.assertEqual([row['content'] for row in page], ['message 4', 'message 2', 'message 0'])
+
+    def test_run_that_died_before_deleting_is_redone(self):
+        self.send('message 0')
+        self.assertEqual(self.archive(), 1)
+        month = ArchivedMonth.objects.get()
+        # A run wrote a complete member, then died before deleting its messages
+        self.send('message 1')
+        ghost = {
+            'id': 0, 'sender_id': self.sender.id, 'receiver_id': self.receiver.id, 'content': 'ghost',
+            'timestamp': self.old.isoformat(), 'is_read': False,
+        }
+        with open(month.path, 'ab') as archive, gzip.GzipFile(fileobj=archive, mode='ab') as member:
+            member.write(json.dumps(ghost).encode('utf8') + b'\n')
+        self.assertEqual(self.archive(), 1)
+        month.refresh_from_db()
+        self.assertEqual((month.message_count, month.size), (2, os.path.getsize(month.path)))
+        self.assertEqual(self.archived_contents(), ['message 1', 'message 0'])
+
+    def test_receiver_keeps_the_attachment_of_an_archived_message(self):
+        attachment = create_upload(self.sender.id, 'notes.txt', 10)
+        Attachment.objects.filter(pk=attachment.pk).update(completed_at=timezone.now())
+        self.send('see attached', sendable_attachment(self.sender.id, attachment.pk, self.receiver.id))
+        self.archive()
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(readable_attachment(self.receiver.id, attachment.pk), attachment)
+
+
+class FailingWriteBehindQueue(MessageWriteBehindQueue):
+    # The database refuses the first ``failures`` batches
+    failures = 1
+
+    def _write(self, batch):
+        if self.failures:
+            self.failures -= 1
+            raise OperationalError('database is locked')
+        super()._write(batch)
+
+
+class BrokenChannelLayer(InMemoryChannelLayer):
+    # Redis went away
+    async def group_send(self, group, message):
+        raise ConnectionError('layer unavailable')
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class WriteBehindQueueTests(TransactionTestCase):
+
+    def setUp(self):
+        users = [User.objects.create_user(f'user{index}', password='x') for index in range(2)]
+        profiles = Profile.objects.bulk_create([Profile(user=user, gender='M') for user in users])
+        self.sender, self.receiver = [
+            Identity(profile.user_id, profile.id, profile.user.username, '') for profile in profiles
+        ]
+
+    async def put(self, queue, *contents):
+        for content in contents:
+            await queue.put(self.sender, self.receiver, content, client_id=content)
+
+    async def written(self, queue, timeout=1):
+        # Contents of the messages in the database once the queue wrote them
+        # on its own: it took every message, then its flush finished (the
+        # database is not read meanwhile, SQLite would lock the table)
+        async def taken():
+            while len(queue):
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(taken(), timeout)
+        await queue.flush()
+        return [content async for content in Message.objects.order_by('id').values_list('content', flat=True)]
+
+    async def test_flushes_a_full_batch(self):
+        queue = MessageWriteBehindQueue(batch_size=3, max_latency=60)
+        await self.put(queue, 'a', 'b')
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(await Message.objects.acount(), 0)
+
+        await self.put(queue, 'c')
+        self.assertEqual(await self.written(queue), ['a', 'b', 'c'])
+
+    async def test_flushes_after_the_latency(self):
+        queue = MessageWriteBehindQueue(batch_size=100, max_latency=0.2)
+        await self.put(queue, 'a')
+        self.assertEqual(await Message.objects.acount(), 0)
+        self.assertEqual(await self.written(queue), ['a'])
+
+    async def test_retries_a_failed_batch(self):
+        queue = FailingWriteBehindQueue(batch_size=100, max_latency=0.05)
+        await self.put(queue, 'a', 'b', 'c')
+        with self.assertLogs('chat.persistence', 'ERROR'):
+            await queue.flush()
+        # Kept, in order, for the next flush
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(await Message.objects.acount(), 0)
+        self.assertEqual(await self.written(queue), ['a', 'b', 'c'])
+
+    @override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'chat.tests.BrokenChannelLayer'}})
+    async def test_announce_failure_does_not_retry_a_written_batch(self):
+        queue = MessageWriteBehindQueue(batch_size=100, max_latency=60)
+        await self.put(queue, 'a', 'b')
+        with self.assertLogs('chat.persistence', 'ERROR') as logs:
+            await queue.flush()
+        # One failure per group (conversation and inbox), none per message
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(await Message.objects.acount(), 2)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_HISTORY_MAX_PAGE_SIZE=100)
+class HistoryTests(TestCase):
+
+    def setUp(self):
+        identities.clear()
+        users = [User.objects.create_user(f'user{index}', password='x') for index in range(3)]
+        self.profiles = Profile.objects.bulk_create([Profile(user=user, gender='M') for user in users])
+
+    def send(self, sender, receiver, content):
+        message = Message(sender_id=sender.id, receiver_id=receiver.id, content=content)
+        message.save()
+        return message
+
+    def test_cursor_round_trip(self):
+        timestamp = timezone.now()
+        self.assertEqual(decode_cursor(encode_cursor(timestamp, 42)), (timestamp, 42))
+
+    def test_invalid_cursors(self):
+        # Not base64, 'x|y', 'not a date|1', not a string
+        for cursor in ('not base64!', 'eHx5', 'bm90IGEgZGF0ZXwx', 5, ['eHx5']):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+
+    def test_pages_walk_the_conversation_newest_first(self):
+        first, second, other = self.profiles
+        messages = [self.send(*pair, f'message {index}') for index, pair in enumerate([(first, second), (second, first)] * 4)]
+        # Not part of the conversation
+        self.send(first, other, 'elsewhere')
+        # Same timestamp: the id breaks the tie, across a page boundary too
+        Message.objects.filter(pk__in=[messages[4].pk, messages[5].pk]).update(timestamp=messages[5].timestamp)
+
+        contents, cursor = [], None
+        while True:
+            page = get_conversation_page(first.id, second.id, cursor=cursor, limit=3)
+            self.assertLessEqual(len(page['messages']), 3)
+            contents.extend(row['content'] for row in page['messages'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(contents, [f'message {index}' for index in reversed(range(8))])
+
+    def test_last_full_page_has_no_cursor(self):
+        first, second, _ = self.profiles
+        for index in range(4):
+            self.send(first, second, f'message {index}')
+        page = get_conversation_page(second.id, first.id, limit=4)
+        self.assertEqual(len(page['messages']), 4)
+        self.assertIsNone(page['next_cursor'])
+
+    def test_limit_is_capped(self):
+        first, second, _ = self.profiles
+        with self.settings(CHAT_HISTORY_MAX_PAGE_SIZE=2):
+            for index in range(3):
+                self.send(first, second, f'message {index}')
+            page = get_conversation_page(first.id, second.id, limit=50)
+        self.assertEqual(len(page['messages']), 2)
+        self.assertIsNotNone(page['next_cursor'])
+
+
+class ShardingTests(SimpleTestCase):
+
+    keys = [private_room_name(user_id, user_id + 1) for user_id in range(4000)]
+
+    def test_room_name_does_not_depend_on_who_opened_it(self):
+        self.assertEqual(private_room_name(7, 12), private_room_name('12', 7))
+        self.assertNotEqual(private_room_name(1, 23), private_room_name(12, 3))
+
+    def test_placement_is_stable(self):
+        nodes = [f'redis-{index}:6379' for index in range(4)]
+        ring, rebuilt = HashRing(nodes), HashRing(list(nodes))
+        self.assertEqual([rebuilt.get_node(key) for key in self.keys], [ring.get_node(key) for key in self.keys])
+
+    def test_keys_are_spread_over_the_nodes(self):
+        ring = HashRing([f'redis-{index}:6379' for index in range(4)])
+        counts = Counter(ring.get_node(key) for key in self.keys)
+        self.assertEqual(set(counts), {0, 1, 2, 3})
+        self.assertGreater(min(counts.values()), len(self.keys) / 4 * 0.7)
+
+    def test_a_new_node_only_takes_keys(self):
+        nodes = [f'redis-{index}:6379' for index in range(4)]
+        before = HashRing(nodes)
+        after = HashRing(nodes + ['redis-4:6379'])
+        moved = [key for key in self.keys if before.get_node(key) != after.get_node(key)]
+        # Only to the new node, and about its share of them
+        self.assertEqual({after.get_node(key) for key in moved}, {4})
+        self.assertLess(len(moved), len(self.keys) * 0.3)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class UnreadCounterTests(TransactionTestCase):
+
+    def setUp(self):
+        identities.clear()
+        users = [User.objects.create_user(f'user{index}', password='x') for index in range(2)]
+        self.sender, self.receiver = Profile.objects.bulk_create([Profile(user=user, gender='M') for user in users])
+        self.messages = []
+        for index in range(3):
+            message = Message(sender_id=self.sender.id, receiver_id=self.receiver.id, content=f'message {index}')
+            message.save()
+            self.messages.append(message)
+
+    def unread(self):
+        return UnreadCounter.objects.counts_for(self.receiver.id)
+
+    def test_counted_when_created(self):
+        self.assertEqual(self.unread(), {self.sender.id: 3})
+        self.assertEqual(UnreadCounter.objects.counts_for(self.sender.id), {})
+
+    async def test_read_one(self):
+        await self.messages[0].mark_as_read()
+        self.assertEqual(await database_sync_to_async(self.unread)(), {self.sender.id: 2})
+
+    def test_read_up_to(self):
+        self.assertEqual(Message.objects.mark_read_up_to(self.receiver.id, self.sender.id, self.messages[1].id), 2)
+        self.assertEqual(self.unread(), {self.sender.id: 1})
+        # Nothing left to read up to there
+        self.assertEqual(Message.objects.mark_read_up_to(self.receiver.id, self.sender.id, self.messages[1].id), 0)
+        self.assertEqual(self.unread(), {self.sender.id: 1})
+
+    def test_read_conversation(self):
+        self.assertEqual(Message.objects.mark_conversation_read(self.receiver.id, self.sender.id), 3)
+        self.assertEqual(self.unread(), {})
+
+    async def test_stale_message_read_after_the_watermark_is_not_counted_twice(self):
+        stale = self.messages[0]
+        await database_sync_to_async(Message.objects.mark_read_up_to)(self.receiver.id, self.sender.id, self.messages[1].id)
+        await stale.mark_as_read()
+        self.assertEqual(await database_sync_to_async(self.unread)(), {self.sender.id: 1})
+
+    def test_rebuild(self):
+        Message.objects.filter(pk=self.messages[0].pk).update(is_read=True)
+        UnreadCounter.objects.update(count=99)
+        call_command('rebuild_unread_counters', stdout=StringIO())
+        self.assertEqual(self.unread(), {self.sender.id: 2})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class SearchTests(TestCase):
+
+    def setUp(self):
+        identities.clear()
+        users = [User.objects.create_user(f'user{index}', password='x') for index in range(3)]
+        self.first, self.second, self.third = Profile.objects.bulk_create(
+            [Profile(user=user, gender='M') for user in users]
+        )
+
+    def send(self, sender, receiver, content, days_ago=0):
+        message = Message(sender_id=sender.id, receiver_id=receiver.id, content=content)
+        message.save()
+        Message.objects.filter(pk=message.pk).update(timestamp=timezone.now() - timedelta(days=days_ago))
+        return message
+
+    def search(self, query, **kwargs):
+        return [row['content'] for row in search_messages(self.first.id, query, **kwargs)['results']]
+
+    def test_indexed_when_saved(self):
+        self.send(self.first, self.second, 'Meet me at the station')
+        self.assertEqual(self.search('station'), ['Meet me at the station'])
+        self.assertEqual(self.search('airport'), [])
+
+    def test_every_word_last_one_as_prefix(self):
+        self.send(self.first, self.second, 'the train leaves tomorrow')
+        self.send(self.first, self.second, 'the bus leaves today')
+        self.assertEqual(self.search('train tomo'), ['the train leaves tomorrow'])
+        self.assertEqual(self.search('leav'), ['the bus leaves today', 'the train leaves tomorrow'])
+
+    def test_relevance_and_recent_order(self):
+        self.send(self.first, self.second, 'pizza pizza pizza tonight?', days_ago=3)
+        self.send(self.first, self.second, 'we could get pizza or sushi or tacos or burgers', days_ago=1)
+        self.assertEqual(self.search('pizza')[0], 'pizza pizza pizza tonight?')
+        self.assertEqual(self.search('pizza', order='recent')[0], 'we could get pizza or sushi or tacos or burgers')
+
+    def test_scope(self):
+        self.send(self.first, self.second, 'secret plan with second')
+        self.send(self.third, self.first, 'secret plan with third')
+        self.send(self.second, self.third, 'secret plan without first')
+        self.assertEqual(sorted(self.search('secret')), ['secret plan with second', 'secret plan with third'])
+        self.assertEqual(self.search('secret', other_profile_id=self.third.id), ['secret plan with third'])
+
+    def test_pages(self):
+        for index in range(3):
+            self.send(self.first, self.second, f'note {index}', days_ago=index)
+        page = search_messages(self.first.id, 'note', order='recent', limit=2)
+        self.assertEqual([row['content'] for row in page['results']], ['note 0', 'note 1'])
+        self.assertEqual(page['next_page'], 2)
+        self.assertEqual(self.search('note', order='recent', limit=2, page=2), ['note 2'])
+
+    def test_invalid_queries(self):
+        for query in ('', '!!!', None, 5, ['note']):
+            with self.assertRaises(InvalidSearch):
+                search_messages(self.first.id, query)
+        with self.assertRaises(InvalidSearch):
+            search_messages(self.first.id, 'note', page={'page': 1})
+
+    def test_archived_messages_leave_the_index(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.send(self.first, self.second, 'ancient history', days_ago=400)
+        self.send(self.first, self.second, 'recent history')
+        with self.settings(CHAT_ARCHIVE_DIR=directory.name):
+            archive_messages(timezone.now() - timedelta(days=365))
+        self.assertEqual(self.search('history'), ['recent history'])
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', ['ancient'])
+            self.assertEqual(cursor.fetchall(), [])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ConversationListTests(TestCase):
+
+    def setUp(self):
+        identities.clear()
+        self.users = [User.objects.create_user(f'user{index}', password='x') for index in range(6)]
+        self.profiles = Profile.objects.bulk_create([Profile(user=user, gender='M') for user in self.users])
+        self.me = self.profiles[0]
+
+    def send(self, sender, receiver, content):
+        message = Message(sender_id=sender.id, receiver_id=receiver.id, content=content)
+        message.save()
+        return message
+
+    def test_last_message_and_unread_count(self):
+        first, second = self.profiles[1:3]
+        self.send(first, self.me, 'hi')
+        self.send(first, self.me, 'are you there?')
+        self.send(self.me, second, 'lunch?')
+        last = self.send(second, self.me, 'sure')
+        self.send(self.me, first, 'yes, sorry')
+
+        conversations = get_conversation_list(self.me.id)['conversations']
+        # Most recently active first
+        self.assertEqual([conversation['username'] for conversation in conversations], ['user1', 'user2'])
+        self.assertEqual(
+            [(c['last_message'], c['sent_by_me'], c['unread']) for c in conversations],
+            [('yes, sorry', True, 2), ('sure', False, 1)],
+        )
+        self.assertEqual(conversations[1]['last_message_id'], last.id)
+
+        Message.objects.mark_conversation_read(self.me.id, first.id)
+        self.assertEqual([c['unread'] for c in get_conversation_list(self.me.id)['conversations']], [0, 1])
+        # The other side of the conversation
+        other_side = get_conversation_list(first.id)['conversations']
+        self.assertEqual([(c['username'], c['sent_by_me'], c['unread']) for c in other_side], [('user0', False, 1)])
+
+    def test_pages(self):
+        for other in self.profiles[1:]:
+            self.send(other, self.me, f'from {other.user.username}')
+        usernames, cursor = [], None
+        while True:
+            page = get_conversation_list(self.me.id, cursor=cursor, limit=2)
+            usernames.extend(conversation['username'] for conversation in page['conversations'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(usernames, ['user5', 'user4', 'user3', 'user2', 'user1'])
+
+    def test_view_runs_a_constant_number_of_queries(self):
+        self.client.force_login(self.users[0])
+        url = reverse('chatd:conversations')
+        self.send(self.profiles[1], self.me, 'one')
+        # Session, user and the identity cache are loaded once
+        self.client.get(url)
+        with self.assertNumQueries(3):
+            self.assertEqual(len(self.client.get(url).json()['conversations']), 1)
+        for other in self.profiles[2:]:
+            self.send(other, self.me, 'many')
+        with self.assertNumQueries(3):
+            self.assertEqual(len(self.client.get(url).json()['conversations']), 5)
+
+
+class CatchUpTests(SimpleTestCase):
+
+    async def test_stops_reading_once_the_client_is_gone(self):
+        reads = []
+
+        def gap(after, limit):
+            reads.append(after)
+            return [{'seq': seq} for seq in range(after + 1, min(after + limit, 50) + 1)]
+
+        class Client:
+            outbound = OutboundQueue(self.fail, max_size=10, disconnect_after=20)
+
+            async def send_payload(self, payload):
+                # Gone while the first chunk is on its way
+                self.outbound.close()
+
+        await send_catch_up(Client(), gap, {'after': 0, 'limit': 10}, 'seq')
+        self.assertEqual(reads, [0])
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        now = bucket.updated
+        self.assertEqual([bucket.take(now) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(now), 0.5)
+        # Half a token refilled: a quarter of a second to go
+        self.assertAlmostEqual(bucket.take(now + 0.25), 0.25)
+        self.assertEqual(bucket.take(now + 0.5), 0)
+
+    def test_refill_stops_at_the_burst(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        later = bucket.updated + 3600
+        self.assertEqual([bucket.take(later) for _ in range(3)], [0, 0, 0])
+        self.assertGreater(bucket.take(later), 0)
+
+    async def test_limiter_keeps_one_bucket_per_key(self):
+        limiter = LocalRateLimiter(rate=0.001, burst=1)
+        self.assertEqual(await limiter.take('user:1'), 0)
+        self.assertGreater(await limiter.take('user:1'), 0)
+        self.assertEqual(await limiter.take('user:2'), 0)
+
+
+class ThrottleReplyTests(PrivateChatTestCase):
+    """
+    Frames over the limits are refused with a 'throttled' notice, the
+    socket stays open.
+    """
+
+    @override_settings(CHAT_RATE_LIMIT_CONNECTION_RATE=0.001, CHAT_RATE_LIMIT_CONNECTION_BURST=2)
+    async def test_rate(self):
+        communicator = await self.connect()
+        for _ in range(3):
+            await communicator.send_json_to({'type': 'unknown'})
+        self.assertIn('error', await communicator.receive_json_from())
+        self.assertIn('error', await communicator.receive_json_from())
+        throttled = (await communicator.receive_json_from())['throttled']
+        self.assertEqual(throttled['reason'], 'rate')
+        self.assertGreater(throttled['retry_after'], 0)
+        await communicator.disconnect()
+
+    @override_settings(CHAT_MAX_FRAME_SIZE=100)
+    async def test_size(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({'type': 'message', 'message': 'x' * 100})
+        self.assertEqual((await communicator.receive_json_from())['throttled']['reason'], 'size')
+        await communicator.send_json_to({'type': 'ping', 'id': 1})
+        self.assertEqual(await communicator.receive_json_from(), {'pong': 1})
+        await communicator.disconnect()
+
+
+class EphemeralCoalescerTests(SimpleTestCase):
+
+    async def test_close_sends_the_pending_event_and_forgets_the_key(self):
+        sent = []
+
+        async def send(event):
+            sent.append(event)
+
+        acks = EphemeralCoalescer(interval=60)
+        await acks.submit('room:1', 'ack 1', send)
+        await acks.submit('room:1', 'ack 2', send)
+        await acks.submit('room:1', 'ack 3', send)
+        self.assertEqual(sent, ['ack 1'])
+
+        await acks.close('room:1')
+        self.assertEqual(sent, ['ack 1', 'ack 3'])
+        self.assertEqual(len(acks), 0)
+        # Nothing left to send at the end of the interval
+        await acks.close('room:1')
+        self.assertEqual(sent, ['ack 1', 'ack 3'])
+
+
+class NoProfileTests(TestCase):
+    """
+    A logged in user without a profile (a superuser made from the command
+    line) gets a 404 from the chat views, not an error.
+    """
+
+    def setUp(self):
+        identities.clear()
+        self.other = User.objects.create_user('other', password='x')
+        Profile.objects.create(user=self.other, gender='M')
+        self.client.force_login(User.objects.create_user('admin', password='x'))
+
+    def test_views_answer_404(self):
+        for url in (
+            reverse('chatd:history', args=[self.other.id]),
+            reverse('chatd:conversations'),
+            reverse('chatd:unread'),
+            reverse('chatd:search') + '?q=hello',
+            reverse('chatd:attachment', args=[1]),
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.post(reverse('chatd:attachment-create'), {'name': 'a.txt', 'size': 1})
+        self.assertEqual(response.status_code, 404)
+
+
+class PresenceTests(SimpleTestCase):
+    """
+    A user stays online while they send heartbeats and goes offline once
+    the last one is older than the TTL, even with a socket still open.
+    """
+
+    async def test_silent_user_expires(self):
+        presence = PresenceRegistry(ttl=0.3)
+        self.assertTrue(await presence.connect(1))
+        self.assertTrue(await presence.connect(2))
+        await asyncio.sleep(0.2)
+        self.assertFalse(await presence.heartbeat(2))
+        self.assertEqual(await presence.expire(), [])
+        await asyncio.sleep(0.2)
+
+        # Only the user without a recent heartbeat expires, once
+        self.assertEqual(await presence.expire(), [1])
+        self.assertEqual(await presence.expire(), [])
+        self.assertFalse(await presence.is_online(1))
+        self.assertEqual(await presence.online_users(), {2})
+
+        # Their next heartbeat is a transition to online again
+        self.assertTrue(await presence.heartbeat(1))
+
+
+class RecordingRouter(PrimaryReplicaRouter):
+    # Records where each read would go; this database has no replica to serve it
+    reads = []
+
+    def db_for_read(self, model, **hints):
+        self.reads.append((model._meta.model_name, super().db_for_read(model, **hints)))
+        return DEFAULT_DB_ALIAS
+
+
+@override_settings(DATABASE_ROUTERS=['chat.tests.RecordingRouter'])
+class ReplicaRoutingTests(PrivateChatTestCase):
+    """
+    History pages and user lists are read from a replica, other reads from
+    the primary.
+    """
+
+    def setUp(self):
+        super().setUp()
+        RecordingRouter.reads.clear()
+        replicas = mock.patch('chat.routers.replica_aliases', return_value=['replica_0'])
+        replicas.start()
+        self.addCleanup(replicas.stop)
+
+    def test_history_is_read_from_a_replica(self):
+        sender, receiver = Profile.objects.order_by('id')
+        Message(sender_id=sender.id, receiver_id=receiver.id, content='hi').save()
+        RecordingRouter.reads.clear()
+        self.assertEqual(len(get_conversation_page(sender.id, receiver.id)['messages']), 1)
+        self.assertEqual(set(RecordingRouter.reads), {('message', 'replica_0')})
+
+        RecordingRouter.reads.clear()
+        Message.objects.count()
+        self.assertEqual(RecordingRouter.reads, [('message', DEFAULT_DB_ALIAS)])
+
+    async def test_user_list_is_read_from_a_replica(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/user_list_status/')
+        communicator.scope['user'] = self.users[0]
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        payload = await communicator.receive_json_from()
+        while 'user_list' not in payload:
+            payload = await communicator.receive_json_from()
+        self.assertEqual(len(payload['user_list']), 2)
+        self.assertIn(('profile', 'replica_0'), RecordingRouter.reads)
+        self.assertNotIn(('profile', DEFAULT_DB_ALIAS), RecordingRouter.reads)
+        await communicator.disconnect()
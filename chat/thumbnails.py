@@ -0,0 +1,27 @@
+"""
+ATTACHMENT THUMBNAILS
+AUTHOR: DONALD PROGRAMMEUR
+
+Run in the thumbnail worker processes (see attachments.py): Pillow only,
+nothing here needs Django to be set up.
+"""
+from PIL import Image, ImageOps
+
+
+# Images that get a thumbnail and are served inline, other files are downloads
+IMAGE_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+
+
+def make_thumbnail(source, target, size):
+    """
+    Write a JPEG of ``source`` fitting in ``size`` x ``size`` to ``target``
+    and return the width and height of the original.
+    """
+    with Image.open(source) as image:
+        width, height = image.size
+        thumbnail = ImageOps.exif_transpose(image)
+        thumbnail.thumbnail((size, size))
+        if thumbnail.mode not in ('RGB', 'L'):
+            thumbnail = thumbnail.convert('RGB')
+        thumbnail.save(target, 'JPEG', quality=85)
+    return width, height
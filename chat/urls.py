@@ -5,5 +5,18 @@ app_name = 'chatd'
 
 
 urlpatterns = [ 
-    path('', HomeView.as_view(), name='home')         
-]
\ No newline at end of file
+    path('', HomeView.as_view(), name='home'),
+    path('history/<int:user_id>/', HistoryView.as_view(), name='history'),
+    path('conversations/', ConversationsView.as_view(), name='conversations'),
+    path('unread/', UnreadCountsView.as_view(), name='unread'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('attachments/', AttachmentUploadView.as_view(), name='attachment-create'),
+    path('attachments/<int:attachment_id>/', AttachmentView.as_view(), name='attachment'),
+    path('attachments/<int:attachment_id>/upload', AttachmentChunkView.as_view(), name='attachment-upload'),
+    path('attachments/<int:attachment_id>/file', AttachmentView.as_view(part='file'), name='attachment-file'),
+    path(
+        'attachments/<int:attachment_id>/thumbnail', AttachmentView.as_view(part='thumbnail'),
+        name='attachment-thumbnail',
+    ),
+    path('stats/outbound/', OutboundStatsView.as_view(), name='outbound-stats'),
+]
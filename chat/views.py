@@ -1,12 +1,32 @@
 from django.views import View
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-from .models import Profile, Message
-from django.contrib.auth.mixins import LoginRequiredMixin
+from .models import Attachment, Message, UnreadCounter
+from .attachments import (
+    InvalidUpload, UploadOffsetMismatch, create_upload, file_response, readable_attachment, sendable_attachment,
+    upload_offset, write_chunk,
+)
+from .conversations import get_conversation_list
+from .history import InvalidCursor, get_conversation_page
+from .identity import identities
+from .metrics import registry
+from .outbound import outbound_stats
+from .search import InvalidSearch, search_messages
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+
+
+def current_identity(request):
+    """
+    Identity of the logged in user, 404 when the user has no profile (an
+    account made without signing up, like a superuser).
+    """
+    identity = identities.resolve(request.user.id)
+    if identity is None:
+        raise Http404
+    return identity
 
 
 @login_required
@@ -16,25 +36,29 @@ def send_message(request):
     This view sends a message from the sender to the receiver.
     """
     if request.method == 'POST':
-        receiver_id = request.POST.get('receiver_id')
-        receiver = get_object_or_404(Profile, id=receiver_id)
+        receiver_id = request.POST.get('receiver_id', '')
+        receiver = identities.resolve_profile(int(receiver_id)) if receiver_id.isdigit() else None
+        if receiver is None:
+            raise Http404
+        sender = current_identity(request)
         message_content = request.POST.get('message')
+        attachment = None
+        if request.POST.get('attachment_id'):
+            attachment_id = request.POST['attachment_id']
+            attachment = (
+                sendable_attachment(sender.profile_id, int(attachment_id), receiver.profile_id)
+                if attachment_id.isdigit() else None
+            )
+            if attachment is None:
+                raise Http404
 
-        # Create a new message and save it to the database
-        new_message = Message(sender=request.user.profile, receiver=receiver, content=message_content)
-        new_message.save()
-
-        # Send a message to the receiver's channel layer
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"user_{receiver.user.username}",
-            {
-                "type": "chat.message",
-                "message": message_content,
-                "sender_username": request.user.username,
-                "sender_avatar": request.user.profile.avatar.image.url
-            }
+        # Create a new message and save it to the database, saving it also
+        # notifies every open socket of the receiver (see Message.save)
+        new_message = Message(
+            sender_id=sender.profile_id, receiver_id=receiver.profile_id, content=message_content or '',
+            attachment=attachment,
         )
+        new_message.save()
 
         return JsonResponse({'status': 'ok'})
 
@@ -52,3 +76,193 @@ class HomeView(View):
         # messages = Message.objects.filter(sender=request.user.profile, receiver=receiver)
         # context = {'receiver': receiver, 'messages': messages, 'users': users}
         return render(request, self.template_name)
+
+
+class HistoryView(LoginRequiredMixin, View):
+    """
+    Paginated history of the conversation with the user ``user_id``, newest
+    messages first. Pass the returned ``next_cursor`` as ``?cursor=`` to get
+    the previous page, and ``?archive=1`` to go on into archived messages.
+    """
+
+    def get(self, request, user_id, *args, **kwargs):
+        other = identities.resolve(user_id)
+        if other is None:
+            raise Http404
+        try:
+            page = get_conversation_page(
+                current_identity(request).profile_id,
+                other.profile_id,
+                cursor=request.GET.get('cursor'),
+                limit=request.GET.get('limit'),
+                archive=request.GET.get('archive') == '1',
+            )
+        except (InvalidCursor, ValueError):
+            return JsonResponse({'error': 'invalid cursor or limit'}, status=400)
+        return JsonResponse(page)
+
+
+class ConversationsView(LoginRequiredMixin, View):
+    """
+    Conversations of the current user, most recent first, each with its last
+    message and unread count. Pass the returned ``next_cursor`` as
+    ``?cursor=`` to get the next page.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            page = get_conversation_list(
+                current_identity(request).profile_id,
+                cursor=request.GET.get('cursor'),
+                limit=request.GET.get('limit'),
+            )
+        except (InvalidCursor, ValueError):
+            return JsonResponse({'error': 'invalid cursor or limit'}, status=400)
+        return JsonResponse(page)
+
+
+class UnreadCountsView(LoginRequiredMixin, View):
+    """
+    Number of unread messages per sender, read from the maintained counters.
+    """
+
+    def get(self, request, *args, **kwargs):
+        counts = UnreadCounter.objects.counts_for(current_identity(request).profile_id)
+        return JsonResponse({'unread': [{'sender_id': sender_id, 'count': count} for sender_id, count in counts.items()]})
+
+
+class SearchView(LoginRequiredMixin, View):
+    """
+    Full-text search in the messages of the current user: ``?q=`` words to
+    find, ``?with=`` a user id to search one conversation only, ``?order=``
+    relevance (default) or recent, ``?page=`` and ``?limit=``.
+    """
+
+    def get(self, request, *args, **kwargs):
+        other_profile_id = None
+        if request.GET.get('with'):
+            other = identities.resolve(int(request.GET['with'])) if request.GET['with'].isdigit() else None
+            if other is None:
+                raise Http404
+            other_profile_id = other.profile_id
+        try:
+            results = search_messages(
+                current_identity(request).profile_id,
+                request.GET.get('q'),
+                other_profile_id=other_profile_id,
+                order=request.GET.get('order', 'relevance'),
+                page=request.GET.get('page', 1),
+                limit=request.GET.get('limit'),
+            )
+        except (InvalidSearch, ValueError):
+            return JsonResponse({'error': 'invalid query, order, page or limit'}, status=400)
+        return JsonResponse(results)
+
+
+class AttachmentUploadView(LoginRequiredMixin, View):
+    """
+    Start the upload of an attachment: POST its ``name``, ``size`` in bytes
+    and ``content_type``. Then send its bytes to the returned ``upload_url``.
+    """
+
+    def post(self, request, *args, **kwargs):
+        try:
+            attachment = create_upload(
+                current_identity(request).profile_id,
+                request.POST.get('name'),
+                request.POST.get('size'),
+                request.POST.get('content_type'),
+            )
+        except (InvalidUpload, TypeError, ValueError) as error:
+            return JsonResponse({'error': f'invalid upload: {error}'}, status=400)
+        return JsonResponse({
+            'id': attachment.id,
+            'upload_url': reverse('chatd:attachment-upload', args=[attachment.id]),
+            'offset': 0,
+        }, status=201)
+
+
+class AttachmentChunkView(LoginRequiredMixin, View):
+    """
+    Resumable upload of an attachment by its uploader. HEAD gives the number
+    of bytes the server has in the ``Upload-Offset`` header; PATCH appends
+    the request body from the ``Upload-Offset`` it gives, and answers with
+    the new offset (409 with the server's offset when they differ). The
+    upload is complete when the offset reaches the size of the file.
+    """
+
+    def get_attachment(self, request, attachment_id):
+        return get_object_or_404(
+            Attachment, pk=attachment_id, uploader_id=current_identity(request).profile_id
+        )
+
+    def head(self, request, attachment_id, *args, **kwargs):
+        response = HttpResponse()
+        response['Upload-Offset'] = upload_offset(self.get_attachment(request, attachment_id))
+        return response
+
+    def patch(self, request, attachment_id, *args, **kwargs):
+        attachment = self.get_attachment(request, attachment_id)
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'Upload-Offset header missing or invalid'}, status=400)
+        try:
+            # The body is read in blocks and written as it comes
+            offset = write_chunk(attachment, offset, request)
+        except UploadOffsetMismatch as error:
+            response = JsonResponse({'error': 'offset mismatch', 'offset': error.offset}, status=409)
+            response['Upload-Offset'] = error.offset
+            return response
+        response = JsonResponse({
+            'offset': offset,
+            'complete': attachment.completed_at is not None,
+            'attachment': attachment.metadata() if attachment.completed_at else None,
+        })
+        response['Upload-Offset'] = offset
+        return response
+
+
+class AttachmentView(LoginRequiredMixin, View):
+    """
+    Metadata of an attachment (JSON), or with ``part`` 'file' or 'thumbnail'
+    the file itself, for its uploader and the receiver of its message.
+    """
+
+    part = None
+
+    def get(self, request, attachment_id, *args, **kwargs):
+        attachment = readable_attachment(current_identity(request).profile_id, attachment_id)
+        if attachment is None:
+            raise Http404
+        if self.part == 'file':
+            return file_response(attachment.path, attachment.name, attachment.content_type)
+        if self.part == 'thumbnail':
+            if not attachment.thumbnail:
+                # Not an image, or not made yet
+                raise Http404
+            return file_response(attachment.thumbnail, f'thumbnail-{attachment.name}.jpg', 'image/jpeg')
+        return JsonResponse(attachment.metadata())
+
+
+class OutboundStatsView(UserPassesTestMixin, View):
+    """
+    Outbound queues of this process (staff only): frames queued, sent,
+    coalesced and dropped, writes paused by a full transport, slow clients
+    disconnected, current depth.
+    """
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(outbound_stats.snapshot())
+
+
+def metrics(request):
+    """
+    Metrics of this process in the Prometheus text format, 404 when disabled.
+    """
+    if not registry.enabled:
+        raise Http404
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
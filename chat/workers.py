@@ -0,0 +1,124 @@
+"""
+MULTI-PROCESS ASGI SERVER: SUPERVISOR
+AUTHOR: DONALD PROGRAMMEUR
+
+``python manage.py runworkers`` starts a supervisor and N Daphne worker
+processes (see server.py). Each worker opens its own listening socket on the
+same port with SO_REUSEPORT, so the kernel spreads the incoming connections
+over them; they share nothing but the database and Redis: the channel layer
+(groups, presence events, cache invalidations) and the presence registry
+(who is online, see presence.py).
+
+Signals of the supervisor:
+  SIGTERM, SIGINT  drain every worker and exit
+  SIGHUP           rolling restart: a new worker is started and listening
+                   before each old one is drained
+"""
+import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def worker_count(workers=None):
+    return workers or settings.CHAT_WORKERS or os.cpu_count() or 1
+
+
+class WorkerSupervisor:
+    """
+    Starts the workers, restarts the ones that die, and drains them on
+    SIGTERM or one at a time on SIGHUP.
+    """
+
+    def __init__(self, host, port, workers, drain_timeout=None, ready_timeout=30, ready_fd=None):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.drain_timeout = drain_timeout or settings.CHAT_WORKER_DRAIN_TIMEOUT
+        self.ready_timeout = ready_timeout
+        self.ready_fd = ready_fd
+        self.processes = []
+        self._stopping = False
+        self._restarting = False
+
+    def command(self, ready_fd):
+        return [
+            sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'runworkers', '--worker',
+            '--host', self.host, '--port', str(self.port),
+            '--drain-timeout', str(self.drain_timeout), '--ready-fd', str(ready_fd),
+        ]
+
+    def spawn(self):
+        """
+        Start a worker and wait until it listens.
+        """
+        read_fd, write_fd = os.pipe()
+        try:
+            process = subprocess.Popen(self.command(write_fd), pass_fds=[write_fd])
+        finally:
+            os.close(write_fd)
+        try:
+            ready, _, _ = select.select([read_fd], [], [], self.ready_timeout)
+            if not ready or not os.read(read_fd, 1):
+                process.kill()
+                process.wait()
+                raise RuntimeError(f'Worker {process.pid} did not start listening')
+        finally:
+            os.close(read_fd)
+        logger.info('Worker %d listening on %s:%d', process.pid, self.host, self.port)
+        return process
+
+    def drain(self, processes):
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.drain_timeout + 5
+        for process in processes:
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning('Worker %d did not drain in time, killing it', process.pid)
+                process.kill()
+                process.wait()
+
+    def rolling_restart(self):
+        for index, old in enumerate(list(self.processes)):
+            self.processes[index] = self.spawn()
+            self.drain([old])
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_restart)
+        try:
+            for _ in range(self.workers):
+                self.processes.append(self.spawn())
+            if self.ready_fd is not None:
+                # Same protocol as the workers: every one of them listens
+                os.write(self.ready_fd, b'1')
+                os.close(self.ready_fd)
+            while not self._stopping:
+                if self._restarting:
+                    self._restarting = False
+                    self.rolling_restart()
+                for index, process in enumerate(self.processes):
+                    if process.poll() is not None and not self._stopping:
+                        logger.error('Worker %d exited with %s, restarting it', process.pid, process.returncode)
+                        self.processes[index] = self.spawn()
+                time.sleep(0.5)
+        finally:
+            self.drain(self.processes)
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_restart(self, signum, frame):
+        self._restarting = True
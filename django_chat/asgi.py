@@ -1,16 +1,22 @@
-from django.urls import path
+import os
+
+from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
-from .routing import websocket_urlpatterns
-import os
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_chat.settings')
 
+# Set up Django before the consumers (and their models) are imported
 django_asgi_app = get_asgi_application()
 
+from chat.outbound import FlowControlMiddleware  # noqa: E402
+
+from .routing import websocket_urlpatterns  # noqa: E402
+
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": URLRouter(websocket_urlpatterns)
-    # Just HTTP for now. (We can add other protocols later.)
+    # The consumers need scope["user"], taken from the Django session;
+    # FlowControlMiddleware needs Daphne's own send, so it comes first
+    "websocket": FlowControlMiddleware(AuthMiddlewareStack(URLRouter(websocket_urlpatterns))),
 })
@@ -5,4 +5,6 @@ from chat import consumers
 websocket_urlpatterns = [
     re_path(r'ws/private_chat/(?P<user_id>\d+)/$', consumers.PrivateChatConsumer.as_asgi()),
     re_path(r'ws/user_list_status/$', consumers.UserListStatusConsumer.as_asgi()),
-]
\ No newline at end of file
+    re_path(r'ws/inbox/$', consumers.InboxConsumer.as_asgi()),
+    re_path(r'ws/room/(?P<room_id>\d+)/$', consumers.RoomConsumer.as_asgi()),
+]
@@ -5,7 +5,7 @@ donaldtedom@gmail.com
 
 from pathlib import Path
 import os 
-from decouple import config
+from decouple import config, Csv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -82,24 +82,293 @@ WSGI_APPLICATION = 'django_chat.wsgi.application'
 
 ASGI_APPLICATION = 'django_chat.asgi.application'
 
+# Comma separated list of Redis hosts, e.g. "10.0.0.1:6379,10.0.0.2:6379".
+# Groups are sharded over them by consistent hashing (see chat/layers.py).
+
+CHANNEL_REDIS_HOSTS = [
+    (host.rsplit(':', 1)[0], int(host.rsplit(':', 1)[1]))
+    for host in config('CHANNEL_REDIS_HOSTS', default='127.0.0.1:6379', cast=Csv())
+]
+
+CHANNEL_LAYER_CAPACITY = config('CHANNEL_LAYER_CAPACITY', default=1000, cast=int)
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "chat.layers.ShardedRedisChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "hosts": CHANNEL_REDIS_HOSTS,
+            # Messages waiting per channel before channel_layer.send raises
+            # ChannelFull. Consumers move them to their outbound queue at once,
+            # so this only needs to absorb bursts.
+            "capacity": CHANNEL_LAYER_CAPACITY,
         },
     },
 }
 
-# Database
+# Chat messages are written to the database in batches (see chat/persistence.py):
+# a batch is flushed when it holds CHAT_MESSAGE_BATCH_SIZE messages or after
+# CHAT_MESSAGE_BATCH_LATENCY seconds, whichever comes first.
+
+CHAT_MESSAGE_BATCH_SIZE = config('CHAT_MESSAGE_BATCH_SIZE', default=100, cast=int)
+
+CHAT_MESSAGE_BATCH_LATENCY = config('CHAT_MESSAGE_BATCH_LATENCY', default=0.05, cast=float)
+
+# Conversation history pages (see chat/history.py)
+
+CHAT_HISTORY_PAGE_SIZE = config('CHAT_HISTORY_PAGE_SIZE', default=50, cast=int)
+
+CHAT_HISTORY_MAX_PAGE_SIZE = config('CHAT_HISTORY_MAX_PAGE_SIZE', default=200, cast=int)
+
+# A user is shown offline when no heartbeat was received for PRESENCE_TTL
+# seconds (see chat/presence.py)
+
+PRESENCE_TTL = config('PRESENCE_TTL', default=60, cast=float)
+
+# Who is online is kept in the memory of the process unless
+# CHAT_PRESENCE_REDIS_URL is set (e.g. redis://127.0.0.1:6379/2), which
+# several worker processes need to agree on it.
+
+CHAT_PRESENCE_REDIS_URL = config('CHAT_PRESENCE_REDIS_URL', default='')
+
+# Profile.last_online is written in bulk every PRESENCE_FLUSH_INTERVAL seconds
+# (see account/last_online.py)
+
+PRESENCE_FLUSH_INTERVAL = config('PRESENCE_FLUSH_INTERVAL', default=5, cast=float)
+
+# Avatars: thumbnails are rendered by a background pool instead of
+# django-avatar's synchronous post_save handler, and their URLs are cached
+# (see account/avatars.py). Users without an uploaded avatar get a gravatar
+# whose default picture depends on their gender.
+
+AVATAR_AUTO_GENERATE_SIZES = ()
+
+AVATAR_THUMBNAIL_SIZES = (40, 80)
+
+AVATAR_THUMBNAIL_WORKERS = config('AVATAR_THUMBNAIL_WORKERS', default=2, cast=int)
+
+AVATAR_DEFAULT_STYLES = {'M': 'mp', 'F': 'mp', 'O': 'identicon'}
+
+CHAT_AVATAR_SIZE = 80
+
+# The avatar URLs have their own cache, sized for every user of the user
+# list (AVATAR_URL_CACHE_SIZE users per process, kept AVATAR_URL_CACHE_TIMEOUT
+# seconds): in the default cache (300 entries) they kept evicting each other.
+
+AVATAR_URL_CACHE_SIZE = config('AVATAR_URL_CACHE_SIZE', default=100000, cast=int)
 
-DATABASES = {
+AVATAR_URL_CACHE_TIMEOUT = config('AVATAR_URL_CACHE_TIMEOUT', default=86400, cast=int)
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'avatar_urls': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'avatar-urls',
+        'TIMEOUT': AVATAR_URL_CACHE_TIMEOUT,
+        'OPTIONS': {'MAX_ENTRIES': AVATAR_URL_CACHE_SIZE},
+    },
 }
 
+# Number of user identities (ids, username, avatar URL) kept in memory by
+# each process (see chat/identity.py)
+
+CHAT_IDENTITY_CACHE_SIZE = config('CHAT_IDENTITY_CACHE_SIZE', default=10000, cast=int)
+
+# Messages older than CHAT_RETENTION_DAYS are moved to monthly compressed
+# files in CHAT_ARCHIVE_DIR by `python manage.py archive_messages`
+
+CHAT_RETENTION_DAYS = config('CHAT_RETENTION_DAYS', default=365, cast=int)
+
+CHAT_ARCHIVE_DIR = config('CHAT_ARCHIVE_DIR', default=os.path.join(BASE_DIR, 'archive'))
+
+# Database work without an async ORM equivalent runs in a pool of
+# CHAT_SYNC_WORKERS threads. Consumer handlers holding the event loop longer
+# than CHAT_LOOP_BLOCKING_THRESHOLD_MS are logged (0 disables the check)
+
+CHAT_SYNC_WORKERS = config('CHAT_SYNC_WORKERS', default=8, cast=int)
+
+CHAT_LOOP_BLOCKING_THRESHOLD_MS = config('CHAT_LOOP_BLOCKING_THRESHOLD_MS', default=50.0, cast=float)
+
+# Message search: text search configuration of the Postgres index and
+# maximum number of words of a query
+
+CHAT_SEARCH_CONFIG = config('CHAT_SEARCH_CONFIG', default='simple')
+
+CHAT_SEARCH_MAX_TERMS = config('CHAT_SEARCH_MAX_TERMS', default=8, cast=int)
+
+# Frames waiting to be written to one WebSocket, held back while its transport
+# has more than 64 KB the client did not read yet: past CHAT_OUTBOUND_QUEUE_SIZE
+# presence updates are coalesced and the oldest droppable events dropped;
+# a client with CHAT_OUTBOUND_DISCONNECT_AFTER frames waiting is disconnected.
+# Chat messages are never dropped. The transport is watched under Daphne
+# (runworkers, daphne, runserver); other ASGI servers give no flow control
+# and the queue never fills up there (a warning is logged).
+
+CHAT_OUTBOUND_QUEUE_SIZE = config('CHAT_OUTBOUND_QUEUE_SIZE', default=100, cast=int)
+
+CHAT_OUTBOUND_DISCONNECT_AFTER = config('CHAT_OUTBOUND_DISCONNECT_AFTER', default=1000, cast=int)
+
+# Flood control of the private chat sockets: frames larger than
+# CHAT_MAX_FRAME_SIZE are refused, and token buckets allow a burst then a
+# steady rate of frames per second per connection and per user. The user
+# buckets are shared by the workers through Redis when
+# CHAT_RATE_LIMIT_REDIS_URL is set (e.g. redis://127.0.0.1:6379/1).
+
+CHAT_MAX_FRAME_SIZE = config('CHAT_MAX_FRAME_SIZE', default=16384, cast=int)
+
+CHAT_RATE_LIMIT_CONNECTION_RATE = config('CHAT_RATE_LIMIT_CONNECTION_RATE', default=5.0, cast=float)
+
+CHAT_RATE_LIMIT_CONNECTION_BURST = config('CHAT_RATE_LIMIT_CONNECTION_BURST', default=20, cast=int)
+
+CHAT_RATE_LIMIT_USER_RATE = config('CHAT_RATE_LIMIT_USER_RATE', default=10.0, cast=float)
+
+CHAT_RATE_LIMIT_USER_BURST = config('CHAT_RATE_LIMIT_USER_BURST', default=40, cast=int)
+
+CHAT_RATE_LIMIT_REDIS_URL = config('CHAT_RATE_LIMIT_REDIS_URL', default='')
+
+# Prometheus metrics of the consumers, served on /metrics when enabled
+# (each worker process serves its own). Disabled, they cost next to nothing.
+
+CHAT_METRICS_ENABLED = config('CHAT_METRICS_ENABLED', default=False, cast=bool)
+
+# Ephemeral events of the private chats (never written to the database):
+# at most one typing event per CHAT_TYPING_INTERVAL seconds and one delivery
+# ack per CHAT_ACK_INTERVAL seconds are forwarded per user and conversation
+
+CHAT_TYPING_INTERVAL = config('CHAT_TYPING_INTERVAL', default=2.0, cast=float)
+
+CHAT_ACK_INTERVAL = config('CHAT_ACK_INTERVAL', default=1.0, cast=float)
+
+# Messages sent per frame when a reconnecting client catches up on what it
+# missed, from its last sequence number (see chat/catchup.py)
+
+CHAT_CATCH_UP_CHUNK_SIZE = config('CHAT_CATCH_UP_CHUNK_SIZE', default=100, cast=int)
+
+# Rooms whose member list is kept in memory by each process (see chat/rooms.py)
+
+CHAT_MEMBERSHIP_CACHE_SIZE = config('CHAT_MEMBERSHIP_CACHE_SIZE', default=1000, cast=int)
+
+# Message attachments (see chat/attachments.py): where the files are stored
+# (not under MEDIA_ROOT, they are only served to the two participants), the
+# largest file accepted in bytes, and the size of the image thumbnails made
+# by CHAT_THUMBNAIL_WORKERS processes.
+
+CHAT_ATTACHMENT_DIR = config('CHAT_ATTACHMENT_DIR', default=os.path.join(BASE_DIR, 'attachments'))
+
+CHAT_ATTACHMENT_MAX_SIZE = config('CHAT_ATTACHMENT_MAX_SIZE', default=25 * 1024 * 1024, cast=int)
+
+CHAT_THUMBNAIL_SIZE = config('CHAT_THUMBNAIL_SIZE', default=320, cast=int)
+
+CHAT_THUMBNAIL_WORKERS = config('CHAT_THUMBNAIL_WORKERS', default=2, cast=int)
+
+# Hours after which an upload that got no new bytes is deleted with its
+# ".part" file by "manage.py expire_uploads" (run it from cron).
+
+CHAT_ATTACHMENT_UPLOAD_EXPIRY_HOURS = config('CHAT_ATTACHMENT_UPLOAD_EXPIRY_HOURS', default=24, cast=int)
+
+# Let the front web server send the files: '' (Django streams them),
+# 'X-Accel-Redirect' (nginx, with an internal location serving
+# CHAT_ATTACHMENT_DIR at CHAT_ATTACHMENT_SENDFILE_URL) or 'X-Sendfile'
+# (Apache mod_xsendfile, lighttpd).
+
+CHAT_ATTACHMENT_SENDFILE = config('CHAT_ATTACHMENT_SENDFILE', default='')
+
+CHAT_ATTACHMENT_SENDFILE_URL = config('CHAT_ATTACHMENT_SENDFILE_URL', default='/protected/attachments/')
+
+# ASGI worker processes started by "manage.py runworkers" (0: one per core),
+# all listening on the same port (SO_REUSEPORT), and the seconds a stopping
+# worker waits for its connections to close before it is killed. The
+# workers share nothing but the database and Redis: the channel layer, the
+# presence registry (CHAT_PRESENCE_REDIS_URL, required with several
+# workers), and the per-user rate limits when CHAT_RATE_LIMIT_REDIS_URL is set.
+
+CHAT_WORKERS = config('CHAT_WORKERS', default=0, cast=int)
+
+CHAT_WORKER_DRAIN_TIMEOUT = config('CHAT_WORKER_DRAIN_TIMEOUT', default=10.0, cast=float)
+
+# Database
+# SQLite by default (development). With DATABASE_ENGINE=postgresql the
+# connection comes from the DATABASE_* variables below.
+
+DATABASE_ENGINE = config('DATABASE_ENGINE', default='sqlite3')
+
+# Database name on Postgres, file path on SQLite
+
+DATABASE_NAME = config(
+    'DATABASE_NAME', default='django_chat' if DATABASE_ENGINE == 'postgresql' else str(BASE_DIR / 'db.sqlite3')
+)
+
+# Seconds a connection is kept open for reuse (0: closed after each request
+# or sync_to_async call). Each thread has its own, so a
+# process holds about CHAT_SYNC_WORKERS + 1 connections per database.
+# Health checks test a reused connection before its first query.
+
+DATABASE_CONN_MAX_AGE = config('DATABASE_CONN_MAX_AGE', default=60, cast=int)
+
+DATABASE_CONN_HEALTH_CHECKS = config('DATABASE_CONN_HEALTH_CHECKS', default=True, cast=bool)
+
+# Set when connecting through PgBouncer in transaction mode: server side
+# cursors do not survive a transaction there.
+
+DATABASE_POOLER = config('DATABASE_POOLER', default=False, cast=bool)
+
+# Comma separated "host:port" list of Postgres read replicas, with the same
+# name and credentials as the primary. History pages and user lists are read
+# from them (see chat/routers.py).
+
+DATABASE_REPLICA_HOSTS = config('DATABASE_REPLICA_HOSTS', default='', cast=Csv())
+
+# Seconds a SQLite write waits for the lock held by another connection
+# before failing with "database is locked", and write-ahead logging so that
+# reads do not wait for writes (see chat/signals.py).
+
+SQLITE_BUSY_TIMEOUT = config('SQLITE_BUSY_TIMEOUT', default=20.0, cast=float)
+
+SQLITE_WAL = config('SQLITE_WAL', default=True, cast=bool)
+
+
+def postgres_database(host, port):
+    return {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': DATABASE_NAME,
+        'USER': config('DATABASE_USER', default='django_chat'),
+        'PASSWORD': config('DATABASE_PASSWORD', default=''),
+        'HOST': host,
+        'PORT': port,
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': DATABASE_CONN_HEALTH_CHECKS,
+        'DISABLE_SERVER_SIDE_CURSORS': DATABASE_POOLER,
+    }
+
+
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': postgres_database(
+            config('DATABASE_HOST', default='127.0.0.1'), config('DATABASE_PORT', default='5432')
+        ),
+    }
+    for index, host in enumerate(DATABASE_REPLICA_HOSTS):
+        replica_host, _, replica_port = host.partition(':')
+        DATABASES[f'replica_{index}'] = dict(
+            postgres_database(replica_host, replica_port or '5432'),
+            # Tests read the test database through the replicas
+            TEST={'MIRROR': 'default'},
+        )
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': DATABASE_NAME,
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'OPTIONS': {
+                'timeout': SQLITE_BUSY_TIMEOUT,
+            },
+        }
+    }
+
+DATABASE_ROUTERS = ['chat.routers.PrimaryReplicaRouter']
+
 
 # Password validation
 
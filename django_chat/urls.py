@@ -5,8 +5,11 @@ from django.conf import settings
 
 from django.conf.urls.static import static
 
+from chat.views import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name='metrics'),
     path('', include('chat.urls')),
 ]
 